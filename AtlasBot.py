@@ -8,18 +8,42 @@ Mapa rápido de secciones para defensa (rúbrica / puntos):
     1. IMPORTS Y CONFIGURACIÓN (Infraestructura básica, carga .env)
     2. LOGGING ESTRUCTURADO (IL3.2) -> structlog + formato JSON
     3. TEMA UI / ESTÉTICA (IE5 soporte visual, accesibilidad)
+    4.0 COMPONENTES DE INDEXACIÓN (almacén de embeddings en disco, índice léxico invertido / BM25, ANN IVF)
+    4.0b TRANSPORTE HTTP (GitHub inference: sesión con pool, timeouts y reintentos con backoff)
+    4.0c CACHÉS DE CONSULTA (respuestas por coseno del embedding con LRU + TTL; embeddings exactos
+         por texto normalizado, compartidos por el proceso y opcionalmente en disco)
+    4.0d FILTRO DE PALABRAS CLAVE (Aho-Corasick: familias prohibidas / sensibles / RAG en una pasada)
+    4.0e INGESTA EN STREAMING (CSV / TXT / JSON leídos por bloques, fragmentos con solapamiento y metadatos)
+    4.0f BASE DE CONOCIMIENTO COMPARTIDA (instantáneas inmutables del corpus e índices, una por proceso,
+         publicadas por intercambio copy-on-write)
+    4.0g BACKEND DE EMBEDDINGS LOCAL (interfaz enchufable; hashing de n-gramas + IDF incremental + proyección
+         aleatoria con scikit-learn, sin red; `ATLAS_EMBEDDINGS_BACKEND=local`)
+    4.0h CONSTRUCCIÓN DEL CONTEXTO (presupuesto de tokens del prompt, corte por puntaje, oraciones casi
+         duplicadas entre fuentes, solo oraciones relevantes de documentos largos)
     4. CLASE PRINCIPAL (ChatbotMedicoRAG) - Estructura General
              4.1 Inicialización y Cliente (OpenAI / GitHub Inference)
              4.2 Documentos Base (Carga Hospital)
              4.3 Embeddings y Recuperación (RAG híbrido)
              4.4 Generación de Respuestas LLM + Métricas de Recursos
              4.5 Seguridad y Ética (IL3.3 / IE6)
-             4.6 Métricas de Calidad (IL3.1)
+             4.6 Lógica del Agente (pipeline asíncrono: embedding en paralelo a los filtros,
+                 evaluación y registro fuera del camino de respuesta) + Métricas de Calidad (IL3.1)
              4.7 Persistencia y Logs (IE3 / IE10 trazabilidad)
              4.8 Limpieza y Mantenimiento
-    5. RATE LIMITER (Control de abuso / resiliencia básica)
-    6. UTILIDADES ASÍNCRONAS (Embeddings en background)
+    4.9 PERSISTENCIA APPEND-ONLY (escritor JSONL de logs en segundo plano, segmentos rotados, archivo columnar,
+         agregados incrementales del dashboard e historial del chat paginado desde el final del archivo)
+    4.9b TRAZAS (tramos anidados por etapa y llamada al proveedor vía contextvars, histogramas de latencia
+         con buckets fijos, exportación a `data/traces.jsonl`)
+    4.9c EVALUACIÓN EN SEGUNDO PLANO (evaluadores enchufables por lotes con tokenización compartida;
+         los puntajes se agregan al log como registros de evaluación)
+    5. RATE LIMITER (Control de abuso: token bucket / ventana deslizante O(1), expulsión de claves inactivas,
+       estado opcional en SQLite compartido entre procesos)
+    6. UTILIDADES ASÍNCRONAS (Embeddings en background, bucle asyncio del agente)
     7. INTERFAZ STREAMLIT (Tabs: Chat / Documentos / Métricas)
+    7b. BENCHMARK OFFLINE (`python AtlasBot.py --benchmark`: proveedores simulados en proceso o HTTP local,
+        p50/p95/p99 por etapa, throughput y memoria pico en JSON)
+    7c. PRESUPUESTO DE ARRANQUE (`python AtlasBot.py --startup`: tiempo de importación con dependencias
+        pesadas diferidas, costo de cada una al usarse y primera ejecución / rerun del script)
     8. BLOQUE PRINCIPAL (Protección de arranque y manejo de fallos)
 
 Convención comentarios: "IL" = Indicador de Log / Observabilidad, "IE" = Evidencia de Entrega.
@@ -30,22 +54,41 @@ Convención comentarios: "IL" = Indicador de Log / Observabilidad, "IE" = Eviden
 # ==============================================================
 import streamlit as st
 import os
+import sys
 import json
 import time
 import uuid
 import re                     # (4.5) Seguridad / Sanitización
-from datetime import datetime
-import pandas as pd
+import io                     # (4.0e) Lectura incremental de archivos subidos
+import math
+import hashlib                 # (4.0) Claves de contenido del almacén de embeddings
+import unicodedata             # (4.0c) Normalización de consultas (tildes)
+import threading
+import queue                   # (4.9) Cola del escritor de logs en segundo plano
+import atexit
+import bisect                  # (4.9b) Buckets fijos de los histogramas de latencia
+import contextlib
+import contextvars             # (4.9b) Tramo activo de la traza (se propaga a tareas e hilos)
+import argparse                # (7b) Opciones del benchmark offline
+import inspect
+import shutil
+import tempfile
+import tracemalloc             # (7b) Memoria pico del benchmark
+import sqlite3                 # (5) Estado compartido del rate limiter entre procesos
+import random                  # (4.0b) Jitter del backoff HTTP
+import abc                     # (4.0g / 4.9c) Interfaces de backends de embeddings y evaluadores
+from email.utils import parsedate_to_datetime  # (4.0b) `Retry-After` en formato fecha HTTP
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer  # (7b) Stub HTTP del benchmark
 import numpy as np
-from openai import OpenAI
-from sklearn.metrics.pairwise import cosine_similarity
-import plotly.express as px
-import plotly.graph_objects as go
-from collections import defaultdict
-import requests
+from collections import OrderedDict, defaultdict, deque
 import concurrent.futures
+import asyncio                 # (4.6b) Pipeline asíncrono del agente
 import logging                 # (2) Logging estructurado
 import structlog               # (2) Logging estructurado
+# (7c) Dependencias pesadas con importación diferida (solo al usar su función; ver `run_startup_benchmark`):
+#   openai -> `initialize_client` · requests -> `HTTPTransport` (modo GitHub) · pandas -> CSV de ingesta,
+#   pestañas Documentos y Métricas · plotly -> pestaña Métricas · scikit-learn / scipy -> `LocalEmbeddingBackend`
 
 # ==============================================================
 # 2. LOGGING ESTRUCTURADO (IL3.2) - JSON para trazabilidad
@@ -75,6 +118,64 @@ openai_api_key = os.getenv("OPENAI_API_KEY")
 openai_base_url = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
 github_token = os.getenv("GITHUB_TOKEN")
 github_inference_url = os.getenv("OPENAI_EMBEDDINGS_URL") or os.getenv("GITHUB_BASE_URL")
+embeddings_store_dir = os.getenv("ATLAS_EMBEDDINGS_DIR", os.path.join("data", "embeddings"))
+embeddings_backend = os.getenv("ATLAS_EMBEDDINGS_BACKEND", "remote").lower()  # (4.0g) "remote" (proveedor) o "local" (sin red)
+local_embed_dim = int(os.getenv("ATLAS_LOCAL_EMBED_DIM", "512"))               # dimensión de la proyección local
+local_embed_features = int(os.getenv("ATLAS_LOCAL_EMBED_FEATURES", str(2 ** 18)))  # columnas del hashing de n-gramas
+lexical_scorer = os.getenv("ATLAS_LEXICAL_SCORER", "overlap")  # "overlap" (ratio de términos) o "bm25"
+ann_mode = os.getenv("ATLAS_ANN", "auto")                  # "auto" (según tamaño), "on" u "off"
+ann_min_docs = int(os.getenv("ATLAS_ANN_MIN_DOCS", "5000"))  # umbral de documentos para "auto"
+ann_nlist = int(os.getenv("ATLAS_ANN_NLIST", "0"))           # 0 = automático (~2·sqrt(n))
+ann_nprobe = int(os.getenv("ATLAS_ANN_NPROBE", "8"))
+http_pool_size = int(os.getenv("ATLAS_HTTP_POOL_SIZE", "10"))              # (4.0b) conexiones keep-alive por host
+http_connect_timeout = float(os.getenv("ATLAS_HTTP_CONNECT_TIMEOUT", "5"))  # s
+http_read_timeout = float(os.getenv("ATLAS_HTTP_READ_TIMEOUT", "30"))       # s
+http_max_retries = int(os.getenv("ATLAS_HTTP_MAX_RETRIES", "3"))            # reintentos ante 429/5xx o error de conexión
+http_backoff_base = float(os.getenv("ATLAS_HTTP_BACKOFF_BASE", "0.5"))      # s, se duplica por intento (con jitter)
+http_backoff_max = float(os.getenv("ATLAS_HTTP_BACKOFF_MAX", "8"))          # s
+answer_cache_enabled = os.getenv("ATLAS_ANSWER_CACHE", "true").lower() not in ("0", "false", "no")  # (4.0c)
+answer_cache_threshold = float(os.getenv("ATLAS_ANSWER_CACHE_THRESHOLD", "0.92"))  # coseno mínimo para un acierto
+answer_cache_size = int(os.getenv("ATLAS_ANSWER_CACHE_SIZE", "512"))               # entradas (LRU)
+answer_cache_ttl = float(os.getenv("ATLAS_ANSWER_CACHE_TTL", "3600"))              # s
+answer_cache_direct = os.getenv("ATLAS_ANSWER_CACHE_DIRECT", "false").lower() in ("1", "true", "yes")  # también turnos directos
+query_cache_size = int(os.getenv("ATLAS_QUERY_CACHE_SIZE", "4096"))  # (4.0c) embeddings de consulta en memoria (LRU)
+query_cache_persist = os.getenv("ATLAS_QUERY_CACHE_PERSIST", "false").lower() in ("1", "true", "yes")  # ... y en disco
+embed_batch_tokens = int(os.getenv("ATLAS_EMBED_BATCH_TOKENS", "50000"))  # (4.3) presupuesto estimado de tokens por lote
+embed_batch_size = int(os.getenv("ATLAS_EMBED_BATCH_SIZE", "128"))       # máximo de textos por lote
+embed_concurrency = int(os.getenv("ATLAS_EMBED_CONCURRENCY", "4"))       # lotes en vuelo a la vez
+embed_batch_retries = int(os.getenv("ATLAS_EMBED_BATCH_RETRIES", "2"))   # reintentos por lote (en modo GitHub solo lo que el transporte no reintenta)
+chunk_tokens = int(os.getenv("ATLAS_CHUNK_TOKENS", "400"))     # (4.0e) tamaño estimado de cada fragmento
+chunk_overlap = int(os.getenv("ATLAS_CHUNK_OVERLAP", "60"))    # tokens compartidos entre fragmentos consecutivos
+csv_chunk_rows = int(os.getenv("ATLAS_CSV_CHUNK_ROWS", "1000"))  # filas leídas por bloque de CSV
+ingest_batch_chunks = int(os.getenv("ATLAS_INGEST_BATCH", "512"))  # fragmentos embebidos e indexados por tanda
+context_max_tokens = int(os.getenv("ATLAS_CONTEXT_TOKENS", "400"))          # (4.0h) presupuesto de tokens del contexto
+context_min_score = float(os.getenv("ATLAS_CONTEXT_MIN_SCORE", "0.0"))        # puntaje combinado mínimo de una fuente
+context_relative_score = float(os.getenv("ATLAS_CONTEXT_RELATIVE_SCORE", "0.6"))  # ... y fracción mínima del mejor puntaje
+context_dedup_threshold = float(os.getenv("ATLAS_CONTEXT_DEDUP", "0.8"))      # Jaccard desde el que una oración es duplicada
+context_long_doc_tokens = int(os.getenv("ATLAS_CONTEXT_LONG_DOC_TOKENS", "120"))  # documentos más largos: solo oraciones relevantes
+keywords_file = os.getenv("ATLAS_KEYWORDS_FILE")  # (4.0d) JSON opcional con las familias de palabras clave
+rate_limit_rpm = int(os.getenv("ATLAS_RATE_LIMIT_RPM", "60"))        # (5) consultas por minuto y cliente (0 = sin límite)
+rate_limit_algorithm = os.getenv("ATLAS_RATE_LIMIT_ALGORITHM", "token_bucket")  # "token_bucket" o "sliding_window"
+rate_limit_burst = int(os.getenv("ATLAS_RATE_LIMIT_BURST", "0"))      # capacidad de la cubeta (0 = igual a RPM)
+rate_limit_db = os.getenv("ATLAS_RATE_LIMIT_DB")                      # SQLite compartido entre procesos (vacío = memoria)
+rate_limit_idle_sec = float(os.getenv("ATLAS_RATE_LIMIT_IDLE", "600"))  # s sin actividad antes de expulsar una clave
+rate_limit_user_header = os.getenv("ATLAS_RATE_LIMIT_USER_HEADER", "")   # usuario autenticado por el proxy (solo con proxy de confianza)
+rate_limit_trusted_proxy = os.getenv("ATLAS_TRUSTED_PROXY", "false").lower() in ("1", "true", "yes")  # honrar X-Forwarded-*
+rate_limit_fail_open = os.getenv("ATLAS_RATE_LIMIT_FAIL_OPEN", "true").lower() not in ("0", "false", "no")  # backend caído: permitir
+streaming_enabled = os.getenv("ATLAS_STREAMING", "true").lower() not in ("0", "false", "no")  # (4.4) Respuestas en streaming
+log_segment_max_entries = int(os.getenv("ATLAS_LOG_SEGMENT_ENTRIES", "1000"))     # rotación por nº de entradas
+log_segment_max_bytes = int(os.getenv("ATLAS_LOG_SEGMENT_BYTES", str(4 * 1024 * 1024)))  # ... por tamaño
+log_segment_max_hours = float(os.getenv("ATLAS_LOG_SEGMENT_HOURS", "24"))          # ... por antigüedad
+chat_window = int(os.getenv("ATLAS_CHAT_WINDOW", "50"))       # (4.9) mensajes del chat en memoria por sesión
+chat_page_size = int(os.getenv("ATLAS_CHAT_PAGE_SIZE", "20"))  # mensajes anteriores cargados por página
+chat_retention_days = float(os.getenv("ATLAS_CHAT_RETENTION_DAYS", "30"))  # días sin actividad antes de borrar una conversación (0 = nunca)
+tracing_enabled = os.getenv("ATLAS_TRACE", "true").lower() not in ("0", "false", "no")  # (4.9b) Trazas por etapa
+trace_file = os.getenv("ATLAS_TRACE_FILE", os.path.join("data", "traces.jsonl"))      # exportación JSONL (vacío = sin archivo)
+trace_segment_bytes = int(os.getenv("ATLAS_TRACE_SEGMENT_BYTES", str(8 * 1024 * 1024)))  # rotación por tamaño
+trace_keep_segments = int(os.getenv("ATLAS_TRACE_KEEP_SEGMENTS", "10"))               # segmentos rotados que se conservan
+evaluator_names = os.getenv("ATLAS_EVALUATORS", "heuristic")      # (4.9c) evaluadores de calidad (separados por coma)
+eval_batch_size = int(os.getenv("ATLAS_EVAL_BATCH_SIZE", "32"))      # interacciones por lote de evaluación
+eval_linger_ms = float(os.getenv("ATLAS_EVAL_LINGER_MS", "200"))     # espera máxima para completar un lote
 
 st.set_page_config(page_title="🏥 Agente Médico Funcional v2 (Obs)", page_icon="🏥", layout="wide")
 
@@ -109,48 +210,1327 @@ def inject_hospital_theme(logo_path: str = None):
     except Exception:
         pass
 
+ # ==============================================================
+ # 4.0 COMPONENTES DE INDEXACIÓN (almacén de embeddings, índice léxico, ANN)
+ # ==============================================================
+class EmbeddingStore:
+    """
+    (4.0) Almacén de embeddings direccionado por contenido.
+    Cada vector se identifica por sha256(modelo + texto). Los vectores se guardan en una
+    matriz float32 memory-mapped (`<modelo>.f32`) y un manifiesto JSON (`<modelo>.json`)
+    indica la dimensión y la fila de cada hash. Solo se agregan filas (append-only).
+    """
+
+    def __init__(self, model, directory=None):
+        self.model = model
+        self.directory = directory or embeddings_store_dir
+        slug = re.sub(r"[^A-Za-z0-9_.-]+", "_", model)
+        self.matrix_path = os.path.join(self.directory, f"{slug}.f32")
+        self.manifest_path = os.path.join(self.directory, f"{slug}.json")
+        self.dim = None
+        self.count = 0
+        self.rows = {}  # hash -> fila en la matriz
+        self._matrix = None
+        self._lock = threading.Lock()
+        self._load_manifest()
+
+    @staticmethod
+    def content_key(model, text):
+        """Hash de contenido (modelo + texto) usado como clave del almacén."""
+        return hashlib.sha256(f"{model}\x00{text}".encode("utf-8")).hexdigest()
+
+    def _load_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as fh:
+                manifest = json.load(fh)
+            if manifest.get("model") != self.model:
+                return
+            dim, count = int(manifest["dim"]), int(manifest["count"])
+            size = os.path.getsize(self.matrix_path) if os.path.exists(self.matrix_path) else 0
+            if size < dim * count * 4:
+                # Manifiesto apunta a filas que no existen en disco: descartar
+                logger.warning("embedding_store", status="inconsistent", path=self.manifest_path, expected_rows=count)
+                return
+            self.dim, self.count = dim, count
+            self.rows = dict(manifest.get("rows", {}))
+        except Exception as e:
+            logger.warning("embedding_store", status="load_error", error=str(e))
+
+    def _write_manifest(self):
+        manifest = {"model": self.model, "dim": self.dim, "count": self.count, "dtype": "float32", "rows": self.rows}
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as fh:
+            json.dump(manifest, fh)
+        os.replace(tmp_path, self.manifest_path)  # escritura atómica
+
+    def _view(self):
+        if self._matrix is None and self.count:
+            self._matrix = np.memmap(self.matrix_path, dtype=np.float32, mode="r", shape=(self.count, self.dim))
+        return self._matrix
+
+    def __len__(self):
+        return len(self.rows)
+
+    def sidecar_path(self, suffix):
+        """Ruta de un artefacto asociado al modelo (p. ej. índice ANN) junto a la matriz."""
+        return self.matrix_path[:-len(".f32")] + suffix
+
+    def lookup(self, keys):
+        """Devuelve {hash: vector} solo para los hashes presentes en disco."""
+        with self._lock:
+            found = [k for k in dict.fromkeys(keys) if k in self.rows]
+            if not found:
+                return {}
+            block = np.array(self._view()[[self.rows[k] for k in found]])
+            return dict(zip(found, block))
+
+    def add(self, keys, vectors, overwrite=False):
+        """Agrega vectores nuevos al final de la matriz y actualiza el manifiesto."""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if not len(keys) or vectors.ndim != 2:
+            return 0
+        with self._lock:
+            if self.dim is None:
+                self.dim = int(vectors.shape[1])
+            elif vectors.shape[1] != self.dim:
+                raise ValueError(f"Dimensión {vectors.shape[1]} incompatible con el almacén ({self.dim})")
+            pending = {}
+            for key, vec in zip(keys, vectors):
+                if overwrite or key not in self.rows:
+                    pending[key] = vec
+            if not pending:
+                return 0
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self.matrix_path, "ab") as fh:
+                fh.truncate(self.count * self.dim * 4)  # descartar bytes huérfanos de una escritura interrumpida
+                fh.write(np.ascontiguousarray(np.stack(list(pending.values()))).tobytes())
+                fh.flush()
+                os.fsync(fh.fileno())
+            for offset, key in enumerate(pending):
+                self.rows[key] = self.count + offset
+            self.count += len(pending)
+            self._matrix = None  # reabrir el memmap con el nuevo tamaño
+            self._write_manifest()
+            return len(pending)
+
+class LexicalIndex:
+    """
+    (4.0) Índice léxico invertido construido al indexar (no en cada consulta).
+    Guarda postings término -> {doc_id: frecuencia}, longitud de cada documento y,
+    por tanto, la frecuencia documental (df) de cada término. Puntuar una consulta
+    solo recorre los postings de sus términos.
+    """
+    STRIP_CHARS = ".,?¡!():;\"'"
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = defaultdict(dict)  # término -> {doc_id: tf}
+        self.doc_len = {}                  # doc_id -> número de términos
+        self.doc_terms = {}                # doc_id -> términos únicos (para bajas sin re-tokenizar)
+        self.total_len = 0
+        self._shared = set()               # (4.0f) términos cuyos postings comparte con el índice original
+
+    def copy(self):
+        """
+        (4.0f) Copia copy-on-write: duplica los diccionarios por documento pero comparte los postings
+        de cada término con el original hasta que una alta o baja los modifica.
+        """
+        clone = LexicalIndex(self.k1, self.b)
+        clone.postings = defaultdict(dict, self.postings)
+        clone.doc_len = dict(self.doc_len)
+        clone.doc_terms = dict(self.doc_terms)
+        clone.total_len = self.total_len
+        clone._shared = set(self.postings)
+        return clone
+
+    def _writable(self, term):
+        """Postings propios de `term` (se copian la primera vez si eran compartidos)."""
+        if term in self._shared:
+            self._shared.discard(term)
+            self.postings[term] = dict(self.postings[term])
+        return self.postings[term]
+
+    @classmethod
+    def tokenize(cls, text):
+        """Términos de un texto (palabras >2 caracteres, sin puntuación, minúsculas)."""
+        terms = [w.strip(cls.STRIP_CHARS).lower() for w in text.split() if len(w) > 2]
+        return [t for t in terms if t]
+
+    def __len__(self):
+        return len(self.doc_len)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.doc_len
+
+    def document_frequency(self, term):
+        return len(self.postings.get(term, ()))
+
+    def add(self, doc_id, text):
+        if doc_id in self.doc_len:
+            self.remove(doc_id)
+        terms = self.tokenize(text)
+        counts = defaultdict(int)
+        for term in terms:
+            counts[term] += 1
+        for term, tf in counts.items():
+            self._writable(term)[doc_id] = tf
+        self.doc_terms[doc_id] = tuple(counts)
+        self.doc_len[doc_id] = len(terms)
+        self.total_len += len(terms)
+
+    def remove(self, doc_id):
+        if doc_id not in self.doc_len:
+            return
+        for term in self.doc_terms.pop(doc_id, ()):
+            if term in self.postings:
+                docs = self._writable(term)
+                docs.pop(doc_id, None)
+                if not docs:
+                    del self.postings[term]
+        self.total_len -= self.doc_len.pop(doc_id)
+
+    def score(self, query, scorer="overlap"):
+        """
+        Puntuaciones léxicas {doc_id: score en [0, 1]} para los documentos que comparten términos con la query.
+        - "overlap": fracción de términos (únicos) de la query presentes en el documento.
+        - "bm25": Okapi BM25 normalizado por el máximo de la consulta.
+        """
+        q_terms = set(self.tokenize(query))
+        scores = defaultdict(float)
+        if not q_terms or not self.doc_len:
+            return scores
+        if scorer == "bm25":
+            n_docs = len(self.doc_len)
+            avgdl = max(1e-9, self.total_len / n_docs)
+            for term in q_terms:
+                docs = self.postings.get(term)
+                if not docs:
+                    continue
+                idf = math.log(1.0 + (n_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+                for doc_id, tf in docs.items():
+                    norm = self.k1 * (1.0 - self.b + self.b * self.doc_len[doc_id] / avgdl)
+                    scores[doc_id] += idf * tf * (self.k1 + 1.0) / (tf + norm)
+            top = max(scores.values(), default=0.0)
+            if top > 0:
+                for doc_id in scores:
+                    scores[doc_id] /= top
+            return scores
+        for term in q_terms:
+            for doc_id in self.postings.get(term, ()):
+                scores[doc_id] += 1.0
+        for doc_id in scores:
+            scores[doc_id] /= len(q_terms)
+        return scores
+
+class IVFIndex:
+    """
+    (4.0) Índice ANN tipo IVF construido en NumPy.
+    Un k-means esférico (cuantizador grueso) reparte las filas de `embedding_matrix` en
+    `nlist` listas invertidas. La consulta puntúa los centroides, explora solo las `nprobe`
+    listas más cercanas y compara exactamente contra esas filas. Se mantiene de forma
+    incremental (altas, bajas y reemplazos) y se persiste junto al almacén de embeddings.
+    """
+
+    def __init__(self, centroids, assign, trained_size=None):
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.assign = np.asarray(assign, dtype=np.int32)  # fila -> lista
+        self.trained_size = int(trained_size if trained_size is not None else len(self.assign))
+        self._rebuild_lists()
+
+    def __len__(self):
+        return len(self.assign)
+
+    def copy(self):
+        """(4.0f) Copia independiente para modificar sin afectar a quien consulta el original."""
+        clone = IVFIndex.__new__(IVFIndex)
+        clone.centroids = self.centroids
+        clone.assign = self.assign.copy()
+        clone.trained_size = self.trained_size
+        clone.lists = list(self.lists)  # las listas se sustituyen (nunca se mutan) en add/update
+        return clone
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    def _rebuild_lists(self):
+        order = np.argsort(self.assign, kind="stable")
+        bounds = np.cumsum(np.bincount(self.assign, minlength=self.nlist))[:-1]
+        self.lists = np.split(order.astype(np.int64), bounds)
+
+    def _nearest(self, vectors, chunk=65536):
+        labels = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), chunk):
+            labels[start:start + chunk] = np.argmax(vectors[start:start + chunk] @ self.centroids.T, axis=1)
+        return labels
+
+    @classmethod
+    def train(cls, matrix, nlist=None, iterations=10, seed=0):
+        """Entrena el cuantizador (k-means esférico sobre una muestra) y asigna todas las filas."""
+        n = len(matrix)
+        nlist = min(n, nlist or max(1, int(round(2 * math.sqrt(n)))))
+        rng = np.random.default_rng(seed)
+        sample = matrix if n <= 64 * nlist else matrix[np.sort(rng.choice(n, 64 * nlist, replace=False))]
+        centroids = np.array(sample[rng.choice(len(sample), nlist, replace=False)], dtype=np.float32)
+        for _ in range(iterations):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            order = np.argsort(labels, kind="stable")
+            present, starts = np.unique(labels[order], return_index=True)
+            sums = np.add.reduceat(sample[order], starts, axis=0)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            centroids[present] = sums / np.maximum(norms, 1e-12)  # listas vacías conservan su centroide
+        index = cls(centroids, np.zeros(0, dtype=np.int32), trained_size=n)
+        index.assign = index._nearest(matrix)
+        index._rebuild_lists()
+        return index
+
+    def candidates(self, q_vec, nprobe=8):
+        """Filas de las `nprobe` listas cuyo centroide es más similar a la consulta."""
+        scores = self.centroids @ q_vec
+        nprobe = min(max(1, nprobe), self.nlist)
+        probes = np.argpartition(-scores, nprobe - 1)[:nprobe] if nprobe < self.nlist else np.arange(self.nlist)
+        return np.concatenate([self.lists[p] for p in probes])
+
+    def add(self, start_row, vectors):
+        """Asigna filas nuevas (consecutivas desde `start_row`) a su lista más cercana."""
+        labels = self._nearest(np.asarray(vectors, dtype=np.float32))
+        self.assign = np.concatenate([self.assign, labels])
+        for label in np.unique(labels):
+            rows = start_row + np.flatnonzero(labels == label)
+            self.lists[label] = np.concatenate([self.lists[label], rows])
+
+    def update(self, row, vector):
+        """Reasigna una fila cuyo vector cambió."""
+        label = int(self._nearest(np.asarray(vector, dtype=np.float32).reshape(1, -1))[0])
+        old = int(self.assign[row])
+        if label != old:
+            self.lists[old] = self.lists[old][self.lists[old] != row]
+            self.lists[label] = np.append(self.lists[label], row)
+            self.assign[row] = label
+
+    def remove(self, removed_rows):
+        """Elimina filas y compacta la numeración (igual que `embedding_matrix[keep]`)."""
+        removed = np.unique(np.asarray(removed_rows, dtype=np.int64))
+        if not len(removed):
+            return
+        self.assign = np.delete(self.assign, removed)
+        self._rebuild_lists()
+
+    def needs_retrain(self):
+        """El cuantizador se desactualiza si el corpus creció mucho desde el entrenamiento."""
+        return len(self.assign) > 4 * max(1, self.trained_size)
+
+    def save(self, path, fingerprint):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as fh:
+            np.savez(fh, centroids=self.centroids, assign=self.assign,
+                     trained_size=np.array(self.trained_size), fingerprint=np.array(fingerprint))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, fingerprint):
+        """Carga el índice si existe y corresponde al mismo corpus (`fingerprint`); si no, None."""
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            if str(data["fingerprint"]) != fingerprint:
+                return None
+            return cls(data["centroids"], data["assign"], int(data["trained_size"]))
+
+
+ # ==============================================================
+ # 4.0b TRANSPORTE HTTP (GitHub inference: pool de conexiones y reintentos)
+ # ==============================================================
+class HTTPTransport:
+    """
+    (4.0b) Cliente HTTP con `requests.Session` (keep-alive, pool de conexiones), timeouts de
+    conexión y lectura separados, y reintentos con backoff exponencial con jitter para
+    429/5xx y errores de conexión (respeta `Retry-After`). Lleva contadores para el dashboard.
+    """
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+    MAX_RETRY_AFTER = 60.0  # tope (s) para un `Retry-After` del servidor
+
+    def __init__(self, base_url, token, pool_size=None, connect_timeout=None, read_timeout=None,
+                 max_retries=None, backoff_base=None, backoff_max=None):
+        self.base_url = base_url.rstrip("/")
+        self.token = token
+        self.pool_size = pool_size or http_pool_size
+        self.timeout = (connect_timeout or http_connect_timeout, read_timeout or http_read_timeout)
+        self.max_retries = http_max_retries if max_retries is None else max_retries
+        self.backoff_base = backoff_base or http_backoff_base
+        self.backoff_max = backoff_max or http_backoff_max
+        import requests  # (7c) diferido: solo el modo GitHub inference lo usa
+        self.session = requests.Session()
+        self.adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=0)
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+        self.session.headers.update({"Authorization": f"Bearer {token}", "Content-Type": "application/json"})
+        self._lock = threading.Lock()
+        self.counters = {'requests': 0, 'attempts': 0, 'retries': 0, 'failures': 0}
+        self.status_counts = defaultdict(int)
+        self.latency = QuantileSketch()  # tiempo hasta cabeceras por intento
+        self.latency_sum = 0.0
+
+    def _backoff(self, attempt, resp=None):
+        """Espera antes del reintento `attempt`: `Retry-After` si viene, si no backoff exponencial con jitter completo."""
+        retry_after = resp.headers.get("Retry-After") if resp is not None else None
+        if retry_after:
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                try:
+                    delay = (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds()
+                except (TypeError, ValueError):
+                    delay = None
+            if delay is not None:
+                return min(max(delay, 0.0), self.MAX_RETRY_AFTER)
+        return random.uniform(0.0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def post(self, path, payload, stream=False, accept="application/json"):
+        """POST con reintentos; devuelve la respuesta (ya validada con `raise_for_status`)."""
+        import requests
+        url = f"{self.base_url}/{path.lstrip('/')}"
+        with self._lock:
+            self.counters['requests'] += 1
+        attempt = 0
+        while True:
+            start = time.time()
+            resp = None
+            try:
+                resp = self.session.post(url, json=payload, headers={"Accept": accept}, timeout=self.timeout, stream=stream)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            else:
+                error = None
+            elapsed = time.time() - start
+            with self._lock:
+                self.counters['attempts'] += 1
+                self.status_counts[resp.status_code if resp is not None else 'error'] += 1
+                self.latency.add(elapsed)
+                self.latency_sum += elapsed
+            retryable = error is not None or resp.status_code in self.RETRY_STATUS
+            if not retryable or attempt >= self.max_retries:
+                if error is not None or not resp.ok:
+                    with self._lock:
+                        self.counters['failures'] += 1
+                if error is not None:
+                    raise error
+                resp.raise_for_status()
+                return resp
+            delay = self._backoff(attempt, resp)
+            logger.warning("http_retry", path=path, attempt=attempt + 1, delay_sec=round(delay, 3),
+                           status=resp.status_code if resp is not None else None, error=str(error) if error else None)
+            if resp is not None:
+                resp.close()
+            with self._lock:
+                self.counters['retries'] += 1
+            time.sleep(delay)
+            attempt += 1
+
+    def stats(self):
+        """Contadores para el dashboard: reintentos, estados, reutilización de conexiones y latencia."""
+        opened = served = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():  # `keys()` copia bajo el lock del contenedor de urllib3
+            pool = pools.get(key)
+            opened += getattr(pool, "num_connections", 0)
+            served += getattr(pool, "num_requests", 0)
+        with self._lock:
+            attempts = self.counters['attempts']
+            return {
+                **self.counters,
+                'status_counts': {str(k): v for k, v in self.status_counts.items()},
+                'connections_opened': opened,
+                'connections_reused': max(served - opened, 0),
+                'reuse_ratio': (served - opened) / served if served else 0.0,
+                'latency_mean': self.latency_sum / attempts if attempts else 0.0,
+                'latency_p50': self.latency.quantile(0.5),
+                'latency_p95': self.latency.quantile(0.95),
+            }
+
+    def close(self):
+        self.session.close()
+
+
+ # ==============================================================
+ # 4.0c CACHÉS DE CONSULTA (respuestas por similitud semántica, embeddings exactos)
+ # ==============================================================
+class SemanticAnswerCache:
+    """
+    (4.0c) Respuestas previas indexadas por el embedding normalizado de la consulta.
+    Un acierto es la entrada más similar con coseno >= `threshold` y sin expirar (TTL).
+    Memoria acotada: matriz float32 de `max_entries` filas con expulsión LRU. Todas las
+    entradas pertenecen a un `namespace` (modelo LLM, modelo de embeddings, versión del
+    corpus); si cambia, la caché se vacía.
+    """
+
+    def __init__(self, max_entries=512, threshold=0.92, ttl_sec=3600.0):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.ttl_sec = ttl_sec
+        self._lock = threading.Lock()
+        self.namespace = None
+        self.matrix = None                 # (max_entries, dim) float32, reservada al primer `put`
+        self.entries = OrderedDict()       # fila -> entrada (orden LRU: la más reciente al final)
+        self.free_rows = []
+        self.hits = 0
+        self.misses = 0
+        self.saved_sec = 0.0
+
+    def _reset(self, namespace):
+        self.namespace = namespace
+        self.matrix = None
+        self.entries.clear()
+        self.free_rows = []
+
+    def _check_namespace(self, namespace):
+        if namespace != self.namespace:
+            if self.entries:
+                logger.info("answer_cache", status="invalidated", entries=len(self.entries))
+            self._reset(namespace)
+
+    def _drop(self, row):
+        self.entries.pop(row, None)
+        self.free_rows.append(row)
+
+    def get(self, q_vec, namespace):
+        """Entrada más similar a `q_vec` (normalizado) o None; cuenta aciertos / fallos."""
+        with self._lock:
+            self._check_namespace(namespace)
+            now = time.time()
+            for row in [r for r, e in self.entries.items() if now - e['created'] > self.ttl_sec]:
+                self._drop(row)
+            if not self.entries:
+                self.misses += 1
+                return None
+            rows = np.fromiter(self.entries.keys(), dtype=np.int64, count=len(self.entries))
+            sims = self.matrix[rows] @ q_vec
+            best = int(np.argmax(sims))
+            if sims[best] < self.threshold:
+                self.misses += 1
+                return None
+            row = int(rows[best])
+            self.entries.move_to_end(row)
+            self.hits += 1
+            entry = self.entries[row]
+            return dict(entry, similarity=float(sims[best]))
+
+    def put(self, q_vec, namespace, response, results, cost_sec):
+        """Guarda una respuesta generada; `cost_sec` es la latencia que ahorrará cada acierto."""
+        with self._lock:
+            self._check_namespace(namespace)
+            if self.matrix is None or self.matrix.shape[1] != len(q_vec):
+                self._reset(namespace)
+                self.matrix = np.zeros((self.max_entries, len(q_vec)), dtype=np.float32)
+                self.free_rows = list(range(self.max_entries - 1, -1, -1))
+            if not self.free_rows:
+                self._drop(next(iter(self.entries)))  # expulsión LRU
+            row = self.free_rows.pop()
+            self.matrix[row] = q_vec
+            self.entries[row] = {'response': response, 'results': results, 'cost_sec': cost_sec, 'created': time.time()}
+
+    def record_saving(self, seconds):
+        with self._lock:
+            self.saved_sec += max(seconds, 0.0)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups else 0.0, 'saved_sec': self.saved_sec}
+
+
+class QueryEmbeddingCache:
+    """
+    (4.0c) Caché exacta de embeddings de consulta, compartida por todo el proceso.
+    Clave: (modelo, texto normalizado: casefold + sin tildes + espacios colapsados).
+    LRU acotada en memoria; opcionalmente respaldada en disco con un `EmbeddingStore`
+    propio (`<ATLAS_EMBEDDINGS_DIR>/queries`) para sobrevivir reinicios.
+    """
+
+    def __init__(self, max_entries=4096, persist=False, directory=None):
+        self.max_entries = max_entries
+        self.persist = persist
+        self.directory = directory or os.path.join(embeddings_store_dir, "queries")
+        self._lock = threading.Lock()
+        self.entries = OrderedDict()  # content_key(modelo, normalizado) -> vector float32
+        self.stores = {}              # modelo -> EmbeddingStore (solo con `persist`)
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(text):
+        folded = unicodedata.normalize("NFKD", str(text).casefold())
+        folded = "".join(ch for ch in folded if not unicodedata.combining(ch))
+        return " ".join(folded.split())
+
+    def _store(self, model):
+        if model not in self.stores:
+            self.stores[model] = EmbeddingStore(model, directory=self.directory)
+        return self.stores[model]
+
+    def _remember(self, key, vector):
+        self.entries[key] = vector
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get(self, model, text):
+        key = EmbeddingStore.content_key(model, self.normalize(text))
+        with self._lock:
+            vector = self.entries.get(key)
+            if vector is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return vector
+            if self.persist:
+                try:
+                    vector = self._store(model).lookup([key]).get(key)
+                except Exception as e:
+                    logger.warning("query_embedding_cache", status="disk_error", error=str(e))
+                if vector is not None:
+                    self._remember(key, vector)
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return vector
+            self.misses += 1
+            return None
+
+    def put(self, model, text, vector):
+        key = EmbeddingStore.content_key(model, self.normalize(text))
+        vector = np.asarray(vector, dtype=np.float32)
+        with self._lock:
+            self._remember(key, vector)
+            if self.persist:
+                try:
+                    self._store(model).add([key], vector[None, :])
+                except Exception as e:
+                    logger.warning("query_embedding_cache", status="disk_error", error=str(e))
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self.entries), 'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups else 0.0}
+
+
+@st.cache_resource
+def get_query_embedding_cache():
+    """(4.0c) Una sola caché de embeddings de consulta por proceso (compartida entre sesiones y reruns)."""
+    return QueryEmbeddingCache(query_cache_size, persist=query_cache_persist)
+
+
+@st.cache_resource
+def get_answer_cache():
+    """(4.0c) Caché semántica de respuestas compartida por las sesiones (None si está deshabilitada)."""
+    return SemanticAnswerCache(answer_cache_size, answer_cache_threshold, answer_cache_ttl) if answer_cache_enabled else None
+
+
+ # ==============================================================
+ # 4.0d FILTRO DE PALABRAS CLAVE (Aho-Corasick: seguridad y ruteo RAG en una pasada)
+ # ==============================================================
+class KeywordMatcher:
+    """
+    (4.0d) Autómata Aho-Corasick sobre todas las familias de palabras clave (prohibidas,
+    sensibles, RAG). Se construye una vez; `classify` recorre la consulta en minúsculas
+    una sola vez (coste lineal en su largo, independiente del número de términos) y
+    devuelve {familia: primera palabra clave encontrada}. Coincidencia por subcadena.
+    """
+    DEFAULT_KEYWORDS = {
+        'prohibited': [
+            "suicid", "suicidi", "matarme", "morir", "muerte",  # Salud mental crítica
+            "hackear", "hack", "exploit", "vulnerabilidad",  # Seguridad
+            "violencia", "violen", "agredir", "golpear", "matar", "dañ", "herir", "lastim", "pegar",  # Violencia y daño
+            "terrorismo", "terrorista", "bomba", "explosivo", "atentado",  # Terrorismo
+            "droga", "cocaína", "heroína", "metanfetamina", "narcotraf",  # Drogas ilegales
+            "arma", "pistola", "rifle", "ametralladora", "cuchillo"  # Armas
+        ],
+        # IE6: Temas sensibles (Consejo Legal/Financiero/Específico no médico)
+        'sensitive': ["inversión", "abogado", "ley", "demanda"],
+        'rag': ["horari", "protocolo", "servicio", "emerg", "urgenc", "hospital", "teléfono", "telefono", "direcci", "ubicac", "consulta", "cita"],
+    }
+
+    def __init__(self, families):
+        self.families = {family: [k.lower() for k in keywords if k] for family, keywords in families.items()}
+        self.goto = [{}]   # nodo -> {carácter: nodo}
+        self.fail = [0]
+        self.output = [()]  # nodo -> ((familia, palabra), ...) que terminan en ese nodo
+        for family, keywords in self.families.items():
+            for keyword in keywords:
+                node = 0
+                for ch in keyword:
+                    nxt = self.goto[node].get(ch)
+                    if nxt is None:
+                        nxt = len(self.goto)
+                        self.goto[node][ch] = nxt
+                        self.goto.append({})
+                        self.fail.append(0)
+                        self.output.append(())
+                    node = nxt
+                self.output[node] += ((family, keyword),)
+        # Enlaces de fallo en anchura (BFS); cada nodo hereda las salidas de su sufijo
+        pending = deque(self.goto[0].values())
+        while pending:
+            node = pending.popleft()
+            for ch, child in self.goto[node].items():
+                pending.append(child)
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[child] = self.goto[f].get(ch, 0)
+                self.output[child] += self.output[self.fail[child]]
+
+    @classmethod
+    def from_config(cls, path=None):
+        """
+        Familias por defecto, reemplazadas por las que defina el JSON `path`
+        (p. ej. {"prohibited": [...], "sensitive": [...], "rag": [...]}).
+        """
+        families = {family: list(keywords) for family, keywords in cls.DEFAULT_KEYWORDS.items()}
+        if path:
+            try:
+                with open(path, "r", encoding="utf-8") as fh:
+                    loaded = json.load(fh)
+                families.update({family: [str(k) for k in keywords] for family, keywords in loaded.items()
+                                 if isinstance(keywords, list)})
+                logger.info("keyword_matcher", status="loaded", path=path,
+                            terms={family: len(keywords) for family, keywords in families.items()})
+            except Exception as e:
+                logger.warning("keyword_matcher", status="config_error", path=path, error=str(e))
+        return cls(families)
+
+    def classify(self, text):
+        """{familia: palabra clave} de cada familia presente en `text` (primera aparición)."""
+        found = {}
+        goto, fail, output = self.goto, self.fail, self.output
+        node = 0
+        for ch in text.lower():
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            for family, keyword in output[node]:
+                found.setdefault(family, keyword)
+        return found
+
+
+ # ==============================================================
+ # 4.0e INGESTA EN STREAMING (lectura incremental y fragmentos con solapamiento)
+ # ==============================================================
+class StreamingChunker:
+    """
+    (4.0e) Convierte un archivo subido (CSV / TXT / JSON o JSONL) en fragmentos acotados por
+    tokens (estimados como en `_estimate_tokens`: ~4 caracteres por token) con solapamiento,
+    sin materializar el archivo completo: CSV por bloques de filas, TXT y JSON por bloques de
+    caracteres. Cada fragmento lleva metadatos {source, record, offset, chunk}; `offset` es
+    la posición en caracteres dentro del archivo (TXT) o del registro (CSV / JSON).
+    """
+    TEXT_FIELDS = ("content", "text")
+    MIN_CHARS = 10  # Igual que el filtro de `load_external_documents`
+
+    def __init__(self, max_tokens=None, overlap_tokens=None, block_chars=65536, csv_rows=None):
+        self.max_chars = max(1, max_tokens or chunk_tokens) * 4
+        self.overlap_chars = min(max(0, overlap_tokens if overlap_tokens is not None else chunk_overlap) * 4,
+                                 self.max_chars // 2)
+        self.block_chars = block_chars
+        self.csv_rows = csv_rows or csv_chunk_rows
+
+    def _cut(self, text):
+        """Fin del primer fragmento de `text` (≤ max_chars), en fin de frase o espacio si lo hay."""
+        if len(text) <= self.max_chars:
+            return len(text)
+        floor = self.overlap_chars + 1  # el fragmento debe avanzar más allá del solapamiento
+        for sep in ("\n", ". ", " "):
+            cut = text.rfind(sep, floor, self.max_chars)
+            if cut != -1:
+                return cut + len(sep)
+        return self.max_chars
+
+    def _next_start(self, text, end):
+        """Inicio del siguiente fragmento: `overlap_chars` antes de `end`, alineado a palabra."""
+        start = max(end - self.overlap_chars, 1)
+        if start < end and not text[start - 1].isspace():
+            space = text.find(" ", start, end)
+            start = space + 1 if space != -1 else start
+        return start
+
+    def split(self, text):
+        """Pares (offset, fragmento) de un texto ya en memoria (una celda o un registro JSON)."""
+        offset = 0
+        while len(text) > self.max_chars:
+            end = self._cut(text)
+            yield offset, text[:end]
+            start = self._next_start(text, end)
+            text, offset = text[start:], offset + start
+        if text:
+            yield offset, text
+
+    def _emit(self, source, record, pieces, base=0, first=0):
+        """Fragmentos (texto, metadatos) de `pieces`, descartando los demasiado cortos."""
+        for chunk, (offset, text) in enumerate(pieces, start=first):
+            text = text.strip()
+            if len(text) >= self.MIN_CHARS:
+                yield text, {'source': source, 'record': record, 'offset': base + offset, 'chunk': chunk}
+
+    @classmethod
+    def record_text(cls, record):
+        """Texto de un registro JSON: campo 'content'/'text' de un objeto, o el propio string."""
+        if isinstance(record, dict):
+            for field in cls.TEXT_FIELDS:
+                if isinstance(record.get(field), str):
+                    return record[field]
+            return json.dumps(record, ensure_ascii=False)
+        return record if isinstance(record, str) else json.dumps(record, ensure_ascii=False)
+
+    def iter_csv(self, fileobj, source):
+        """CSV por bloques de `csv_rows` filas (columna 'content', 'text' o la primera)."""
+        import pandas as pd  # (7c) diferido: solo la ingesta de CSV lo usa
+        for frame in pd.read_csv(fileobj, chunksize=self.csv_rows):
+            column = next((c for c in self.TEXT_FIELDS if c in frame.columns), frame.columns[0])
+            for row, value in frame[column].dropna().items():
+                yield from self._emit(source, int(row), self.split(str(value)))
+
+    def iter_text(self, fileobj, source):
+        """
+        TXT leído por bloques: un párrafo (separado por línea en blanco) es un registro; los
+        párrafos más largos que un fragmento se cortan sobre la marcha, con memoria O(fragmento + bloque).
+        """
+        reader = io.TextIOWrapper(fileobj, encoding="utf-8", errors="replace")
+        separator = re.compile(r"\n[ \t\r\f\v]*\n")
+        buf, buf_offset, record, chunk = "", 0, 0, 0
+        try:
+            while True:
+                block = reader.read(self.block_chars)
+                buf += block
+                match = separator.search(buf)
+                while match:
+                    yield from self._emit(source, record, self.split(buf[:match.start()]), buf_offset, chunk)
+                    record, chunk = record + 1, 0
+                    buf, buf_offset = buf[match.end():], buf_offset + match.end()
+                    match = separator.search(buf)
+                # Párrafo aún abierto: se emiten las ventanas completas y se conserva el solapamiento
+                # (más margen para un separador que pueda quedar partido entre bloques)
+                while block and len(buf) > self.max_chars + self.block_chars:
+                    end = self._cut(buf)
+                    yield from self._emit(source, record, [(0, buf[:end])], buf_offset, chunk)
+                    chunk += 1
+                    start = self._next_start(buf, end)
+                    buf, buf_offset = buf[start:], buf_offset + start
+                if not block:
+                    break
+            yield from self._emit(source, record, self.split(buf), buf_offset, chunk)
+        finally:
+            reader.detach()  # No cerrar el archivo subido al descartar el lector
+
+    def iter_json(self, fileobj, source):
+        """
+        JSON leído por bloques: una lista de textos/objetos se decodifica elemento a elemento; si
+        empieza por '{' (un objeto, aunque tenga saltos de línea, o JSONL de objetos) se decodifican
+        los valores uno tras otro con `raw_decode`; en otro caso se trata como JSONL (un registro por línea).
+        """
+        reader = io.TextIOWrapper(fileobj, encoding="utf-8", errors="replace")
+        try:
+            buf = reader.read(self.block_chars).lstrip("\ufeff \t\r\n")
+            if buf.startswith("["):
+                yield from self._iter_values(reader, source, buf[1:], " \t\r\n,", "]")
+                return
+            if buf.startswith("{"):
+                yield from self._iter_values(reader, source, buf, " \t\r\n", None)
+                return
+            record, more = 0, buf
+            while more:
+                more = reader.read(self.block_chars)
+                lines = (buf + more).split("\n")
+                buf = lines.pop() if more else ""  # última línea posiblemente incompleta
+                for line in lines:
+                    if line.strip():
+                        yield from self._emit(source, record, self.split(self.record_text(json.loads(line))))
+                        record += 1
+        finally:
+            reader.detach()
+
+    def _iter_values(self, reader, source, buf, separators, closing):
+        """Valores JSON consecutivos de `reader` (separados por `separators`, hasta `closing` o el final)."""
+        decoder = json.JSONDecoder()
+        record, eof = 0, False
+        while True:
+            buf = buf.lstrip(separators)
+            if len(buf) < self.block_chars and not eof:
+                more = reader.read(self.block_chars)
+                eof = not more
+                buf += more
+                continue
+            if not buf or (closing and buf.startswith(closing)):
+                return
+            try:
+                value, end = decoder.raw_decode(buf)
+                complete = eof or end < len(buf)  # un número al final del bloque podría seguir
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                complete = False
+            if not complete:
+                more = reader.read(self.block_chars)
+                eof = not more
+                buf += more
+                continue
+            buf = buf[end:]
+            yield from self._emit(source, record, self.split(self.record_text(value)))
+            record += 1
+
+    def iter_file(self, fileobj, source):
+        """Fragmentos (texto, metadatos) del archivo según su extensión."""
+        name = source.lower()
+        if name.endswith(".csv"):
+            return self.iter_csv(fileobj, source)
+        if name.endswith((".json", ".jsonl")):
+            return self.iter_json(fileobj, source)
+        return self.iter_text(fileobj, source)
+
+
+ # ==============================================================
+ # 4.0f BASE DE CONOCIMIENTO COMPARTIDA (instantáneas inmutables, intercambio copy-on-write)
+ # ==============================================================
+class KBSnapshot:
+    """
+    (4.0f) Estado del corpus indexado en un instante: textos, ids, metadatos, matriz normalizada e
+    índices léxico / ANN. Una vez publicado no se modifica; cada cambio construye una instantánea
+    nueva (`replace`) con la versión siguiente, que también sirve de `corpus_version` (4.0c).
+    """
+    __slots__ = ("documents", "doc_ids", "doc_meta", "doc_rows", "embedding_matrix", "lexical_index",
+                 "ann_index", "version")
+
+    def __init__(self, documents=None, doc_ids=None, doc_meta=None, doc_rows=None, embedding_matrix=None,
+                 lexical_index=None, ann_index=None, version=0):
+        self.documents = documents if documents is not None else []
+        self.doc_ids = doc_ids if doc_ids is not None else []
+        self.doc_meta = doc_meta if doc_meta is not None else {}
+        self.doc_rows = doc_rows if doc_rows is not None else {d: row for row, d in enumerate(self.doc_ids)}
+        self.embedding_matrix = embedding_matrix
+        self.lexical_index = lexical_index if lexical_index is not None else LexicalIndex()
+        self.ann_index = ann_index
+        self.version = version
+
+    def replace(self, **changes):
+        """Instantánea nueva con `changes` aplicados (los campos no indicados se comparten)."""
+        fields = {name: getattr(self, name) for name in self.__slots__}
+        if "doc_ids" in changes and "doc_rows" not in changes:
+            fields["doc_rows"] = None  # se recalcula a partir de los ids nuevos
+        fields.update(changes, version=self.version + 1)
+        return KBSnapshot(**fields)
+
+
+class KnowledgeBase:
+    """
+    (4.0f) Corpus indexado (documentos, embeddings e índices) compartido por todas las sesiones del
+    proceso (`get_knowledge_base`). Los lectores toman `snapshot` una vez por operación y trabajan
+    sobre esa instantánea sin bloqueos. Los escritores se serializan con `lock`, construyen la
+    instantánea siguiente (listas nuevas, copias copy-on-write de los índices, matriz ampliada
+    sobre un buffer de reserva) y la publican con `publish`: una asignación atómica, por lo que
+    una ingesta nunca bloquea ni altera a quien está buscando.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.snapshot = KBSnapshot()
+        self.ready = False          # corpus inicial cargado y embebido (una vez por proceso)
+        self.matrix_buffer = None   # buffer con capacidad de reserva tras la última matriz publicada
+        self._stores = {}           # modelo -> EmbeddingStore (un único escritor por directorio)
+        self._backends = {}         # (4.0g) nombre -> EmbeddingBackend local (su estado describe este corpus)
+
+    def publish(self, snapshot):
+        """Publica `snapshot`; las instantáneas anteriores siguen siendo válidas para quien las tenga."""
+        self.snapshot = snapshot
+        logger.info("kb_snapshot", version=snapshot.version, documents=len(snapshot.documents),
+                    indexed=snapshot.embedding_matrix is not None)
+        return snapshot
+
+    def embedding_store(self, model):
+        """(4.0) Almacén en disco de `model`, compartido por las sesiones."""
+        with self.lock:
+            if model not in self._stores:
+                self._stores[model] = EmbeddingStore(model)
+            return self._stores[model]
+
+    def embedding_backend(self, name):
+        """(4.0g) Backend de embeddings local `name`, compartido por las sesiones; None = proveedor remoto."""
+        with self.lock:
+            if name not in self._backends:
+                backend = None
+                if name in EMBEDDING_BACKENDS:
+                    try:
+                        backend = EMBEDDING_BACKENDS[name]()
+                        logger.info("embedding_backend", backend=name, model=backend.model)
+                    except Exception as e:
+                        logger.error("embedding_backend", backend=name, status="error", error=str(e))
+                elif name != "remote":
+                    logger.warning("embedding_backend", backend=name, status="unknown", fallback="remote")
+                self._backends[name] = backend
+            return self._backends[name]
+
+    def grow_matrix(self, matrix, rows):
+        """
+        `matrix` + `rows` (ya normalizadas) con crecimiento amortizado: las filas nuevas se escriben
+        en el buffer más allá del final de `matrix`, zona que ninguna instantánea publicada ve.
+        """
+        n = 0 if matrix is None else len(matrix)
+        buf = self.matrix_buffer
+        reusable = (buf is not None and matrix is not None and buf.shape[1] == rows.shape[1]
+                    and len(buf) >= n + len(rows) and np.shares_memory(buf, matrix))
+        if not reusable:
+            buf = np.empty((max(16, 2 * (n + len(rows))), rows.shape[1]), dtype=np.float32)
+            if n:
+                buf[:n] = matrix
+            self.matrix_buffer = buf
+        buf[n:n + len(rows)] = rows
+        return buf[:n + len(rows)]
+
+
+@st.cache_resource
+def get_knowledge_base():
+    """(4.0f) Una sola base de conocimiento por proceso (compartida entre sesiones y reruns)."""
+    return KnowledgeBase()
+
+
+ # ==============================================================
+ # 4.0g BACKEND DE EMBEDDINGS LOCAL (sin red: hashing + IDF incremental + proyección aleatoria)
+ # ==============================================================
+class EmbeddingBackend(abc.ABC):
+    """
+    (4.0g) Interfaz de un backend de embeddings que corre en el proceso (sin proveedor remoto).
+    `model` identifica el espacio vectorial: es la clave del almacén en disco, de las cachés y del
+    índice ANN. Los vectores de documentos no pueden depender del estado ajustado con `update`
+    (solo las consultas lo usan), así los vectores ya guardados siguen valiendo tras cada ingesta.
+    Para agregar un backend: subclase + entrada en `EMBEDDING_BACKENDS`.
+    """
+    model = None
+
+    def __init__(self):
+        self.n_docs = 0
+        self.digest = 0  # hash de multiconjunto del corpus ajustado (ver `corpus_digest`)
+
+    @staticmethod
+    def text_digest(text):
+        return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+
+    @classmethod
+    def corpus_digest(cls, texts):
+        """Hash del corpus independiente del orden, actualizable sumando / restando cada texto."""
+        return sum(cls.text_digest(t) for t in texts) % (1 << 64)
+
+    @abc.abstractmethod
+    def embed_documents(self, texts):
+        """Matriz float32 (n, dim) para `texts`."""
+
+    @abc.abstractmethod
+    def embed_query(self, text):
+        """Vector float32 (dim,) de una consulta."""
+
+    def update(self, added=(), removed=()):
+        """Ajuste incremental con los textos que entran al corpus y los que salen."""
+        self.n_docs += len(added) - len(removed)
+        self.digest = (self.digest + sum(map(self.text_digest, added)) - sum(map(self.text_digest, removed))) % (1 << 64)
+
+    def reset(self):
+        self.n_docs, self.digest = 0, 0
+
+    def fit(self, texts):
+        self.reset()
+        self.update(added=list(texts))
+
+    def save(self, path):
+        pass
+
+    def load(self, path, digest):
+        """Restaura el estado guardado si corresponde al corpus `digest`. True si lo cargó."""
+        return False
+
+
+class LocalEmbeddingBackend(EmbeddingBackend):
+    """
+    (4.0g) Embeddings locales con scikit-learn: n-gramas de caracteres (tolera plurales, tildes y
+    erratas) con `HashingVectorizer` (sin vocabulario que ajustar), tf sublineal normalizado y
+    proyección aleatoria dispersa (`SparseRandomProjection`, semilla fija) a `dim` dimensiones.
+    La IDF se ajusta de forma incremental (frecuencia documental por columna hasheada) y se aplica
+    solo a la consulta: el producto consulta·documento sigue ponderado por IDF, pero los vectores de
+    documentos no cambian al crecer el corpus y el almacén en disco los reutiliza. Embeber una
+    consulta cuesta una fracción de milisegundo y no necesita red.
+    """
+
+    def __init__(self, dim=None, n_features=None, seed=0):
+        super().__init__()
+        self.dim = dim or local_embed_dim
+        self.n_features = n_features or local_embed_features
+        self.model = f"local-hashing-v1-{self.n_features}-{self.dim}-s{seed}"
+        # (7c) diferidos: scikit-learn / scipy solo se cargan con el backend local
+        from scipy import sparse
+        from sklearn.feature_extraction.text import HashingVectorizer
+        from sklearn.random_projection import SparseRandomProjection
+        self.vectorizer = HashingVectorizer(n_features=self.n_features, analyzer="char_wb", ngram_range=(3, 5),
+                                            strip_accents="unicode", lowercase=True, alternate_sign=False,
+                                            norm=None, dtype=np.float32)
+        projection = SparseRandomProjection(n_components=self.dim, random_state=seed)
+        projection.fit(sparse.csr_matrix((1, self.n_features), dtype=np.float32))  # solo usa la forma
+        self._projection = projection.components_.T.tocsr().astype(np.float32)  # (n_features, dim)
+        self.df = np.zeros(self.n_features, dtype=np.int64)
+        self.idf = np.ones(self.n_features, dtype=np.float32)
+
+    def _counts(self, texts):
+        counts = self.vectorizer.transform(texts)
+        np.log(counts.data, out=counts.data)
+        counts.data += 1.0  # tf sublineal
+        return counts
+
+    def embed_documents(self, texts):
+        from sklearn.preprocessing import normalize
+        counts = normalize(self._counts(texts))
+        return (counts @ self._projection).toarray()
+
+    def embed_query(self, text):
+        counts = self._counts([text])
+        counts.data *= self.idf[counts.indices]
+        return (counts @ self._projection).toarray()[0]
+
+    def update(self, added=(), removed=()):
+        """Llamar con el lock de escritura de la base de conocimiento tomado (un solo escritor)."""
+        for texts, sign in ((added, 1), (removed, -1)):
+            if len(texts):
+                self.df += sign * np.bincount(self.vectorizer.transform(texts).indices, minlength=self.n_features)
+        super().update(added, removed)
+        self._refresh_idf()
+
+    def reset(self):
+        super().reset()
+        self.df = np.zeros(self.n_features, dtype=np.int64)
+        self._refresh_idf()
+
+    def _refresh_idf(self):
+        # IDF suavizada (como TfidfVectorizer); se publica con una asignación para las consultas en curso
+        self.idf = (np.log((1.0 + self.n_docs) / (1.0 + np.maximum(self.df, 0))) + 1.0).astype(np.float32)
+
+    def save(self, path):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as fh:
+            np.savez_compressed(fh, df=self.df, n_docs=np.array(self.n_docs), digest=np.array(str(self.digest)),
+                                model=np.array(self.model))
+        os.replace(tmp_path, path)
+
+    def load(self, path, digest):
+        if not os.path.exists(path):
+            return False
+        with np.load(path) as data:
+            if str(data["model"]) != self.model or int(str(data["digest"])) != digest:
+                return False
+            self.df, self.n_docs, self.digest = data["df"].astype(np.int64), int(data["n_docs"]), digest
+        self._refresh_idf()
+        return True
+
+
+EMBEDDING_BACKENDS = {"local": LocalEmbeddingBackend}  # "remote" (por defecto): proveedor OpenAI / GitHub inference
+
+
+ # ==============================================================
+ # 4.0h CONSTRUCCIÓN DEL CONTEXTO (presupuesto de tokens, corte por puntaje, deduplicación, recorte)
+ # ==============================================================
+class ContextBuilder:
+    """
+    (4.0h) Arma el contexto del prompt a partir de los resultados de la búsqueda (ya ordenados):
+    descarta fuentes bajo el corte de puntaje (absoluto y relativo al mejor resultado; el primero
+    siempre entra), quita oraciones casi duplicadas entre fuentes (Jaccard de términos), de los
+    documentos largos conserva solo las oraciones con términos de la consulta y corta en el
+    presupuesto de tokens (por oraciones). Los tokens se estiman localmente, sin tokenizer.
+    """
+    STOPWORDS = frozenset("que cual cuales como donde cuando cuanto para por los las del con una uno unos unas hay "
+                          "esta este esto son sus mas sin sobre entre desde hasta tiene puedo debo quiero".split())
+    _sentence_re = re.compile(r"(?<=[.!?;])\s+|\n+")
+    _token_re = re.compile(r"\w+|[^\w\s]")
+
+    def __init__(self, max_tokens=None, min_score=None, relative_score=None, duplicate_threshold=None,
+                 long_doc_tokens=None):
+        self.max_tokens = context_max_tokens if max_tokens is None else max_tokens
+        self.min_score = context_min_score if min_score is None else min_score
+        self.relative_score = context_relative_score if relative_score is None else relative_score
+        self.duplicate_threshold = context_dedup_threshold if duplicate_threshold is None else duplicate_threshold
+        self.long_doc_tokens = context_long_doc_tokens if long_doc_tokens is None else long_doc_tokens
+
+    @classmethod
+    def count_tokens(cls, text):
+        """Estimación local: una pieza por signo y ~4 caracteres por pieza de palabra (cifras y horas incluidas)."""
+        return sum(1 if len(p) <= 4 else (len(p) + 3) // 4 for p in cls._token_re.findall(text))
+
+    @classmethod
+    def terms(cls, text):
+        """Términos comparables: sin tildes ni mayúsculas, sin palabras vacías, prefijo de 6 letras (plurales)."""
+        words = QueryEmbeddingCache.normalize(text).split()
+        terms = (w.strip(LexicalIndex.STRIP_CHARS + "¿") for w in words)
+        return {t[:6] for t in terms if len(t) > 2 and t not in cls.STOPWORDS}
+
+    def split_sentences(self, text):
+        return [s.strip() for s in self._sentence_re.split(text) if s and s.strip()]
+
+    def build(self, query, results):
+        """
+        Devuelve (texto del contexto, resultados usados, estadísticas). Cada resultado usado lleva
+        `context_tokens` (tokens que aportó al prompt).
+        """
+        stats = {'candidates': len(results), 'dropped_low_score': 0, 'dropped_duplicates': 0,
+                 'dropped_irrelevant': 0, 'dropped_budget': 0, 'tokens_in': 0, 'tokens': 0}
+        if not results:
+            return "", [], stats
+        best = max(r.get('combined_score', 0.0) for r in results)
+        cutoff = max(self.min_score, best * self.relative_score) if best > 0 else self.min_score
+        query_terms = self.terms(query)
+        seen = []  # conjuntos de términos de las oraciones ya incluidas
+        budget = self.max_tokens
+        blocks, used = [], []
+        for rank, r in enumerate(results):
+            sentences = self.split_sentences(r['document'])
+            doc_tokens = [self.count_tokens(s) for s in sentences]
+            stats['tokens_in'] += sum(doc_tokens)
+            if rank and r.get('combined_score', 0.0) < cutoff:
+                stats['dropped_low_score'] += 1
+                continue
+            sentence_terms = [self.terms(s) for s in sentences]
+            order = range(len(sentences))
+            if sum(doc_tokens) > self.long_doc_tokens and query_terms:
+                # Documento largo: oraciones con términos de la consulta (la primera siempre: suele dar el tema)
+                order = [0] + [i for i in range(1, len(sentences)) if sentence_terms[i] & query_terms]
+                stats['dropped_irrelevant'] += len(sentences) - len(order)
+            header = f"Fuente {r['id'] + 1}: "
+            kept, cost = [], self.count_tokens(header)
+            for i in order:
+                terms = sentence_terms[i]
+                if terms and any(len(terms & prev) >= self.duplicate_threshold * len(terms | prev) for prev in seen):
+                    stats['dropped_duplicates'] += 1
+                    continue
+                if cost + doc_tokens[i] > budget:
+                    stats['dropped_budget'] += 1
+                    continue  # una oración más corta posterior todavía puede caber
+                kept.append(sentences[i])
+                seen.append(terms)
+                cost += doc_tokens[i]
+            if not kept:
+                continue
+            budget -= cost
+            blocks.append(header + " ".join(kept))
+            used.append(dict(r, context_tokens=cost))
+        stats['tokens'] = self.max_tokens - budget
+        return "\n\n".join(blocks), used, stats
+
+
 # =================================================================
 # Clase refactorizada con Trazabilidad y Seguridad (IL3.1, IL3.2, IL3.3)
 # =================================================================
 class ChatbotMedicoRAG:
     """(4) Clase principal del Agente con capacidades RAG y métricas."""
+    # (4.0d / 4.5) Construidos una sola vez al cargar la clase
+    keyword_matcher = KeywordMatcher.from_config(keywords_file)
+    _injection_re = re.compile(r"(\bignora\s+las\s+instrucciones\b|\bactua\s+como\b|\bdesactiva\s+el\s+filtro\b)", re.IGNORECASE)
+    _unsafe_chars_re = re.compile(r'[<>{}\[\]\&|;`\$]')
+
     # -----------------------------
     # 4.1 Inicialización y Cliente
     # -----------------------------
-    def __init__(self):
+    def __init__(self, knowledge_base=None, interaction_log=None, answer_cache=None, tracer=None, evaluator=None,
+                 message_store=None, conversation_id=None):
+        """
+        (4.0f) Estado por sesión ligero: cliente, ajustes de búsqueda y contadores. El corpus indexado
+        (`knowledge_base`), el log de interacciones, el historial del chat, la caché de respuestas, el
+        tracer (4.9b) y el evaluador en segundo plano (4.9c) pueden compartirse entre sesiones (ver
+        `main`); si no se indican, la instancia crea los suyos (el tracer propio no exporta a archivo).
+        """
         self.client = None
+        self.async_client = None     # (4.6b) AsyncOpenAI (modo SDK)
+        self.pending_evaluation = None  # (4.6b) Último registro en segundo plano (Future)
+        self.query_embedding_error = None  # (4.6b) Último error del embedding de consulta (se muestra en el hilo de Streamlit)
+        self.kb = knowledge_base if knowledge_base is not None else KnowledgeBase()  # (4.0f) Corpus e índices
+        if answer_cache is None and answer_cache_enabled:
+            answer_cache = SemanticAnswerCache(answer_cache_size, answer_cache_threshold, answer_cache_ttl)
+        self.answer_cache = answer_cache
         self.llm_model = "gpt-4o-mini"
-        self.embeddings_model = "text-embedding-3-small"
-        self.documents = []
-        self.embeddings = None
-        self.embedding_matrix = None
-        self.interaction_logs = []
+        self.embedding_backend = self.kb.embedding_backend(embeddings_backend)  # (4.0g) None = proveedor remoto
+        self.embeddings_model = self.embedding_backend.model if self.embedding_backend else "text-embedding-3-small"
+        self.ann_mode = ann_mode
+        self.ann_nprobe = ann_nprobe
+        self.lexical_scorer = lexical_scorer
+        self.context_builder = ContextBuilder()  # (4.0h) Presupuesto de tokens y recorte del contexto
+        self.http_transport = None   # (4.0b) Sesión HTTP con pool (modo GitHub inference)
         self.error_count = 0  # IL3.1: Métrica de frecuencia de errores
-        # Persistencia de logs de interacción
-        try:
-            os.makedirs("data", exist_ok=True)
-        except Exception:
-            pass
-        self.logs_path = os.path.join("data", "logs.json")
-        # Cargar logs existentes si están presentes
-        try:
-            self._load_logs()
-        except Exception:
-            # No fallar la inicialización si la carga falla
-            pass
+        # (4.9) Persistencia de logs de interacción (escritor, ventana reciente, archivo y agregados)
+        self.interaction_log = interaction_log if interaction_log is not None else InteractionLog()
+        self.message_store = message_store if message_store is not None else ChatMessageStore()  # (4.9) Historial del chat
+        self.conversation_id = conversation_id or ChatMessageStore.new_conversation_id()  # (4.9) Conversación de la sesión
+        self.tracer = tracer if tracer is not None else Tracer()  # (4.9b) Tramos e histogramas por etapa
+        self.evaluator = evaluator if evaluator is not None else EvaluationWorker()  # (4.9c) Calidad por lotes
+
+    # (4.0f) Vistas de solo lectura de la instantánea vigente. Para varias lecturas coherentes entre sí
+    # (p. ej. matriz + textos) se toma `self.kb.snapshot` una vez.
+    @property
+    def documents(self):
+        return self.kb.snapshot.documents
+
+    @property
+    def doc_ids(self):
+        return self.kb.snapshot.doc_ids  # (4.8) Id estable por documento (paralelo a `documents`)
+
+    @property
+    def doc_meta(self):
+        return self.kb.snapshot.doc_meta  # (4.0e) doc_id -> {source, record, offset, chunk}
+
+    @property
+    def lexical_index(self):
+        return self.kb.snapshot.lexical_index
+
+    @property
+    def ann_index(self):
+        return self.kb.snapshot.ann_index
+
+    @property
+    def embedding_matrix(self):
+        return self.kb.snapshot.embedding_matrix
+
+    @property
+    def embeddings(self):
+        return self.kb.snapshot.embedding_matrix  # alias (sin copia) para compatibilidad
+
+    @property
+    def corpus_version(self):
+        return self.kb.snapshot.version  # (4.0c) cambia con cada instantánea publicada
+
+    @property
+    def interaction_logs(self):
+        return self.interaction_log.entries
+
+    @property
+    def rollup(self):
+        return self.interaction_log.rollup
+
+    @property
+    def log_archive(self):
+        return self.interaction_log.archive
+
+    @property
+    def logs_path(self):
+        return self.interaction_log.path
 
     def initialize_client(self):
         """Inicializa el cliente OpenAI o habilita modo GitHub inference."""
         try:
             if openai_api_key:
-                # Modo OpenAI / Azure (usa SDK)
+                # Modo OpenAI / Azure (usa SDK; (7c) importado al inicializar el cliente)
+                from openai import OpenAI, AsyncOpenAI
                 self.client = OpenAI(api_key=openai_api_key, base_url=openai_base_url)
+                self.async_client = AsyncOpenAI(api_key=openai_api_key, base_url=openai_base_url)  # (4.6b) Pipeline asíncrono
                 self.github_mode = False
                 logger.info("system_init", status="success", message="Cliente OpenAI/Azure inicializado")
                 return True
             elif github_token and github_inference_url:
                 # Modo GitHub inference: usaremos HTTP requests directos
                 self.client = None
+                self.async_client = None
                 self.github_mode = True
                 self.github_token = github_token
                 self.github_inference_url = github_inference_url.rstrip("/")
@@ -161,520 +1541,2835 @@ class ChatbotMedicoRAG:
                 st.error("Falta OPENAI_API_KEY o GITHUB_TOKEN en .env")
                 return False
         except Exception as e:
-            logger.error("system_init", status="error", message=f"Error al inicializar cliente: {e}")
-            st.error(f"Error inicializando cliente: {e}")
-            return False
+            logger.error("system_init", status="error", message=f"Error al inicializar cliente: {e}")
+            st.error(f"Error inicializando cliente: {e}")
+            return False
+
+    # -----------------------------
+    # 4.2 Documentos Base (Hospital)
+    # -----------------------------
+    def initialize_hospital_documents(self) -> bool:
+        """Carga documentos por defecto (fuente interna)."""
+        try:
+            docs = [
+                "El Hospital Barros Luco ubicado en Santiago de Chile cuenta con los siguientes servicios: Emergencias 24/7, Cuidados Intensivos (UCI), Cardiología, Neurología, Pediatría, Ginecología y Obstetricia, Oncología, Ortopedia y Traumatología, Radiología e Imágenes, Laboratorio Clínico, Farmacia, y Rehabilitación Física.",
+                "Horarios de atención: Emergencias 24 horas. Consultas externas: Lunes a Viernes 7:00 AM - 6:00 PM, Sábados 8:00 AM - 2:00 PM. Teléfono principal: (01) 234-5678. Emergencias: 911. Dirección: Av. Salud 123, Lima, Perú.",
+                "Protocolo de emergencias: En caso de emergencia médica, dirigirse inmediatamente al área de Emergencias en el primer piso. El personal de triaje evaluará la urgencia. Código Azul: Paro cardiorrespiratorio. Código Rojo: Emergencia médica. Código Amarillo: Emergencia quirúrgica.",
+                "Proceso de hospitalización: 1) Admisión con documento de identidad y seguro médico. 2) Evaluación médica inicial. 3) Asignación de habitación según disponibilidad. 4) Entrega de brazalete de identificación. 5) Orientación sobre normas hospitalarias. Horarios de visita: 2:00 PM - 4:00 PM y 6:00 PM - 8:00 PM.",
+                "El uso de IA en radiología ayuda a detectar anomalías en imágenes médicas con mayor precisión. Nuestro Hospital Barros Luco utiliza sistemas de inteligencia artificial para análisis de radiografías, tomografías y resonancias magnéticas, lo que permite diagnósticos más rápidos y exactos.",
+                "La telemedicina permite realizar consultas médicas a distancia, mejorando el acceso en zonas rurales. El Hospital Barros Luco ofrece servicios de teleconsulta para seguimiento de pacientes crónicos, consultas de especialidades y orientación médica inicial.",
+            ]
+            with self.kb.lock:
+                self.kb.matrix_buffer = None
+                self.kb.publish(self.kb.snapshot.replace(
+                    documents=docs, doc_ids=[f"hbl-{i}" for i in range(len(docs))], doc_meta={},
+                    embedding_matrix=None, lexical_index=LexicalIndex(), ann_index=None))
+            logger.info("data_load", status="success", doc_count=len(docs), message="Documentos del hospital cargados")
+            return True
+        except Exception as e:
+            logger.error("data_load", status="error", message=f"Error inicializando documentos: {e}")
+            st.warning(f"⚠ Error inicializando documentos: {e}")
+            return False
+
+    def ensure_knowledge_base(self):
+        """
+        (4.0f) Carga los documentos base y externos y los embebe una sola vez por proceso: las sesiones
+        siguientes reutilizan la base de conocimiento compartida. Si el embedding falla, la próxima
+        sesión lo reintenta. Devuelve True si hay embeddings.
+        """
+        with self.kb.lock:
+            if not self.kb.ready:
+                self.initialize_hospital_documents()
+                self.load_external_documents()
+                self.kb.ready = self.get_embeddings(self.documents) is not None
+        return self.embedding_matrix is not None
+
+    # -----------------------------
+    # 4.3 Embeddings y Recuperación
+    # -----------------------------
+    def _get_http_transport(self):
+        """(4.0b) Transporte HTTP compartido (pool keep-alive + reintentos) para GitHub inference."""
+        base_url = self.github_inference_url.rstrip('/')
+        if self.http_transport is None or self.http_transport.base_url != base_url or self.http_transport.token != self.github_token:
+            if self.http_transport is not None:
+                self.http_transport.close()
+            self.http_transport = HTTPTransport(base_url, self.github_token)
+        return self.http_transport
+
+    def _github_post(self, path, payload):
+        """POST genérico a GitHub inference (modo alternativo)."""
+        return self._get_http_transport().post(path, payload).json()
+
+    def _github_stream(self, path, payload):
+        """(4.4) POST en streaming a GitHub inference: produce cada evento SSE (`data: {...}`) decodificado."""
+        with self._get_http_transport().post(path, payload, stream=True, accept="text/event-stream") as resp:
+            resp.encoding = resp.encoding or "utf-8"
+            for line in resp.iter_lines(chunk_size=None, decode_unicode=True):  # cada chunk HTTP al llegar (SSE usa chunked)
+                if not line or not line.startswith("data:"):
+                    continue  # comentarios SSE (": keep-alive"), líneas vacías entre eventos, etc.
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                try:
+                    yield json.loads(data)
+                except json.JSONDecodeError:
+                    logger.warning("llm_stream", status="bad_event", data=data[:80])
+
+    def _request_embeddings(self, documents):
+        """Llamada directa al proveedor (OpenAI SDK o GitHub inference) o al backend local, sin caché."""
+        if self.embedding_backend is not None:
+            return self.embedding_backend.embed_documents(documents)
+        if getattr(self, "github_mode", False):
+            payload = {"model": self.embeddings_model, "input": documents}
+            resp = self._github_post("embeddings", payload)
+            # Adaptación según formato: intentar claves comunes
+            return [item.get("embedding") or item.get("vector") for item in resp.get("data", [])]
+        if not self.client:
+            return None
+        resp = self.client.embeddings.create(model=self.embeddings_model, input=documents)
+        return [d.embedding for d in resp.data]
+
+    def _get_embedding_store(self):
+        """(4.0) Almacén en disco del modelo de embeddings activo (compartido vía la base de conocimiento)."""
+        return self.kb.embedding_store(self.embeddings_model)
+
+    @staticmethod
+    def _estimate_tokens(text):
+        """Estimación barata de tokens (~4 caracteres por token) para armar lotes."""
+        return max(1, len(text) // 4)
+
+    @classmethod
+    def _token_batches(cls, texts, max_tokens=None, max_items=None):
+        """Índices de `texts` agrupados en lotes que respetan el presupuesto de tokens y de elementos."""
+        max_tokens, max_items = max_tokens or embed_batch_tokens, max_items or embed_batch_size
+        batches, current, budget = [], [], 0
+        for i, text in enumerate(texts):
+            tokens = cls._estimate_tokens(text)
+            if current and (budget + tokens > max_tokens or len(current) >= max_items):
+                batches.append(current)
+                current, budget = [], 0
+            current.append(i)
+            budget += tokens
+        if current:
+            batches.append(current)
+        return batches
+
+    @staticmethod
+    def _error_status(error):
+        """Código HTTP de un error del SDK (`status_code`) o de requests (`response.status_code`)."""
+        return getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+
+    def _transport_retried(self, error, status):
+        """True si `HTTPTransport.post` ya reintentó este error (modo GitHub: 429/5xx o conexión)."""
+        if self.embedding_backend is not None or not getattr(self, "github_mode", False):
+            return False
+        import requests  # ya cargado por el transporte en modo GitHub
+        return status in HTTPTransport.RETRY_STATUS or isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+    async def _aembed_batch(self, texts, idx, vectors, state):
+        """
+        Un lote con reintentos (backoff con jitter). Si el proveedor rechaza el lote (400/413/422)
+        se divide en mitades para aislar los textos problemáticos; lo que falle queda en None.
+        En modo GitHub no se reintenta lo que el transporte HTTP ya reintentó (429/5xx, conexión).
+        """
+        batch = [texts[i] for i in idx]
+        error, status = None, None
+        for attempt in range(embed_batch_retries + 1):
+            try:
+                fresh = await asyncio.to_thread(self._request_embeddings, batch)
+                if fresh is None or len(fresh) != len(batch) or any(v is None for v in fresh):
+                    raise ValueError("Respuesta de embeddings incompleta")
+                for i, vec in zip(idx, fresh):
+                    vectors[i] = np.asarray(vec, dtype=np.float32)
+                state['done'] += len(idx)
+                return
+            except Exception as e:
+                error, status = e, self._error_status(e)
+                if status in (400, 413, 422):
+                    break  # el mismo lote volvería a fallar
+                if self._transport_retried(e, status):
+                    break  # reintentos agotados en la capa HTTP; no multiplicarlos aquí
+                if attempt < embed_batch_retries:
+                    delay = random.uniform(0.0, min(http_backoff_max, http_backoff_base * (2 ** attempt)))
+                    logger.warning("embedding_batch", status="retry", size=len(idx), attempt=attempt + 1, error=str(e))
+                    await asyncio.sleep(delay)
+        if status in (400, 413, 422) and len(idx) > 1:
+            half = len(idx) // 2
+            await self._aembed_batch(texts, idx[:half], vectors, state)
+            await self._aembed_batch(texts, idx[half:], vectors, state)
+            return
+        state['done'] += len(idx)
+        state['failed'] += len(idx)
+        logger.error("embedding_batch", status="failed", size=len(idx), http_status=status, error=str(error))
+
+    async def _aembed_batches(self, texts, batches, vectors, state):
+        """Lotes con paralelismo acotado (`ATLAS_EMBED_CONCURRENCY`) en el bucle asyncio de fondo."""
+        semaphore = asyncio.Semaphore(max(1, embed_concurrency))
+
+        async def run(idx):
+            async with semaphore:
+                await self._aembed_batch(texts, idx, vectors, state)
+
+        await asyncio.gather(*(run(idx) for idx in batches))
+
+    def _request_embeddings_batched(self, texts, progress=None):
+        """
+        (4.3) Embeddings de `texts` en lotes acotados por tokens, en paralelo y con reintentos por lote.
+        Devuelve una lista alineada con `texts` (None donde el lote falló) o None sin proveedor.
+        `progress(hechos, total)` se invoca desde el hilo que llama (apto para widgets de Streamlit).
+        """
+        if self.embedding_backend is not None:
+            # (4.0g) Local: sin red ni reintentos; por lotes solo para acotar la memoria
+            vectors = []
+            for start in range(0, len(texts), embed_batch_size):
+                vectors.extend(self.embedding_backend.embed_documents(texts[start:start + embed_batch_size]))
+                if progress:
+                    progress(len(vectors), len(texts))
+            return vectors
+        if not getattr(self, "github_mode", False) and not self.client:
+            return None
+        batches = self._token_batches(texts)
+        vectors = [None] * len(texts)
+        state = {'done': 0, 'failed': 0}
+        future = asyncio.run_coroutine_threadsafe(self._aembed_batches(texts, batches, vectors, state), _get_async_loop())
+        while True:
+            try:
+                future.result(timeout=0.2)
+                break
+            except concurrent.futures.TimeoutError:
+                if progress:
+                    progress(state['done'], len(texts))
+        if progress:
+            progress(len(texts), len(texts))
+        logger.info("embedding_batches", batches=len(batches), texts=len(texts), failed=state['failed'])
+        return vectors
+
+    def _embed_texts(self, documents, force_refresh=False, allow_partial=False, progress=None):
+        """
+        Matriz float32 (n, dim) para `documents`: usa el almacén en disco (4.0) y solo
+        envía al proveedor (por lotes) los textos cuyo hash no está guardado. Los lotes exitosos
+        se guardan aunque otros fallen. Sin `allow_partial`: None si falta algún vector; con
+        `allow_partial`: (matriz de los textos embebidos, índices de esos textos).
+        """
+        start_time = time.time()
+        keys = [EmbeddingStore.content_key(self.embeddings_model, doc) for doc in documents]
+        store, cached = None, {}
+        try:
+            store = self._get_embedding_store()
+            if not force_refresh:
+                cached = store.lookup(keys)
+        except Exception as e:
+            logger.warning("embedding_store", status="unavailable", error=str(e))
+        # Textos únicos sin vector en caché (orden de aparición)
+        missing = {k: doc for k, doc in zip(keys, documents) if k not in cached}
+        failed = 0
+        if missing:
+            fresh = self._request_embeddings_batched(list(missing.values()), progress=progress)
+            if fresh is None:
+                return None
+            ok = {k: v for k, v in zip(missing.keys(), fresh) if v is not None}
+            failed = len(missing) - len(ok)
+            cached.update(ok)
+            if store is not None and ok:
+                try:
+                    store.add(list(ok.keys()), np.stack(list(ok.values())), overwrite=force_refresh)
+                except Exception as e:
+                    logger.warning("embedding_store", status="write_error", error=str(e))
+            if failed and not allow_partial:
+                logger.error("tool_call", tool="embedding_generation", status="partial_failure", failed_docs=failed,
+                             stored_docs=len(ok))
+                return None
+        rows = [i for i, k in enumerate(keys) if k in cached]
+        matrix = np.stack([cached[keys[i]] for i in rows]) if rows else np.zeros((0, 0), dtype=np.float32)
+        duration = time.time() - start_time
+        logger.info("tool_call", tool="embedding_generation", status="success", duration_sec=duration,
+                    doc_count=len(documents), cache_hits=len(documents) - len(missing), provider_docs=len(missing),
+                    failed_docs=failed)
+        return (matrix, rows) if allow_partial else matrix
+
+    def get_embeddings(self, documents, force_refresh=False, progress=None):
+        """
+        Reconstrucción completa: embeddings (caché en disco + proveedor según modo) e índice léxico
+        de `documents` (el corpus vigente, con sus ids). `force_refresh=True` vuelve a pedir todos los
+        vectores al proveedor. Si algún lote falla el índice no cambia, pero los lotes exitosos quedan
+        en el almacén y no se vuelven a pedir.
+        """
+        try:
+            with self.kb.lock:
+                snap = self.kb.snapshot
+                doc_ids = snap.doc_ids if len(snap.doc_ids) == len(documents) else [f"doc-{i}" for i in range(len(documents))]
+                return self._reindex(list(documents), list(doc_ids), snap.doc_meta, force_refresh=force_refresh,
+                                     progress=progress)
+        except Exception as e:
+            self.error_count += 1
+            logger.error("tool_call", tool="embedding_generation", status="error", error=str(e), doc_count=len(documents))
+            st.warning(f"⚠ Error generando embeddings: {e}")
+            return None
+
+    def _fetch_query_embedding(self, query):
+        """Llamada al proveedor para una query (sin caché). None si falla."""
+        try:
+            if self.embedding_backend is not None:
+                return self.embedding_backend.embed_query(query)
+            with trace_span("provider.embeddings", mode="github" if getattr(self, "github_mode", False) else "sdk",
+                            model=self.embeddings_model, inputs=1, chars=len(query)):
+                if getattr(self, "github_mode", False):
+                    payload = {"model": self.embeddings_model, "input": [query]}
+                    resp = self._github_post("embeddings", payload)
+                    emb = (resp.get("data") or [{}])[0].get("embedding") or (resp.get("data") or [{}])[0].get("vector")
+                else:
+                    if not self.client:
+                        return None
+                    resp = self.client.embeddings.create(model=self.embeddings_model, input=[query])
+                    emb = resp.data[0].embedding
+            return np.array(emb, dtype=np.float32)
+        except Exception as e:
+            self.error_count += 1
+            logger.error("tool_call", tool="query_embedding", status="error", error=str(e))
+            self.query_embedding_error = e  # puede correr en un hilo sin ScriptRunContext: `main` lo muestra
+            return None
+
+    def get_query_embedding(self, query):
+        """Embedding de la query; la caché exacta del proceso (4.0c) evita repetir la llamada al proveedor."""
+        if self.embedding_backend is not None:
+            return self._fetch_query_embedding(query)  # (4.0g) local: más barato que la caché y con la IDF vigente
+        cache = get_query_embedding_cache()
+        emb = cache.get(self.embeddings_model, query)
+        if emb is None:
+            emb = self._fetch_query_embedding(query)
+            if emb is not None:
+                cache.put(self.embeddings_model, query, emb)
+        return emb
+
+    async def aget_query_embedding(self, query):
+        """(4.6b) Embedding de la query con el cliente asíncrono (SDK) o en un hilo (GitHub inference)."""
+        with trace_span("embed", model=self.embeddings_model) as span:
+            if self.embedding_backend is not None:
+                span.set(backend="local")
+                return self._fetch_query_embedding(query)  # (4.0g) local: sub-milisegundo, sin salir del bucle
+            cache = get_query_embedding_cache()
+            emb = cache.get(self.embeddings_model, query)
+            span.set(cache_hit=emb is not None)
+            if emb is not None:
+                return emb
+            if getattr(self, "github_mode", False) or self.async_client is None:
+                emb = await asyncio.to_thread(self._fetch_query_embedding, query)
+            else:
+                try:
+                    with trace_span("provider.embeddings", mode="sdk_async", model=self.embeddings_model, inputs=1,
+                                    chars=len(query)):
+                        resp = await self.async_client.embeddings.create(model=self.embeddings_model, input=[query])
+                    emb = np.array(resp.data[0].embedding, dtype=np.float32)
+                except Exception as e:
+                    self.error_count += 1
+                    logger.error("tool_call", tool="query_embedding", status="error", error=str(e))
+                    self.query_embedding_error = e
+                    return None
+            if emb is not None:
+                cache.put(self.embeddings_model, query, emb)
+            return emb
+
+    @staticmethod
+    def _normalize_rows(matrix):
+        """Copia float32 con filas de norma L2 unitaria (filas nulas quedan en cero)."""
+        matrix = np.array(matrix, dtype=np.float32, ndmin=2)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix /= np.maximum(norms, 1e-12)
+        return matrix
+
+    @staticmethod
+    def _build_lexical_index(documents, doc_ids):
+        """Índice léxico invertido nuevo para `documents` / `doc_ids`."""
+        index = LexicalIndex()
+        for doc_id, doc in zip(doc_ids, documents):
+            index.add(doc_id, doc)
+        return index
+
+    def _reindex(self, documents, doc_ids, doc_meta, force_refresh=False, progress=None):
+        """
+        (4.0f) Embebe e indexa desde cero el corpus `documents` / `doc_ids` y publica la instantánea
+        resultante. Llamar con `self.kb.lock` tomado. Devuelve la matriz o None si falló el embedding.
+        """
+        matrix = self._embed_texts(documents, force_refresh=force_refresh, progress=progress)
+        if matrix is None:
+            return None
+        # (4.3) Matriz float32 con filas L2-normalizadas: la consulta es un único producto matriz-vector
+        candidate = self.kb.snapshot.replace(
+            documents=documents, doc_ids=doc_ids, doc_meta=doc_meta, embedding_matrix=self._normalize_rows(matrix),
+            lexical_index=self._build_lexical_index(documents, doc_ids), ann_index=None)
+        candidate.ann_index = self._refresh_ann_index(candidate, allow_load=not force_refresh)
+        self._sync_embedding_backend(candidate)
+        self.kb.matrix_buffer = None
+        return self.kb.publish(candidate).embedding_matrix
+
+    def _corpus_fingerprint(self, snap):
+        """Hash del corpus indexado de `snap` (modelo, ids y textos en orden de fila)."""
+        digest = hashlib.sha256(self.embeddings_model.encode("utf-8"))
+        for doc_id, doc in zip(snap.doc_ids, snap.documents):
+            digest.update(f"{doc_id}\x00{doc}\x01".encode("utf-8"))
+        return digest.hexdigest()
+
+    def _sync_embedding_backend(self, snap, added=None, removed=()):
+        """
+        (4.0g) Ajusta el backend local al corpus de `snap` (llamar con `self.kb.lock` tomado): con
+        `added` / `removed`, de forma incremental; sin ellos (reconstrucción), carga el estado guardado
+        si corresponde al mismo corpus o lo ajusta desde cero. Luego lo persiste junto a los embeddings.
+        """
+        backend = self.embedding_backend
+        if backend is None:
+            return
+        try:
+            path = self._get_embedding_store().sidecar_path(".idf.npz")
+            if added is None:
+                digest = backend.corpus_digest(snap.documents)
+                if backend.digest == digest and backend.n_docs == len(snap.documents):
+                    return
+                if backend.load(path, digest):
+                    logger.info("embedding_backend", action="loaded", path=path, documents=backend.n_docs)
+                    return
+                start = time.time()
+                backend.fit(snap.documents)
+                logger.info("embedding_backend", action="fitted", documents=backend.n_docs, duration_sec=time.time() - start)
+            else:
+                backend.update(added=added, removed=removed)
+            backend.save(path)
+        except Exception as e:
+            logger.warning("embedding_backend", status="error", error=str(e))
+
+    def _refresh_ann_index(self, snap, allow_load=True):
+        """
+        (4.0) Índice ANN para la instantánea `snap` aún sin publicar (`snap.ann_index` es el anterior,
+        ya actualizado con los cambios): lo carga de disco o lo entrena cuando el corpus supera el
+        umbral, lo re-entrena si creció mucho, y lo persiste junto a los embeddings. None si no aplica.
+        """
+        try:
+            n = len(snap.documents)
+            wanted = snap.embedding_matrix is not None and n > 0 and (
+                self.ann_mode == "on" or (self.ann_mode == "auto" and n >= ann_min_docs))
+            if not wanted:
+                return None
+            path = self._get_embedding_store().sidecar_path(".ivf.npz")
+            fingerprint = self._corpus_fingerprint(snap)
+            index = snap.ann_index
+            if index is None and allow_load:
+                index = IVFIndex.load(path, fingerprint)
+                if index is not None and len(index) == n:
+                    logger.info("ann_index", action="loaded", path=path, nlist=index.nlist, size=len(index))
+                    return index
+            if index is None or index.needs_retrain() or len(index) != n:
+                start = time.time()
+                index = IVFIndex.train(snap.embedding_matrix, nlist=ann_nlist or None)
+                logger.info("ann_index", action="trained", nlist=index.nlist, size=len(index),
+                            duration_sec=time.time() - start)
+            index.save(path, fingerprint)
+            return index
+        except Exception as e:
+            logger.warning("ann_index", status="error", error=str(e))
+            return None
+
+    def ann_recall_report(self, k=10, nprobes=(1, 2, 4, 8, 16, 32), n_queries=100, seed=0):
+        """
+        (4.0) Recall@k y latencia del índice ANN frente a la búsqueda exacta (componente semántica).
+        Las consultas son documentos del corpus con ruido gaussiano. Devuelve una fila por `nprobe`.
+        """
+        snap = self.kb.snapshot
+        matrix = snap.embedding_matrix
+        if matrix is None or len(matrix) == 0:
+            return []
+        index = snap.ann_index or IVFIndex.train(matrix, nlist=ann_nlist or None)
+        rng = np.random.default_rng(seed)
+        n, dim = matrix.shape
+        k = min(k, n)
+        picks = rng.choice(n, min(n_queries, n), replace=False)
+        queries = self._normalize_rows(matrix[picks] + rng.normal(scale=0.5 / math.sqrt(dim), size=(len(picks), dim)))
+
+        def top_rows(scores, rows=None):
+            kk = min(k, len(scores))
+            best = np.argpartition(-scores, kk - 1)[:kk] if kk < len(scores) else np.arange(len(scores))
+            return set((best if rows is None else rows[best]).tolist())
+
+        exact, start = [], time.perf_counter()
+        for q in queries:
+            exact.append(top_rows(matrix @ q))
+        exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        report = []
+        for nprobe in nprobes:
+            recalls, scanned, start = [], 0, time.perf_counter()
+            for q, truth in zip(queries, exact):
+                rows = index.candidates(q, nprobe=nprobe)
+                scanned += len(rows)
+                recalls.append(len(top_rows(matrix[rows] @ q, rows) & truth) / max(1, len(truth)))
+            ann_ms = (time.perf_counter() - start) * 1000 / len(queries)
+            report.append({
+                'nprobe': min(nprobe, index.nlist),
+                'recall_at_k': float(np.mean(recalls)),
+                'ann_ms': ann_ms,
+                'exact_ms': exact_ms,
+                'speedup': exact_ms / ann_ms if ann_ms > 0 else 0.0,
+                'scanned_fraction': scanned / (len(queries) * n),
+            })
+        logger.info("ann_report", k=k, nlist=index.nlist, size=n, report=report)
+        return report
+
+    def hybrid_search_with_metrics(self, query, top_k=3, q_emb=None):
+        """Búsqueda híbrida (semantic + lexical) + latencia. `q_emb`: embedding de la query ya calculado (4.6b)."""
+        start = time.time()
+        snap = self.kb.snapshot  # (4.0f) una sola instantánea para toda la búsqueda
+        try:
+            if not snap.documents or snap.embedding_matrix is None:
+                logger.warning("rag_search", status="skipped", reason="No documents/embeddings available")
+                return [], 0.0
+
+            if q_emb is None:
+                q_emb = self.get_query_embedding(query)
+            if q_emb is None:
+                return [], 0.0
+            q_vec = self._normalize_rows(q_emb)[0]
+            # Solo se recorren los postings de los términos de la query
+            lexical_scores = snap.lexical_index.score(query, scorer=self.lexical_scorer)
+            lex_rows = np.fromiter((snap.doc_rows[d] for d in lexical_scores), dtype=np.int64, count=len(lexical_scores))
+            lex_vals = np.fromiter(lexical_scores.values(), dtype=np.float32, count=len(lexical_scores))
+            rows = None  # None = búsqueda exacta sobre todas las filas
+            if snap.ann_index is not None and len(snap.ann_index) == len(snap.documents):
+                # (4.0) ANN: filas de las listas IVF sondeadas + mejores candidatos léxicos
+                max_lexical = max(50, 10 * top_k)
+                if len(lex_rows) > max_lexical:
+                    best = np.argpartition(-lex_vals, max_lexical - 1)[:max_lexical]
+                    lex_rows, lex_vals = lex_rows[best], lex_vals[best]
+                rows = np.union1d(snap.ann_index.candidates(q_vec, nprobe=self.ann_nprobe), lex_rows)
+                semantic = snap.embedding_matrix[rows] @ q_vec
+                lexical = np.zeros(len(rows), dtype=np.float32)
+                lexical[np.searchsorted(rows, lex_rows)] = lex_vals
+            else:
+                semantic = snap.embedding_matrix @ q_vec  # coseno: filas ya normalizadas al indexar
+                lexical = np.zeros(len(semantic), dtype=np.float32)
+                lexical[lex_rows] = lex_vals
+            combined = 0.7 * semantic + 0.3 * lexical
+            # Selección top-k en O(n) (argpartition); solo se ordenan y materializan los k ganadores
+            k = min(max(1, top_k), len(combined))
+            top = np.argpartition(-combined, k - 1)[:k] if k < len(combined) else np.arange(len(combined))
+            top = top[np.argsort(-combined[top], kind="stable")]
+            doc_rows = top if rows is None else rows[top]
+            results = [{
+                'id': int(row),
+                'doc_id': snap.doc_ids[row],
+                'document': snap.documents[row],
+                'semantic_score': float(semantic[pos]),
+                'lexical_score': float(lexical[pos]),
+                'combined_score': float(combined[pos])
+            } for pos, row in zip(top, doc_rows)]
+            retrieval_time = time.time() - start
+            logger.info("rag_search", status="success", duration_sec=retrieval_time, top_k=top_k, lexical_scorer=self.lexical_scorer,
+                        ann=rows is not None, scanned=len(combined))  # IL3.2: Trazabilidad
+            return results, retrieval_time
+        except Exception as e:
+            self.error_count += 1
+            logger.error("rag_search", status="error", error=str(e))
+            st.warning(f"⚠ Error en búsqueda híbrida: {e}")
+            return [], 0.0
+
+    # -----------------------------
+    # 4.4 Generación de Respuesta LLM
+    # -----------------------------
+    def _chat_payload(self, query, context, stream=False):
+        """Cuerpo de chat/completions (mismo prompt para SDK y GitHub inference)."""
+        prompt = f"Contexto:\n{context}\n\nPregunta: {query}\n\nResponda de forma clara y concisa:"
+        payload = {
+            "model": self.llm_model,
+            "messages": [{"role": "user", "content": prompt}],
+            "temperature": 0.1,
+            "max_tokens": 600
+        }
+        if stream:
+            payload["stream"] = True
+        return payload
+
+    async def agenerate_response_with_metrics(self, query, context):
+        """(4.6b) Genera respuesta LLM con contexto y reporta uso de tokens (cliente asíncrono)."""
+        start = time.time()
+        tokens_used = {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0}
+        payload = self._chat_payload(query, context)
+        prompt = payload["messages"][0]["content"]
+        try:
+            with trace_span("provider.chat", mode="github" if getattr(self, "github_mode", False) else "sdk",
+                            model=self.llm_model, prompt_chars=len(prompt)) as span:
+                if getattr(self, "github_mode", False):
+                    # Llamada simple al endpoint de chat/completions de GitHub (transporte con pool, en un hilo)
+                    resp = await asyncio.to_thread(self._github_post, "chat/completions", payload)
+                elif self.async_client is not None:
+                    resp = (await self.async_client.chat.completions.create(**payload)).model_dump()  # SDK OpenAI/Azure
+                else:
+                    resp = (await asyncio.to_thread(self.client.chat.completions.create, **payload)).model_dump()
+                # Adaptar según respuesta: intento de extracción común
+                choice = (resp.get("choices") or [{}])[0]
+                response_text = (choice.get("message") or {}).get("content") or choice.get("text")
+                usage = resp.get("usage", {}) or {}
+
+                if usage:
+                    tokens_used = {
+                        'prompt_tokens': usage.get('prompt_tokens', 0),
+                        'completion_tokens': usage.get('completion_tokens', 0),
+                        'total_tokens': usage.get('total_tokens', 0)
+                    }
+                span.set(response_chars=len(response_text or ""), **tokens_used)
+            generation_time = time.time() - start
+            logger.info("llm_generation", status="success", duration_sec=generation_time, **tokens_used)
+            return response_text or "", generation_time, context, tokens_used
+        except Exception as e:
+            self.error_count += 1
+            logger.error("llm_generation", status="error", error=str(e), prompt_length=len(prompt))  # Error generando respuesta LLM
+            generation_time = time.time() - start
+            return f"Error generando respuesta: {e}", generation_time, context, tokens_used
+
+    def generate_response_with_metrics(self, query, context):
+        """Genera respuesta LLM con contexto y reporta uso de tokens."""
+        return run_coroutine_sync(self.agenerate_response_with_metrics(query, context))
+
+    async def astream_response_with_metrics(self, query, context, stats):
+        """
+        (4.6b) Generación en streaming: produce los fragmentos de texto a medida que llegan y,
+        al terminar, deja en `stats` la respuesta completa, el tiempo de generación, el tiempo
+        hasta el primer token (TTFT), tokens/seg y el uso de tokens.
+        """
+        start = time.time()
+        first_token_at = None
+        parts, usage, chunks = [], {}, 0
+        payload = self._chat_payload(query, context, stream=True)
+        try:
+            if getattr(self, "github_mode", False):
+                events = iterate_in_thread(self._github_stream("chat/completions", payload))
+            elif self.async_client is not None:
+                events = await self.async_client.chat.completions.create(**payload, stream_options={"include_usage": True})
+            else:
+                # SDK síncrono: también la apertura (hasta recibir las cabeceras) fuera del bucle compartido
+                events = iterate_in_thread(await asyncio.to_thread(self.client.chat.completions.create, **payload,
+                                                                   stream_options={"include_usage": True}))
+            async for event in events:
+                if not isinstance(event, dict):
+                    event = event.model_dump()  # ChatCompletionChunk del SDK
+                usage = event.get("usage") or usage  # el último evento trae el uso (si el proveedor lo informa)
+                for choice in event.get("choices") or []:
+                    delta = (choice.get("delta") or {}).get("content") or choice.get("text")
+                    if delta:
+                        if first_token_at is None:
+                            first_token_at = time.time()
+                        chunks += 1
+                        parts.append(delta)
+                        yield delta
+            error_occurred = False
+        except Exception as e:
+            self.error_count += 1
+            logger.error("llm_generation", status="error", mode="stream", error=str(e),
+                         prompt_length=len(payload["messages"][0]["content"]))
+            message = ("\n\n" if parts else "") + f"Error generando respuesta: {e}"
+            parts.append(message)
+            error_occurred = True
+            yield message
+
+        end = time.time()
+        completion_tokens = usage.get('completion_tokens') or chunks  # sin `usage`: ~1 token por fragmento
+        decode_time = end - (first_token_at or end)
+        tokens_used = {
+            'prompt_tokens': usage.get('prompt_tokens', 0),
+            'completion_tokens': completion_tokens,
+            'total_tokens': usage.get('total_tokens') or usage.get('prompt_tokens', 0) + completion_tokens
+        }
+        stats.update(
+            prompt_chars=len(payload["messages"][0]["content"]),
+            response="".join(parts),
+            generation_time=end - start,
+            ttft=(first_token_at or end) - start,
+            tokens_per_sec=completion_tokens / decode_time if decode_time > 0 else 0.0,
+            tokens_used=tokens_used,
+            error_occurred=error_occurred,
+        )
+        if not error_occurred:
+            logger.info("llm_generation", status="success", mode="stream", duration_sec=stats['generation_time'],
+                        ttft_sec=stats['ttft'], tokens_per_sec=stats['tokens_per_sec'], **tokens_used)
+
+    def stream_response_with_metrics(self, query, context, stats):
+        """Variante en streaming de `generate_response_with_metrics` (ver `astream_response_with_metrics`)."""
+        yield from iterate_async_sync(self.astream_response_with_metrics(query, context, stats))
+
+    # -----------------------------
+    # 4.5 Seguridad y Ética (IL3.3 / IE6)
+    # -----------------------------
+    def sanitize_input(self, user_input):
+        """
+        IE6: Saneamiento de input para mitigar Prompt Injection y XSS (aunque es menos relevante aquí).
+        Remueve caracteres peligrosos y detecta patrones de inyección (regex precompiladas).
+        """
+        # Detectar y neutralizar intentos de inyección de prompt en una sola pasada
+        sanitized, injections = self._injection_re.subn("consulta sobre el hospital", user_input)
+        if injections:
+            logger.warning("security_violation", type="prompt_injection", input=user_input[:50], action="blocked_sanitized")
+
+        # Saneamiento general de caracteres potencialmente peligrosos (ej. para XSS o inyección)
+        cleaned_input = self._unsafe_chars_re.sub('', sanitized)
+
+        return cleaned_input
+
+    def ethical_check(self, query, matches=None):
+        """
+        IE6: Filtro ético para contenido dañino o fuera de alcance médico.
+        `matches`: clasificación ya calculada con `keyword_matcher.classify` (evita otra pasada).
+        """
+        matches = self.keyword_matcher.classify(query) if matches is None else matches
+        keyword = matches.get('prohibited')
+        if keyword:
+            logger.warning("ethical_violation", type="harmful_content", keyword=keyword, query=query[:50], action="blocked")
+            # Mensaje con recursos de ayuda
+            return False, (
+                "Lo siento, no puedo ayudar con ese tipo de consultas. "
+                "Si estás pasando por un momento difícil, por favor contacta:\n\n"
+                "🆘 **Salud Responde (Minsal Chile)**: 600 360 7777\n"
+                "🆘 **Línea de Prevención del Suicidio**: 1412 (24/7 gratuito)\n"
+                "🆘 **Urgencias Hospital Barros Luco**: +56 2 2576 2000\n\n"
+                "Para consultas sobre servicios del hospital, pregúntame sobre horarios, ubicaciones o procedimientos administrativos."
+            )
+
+        # IE6: Advertencia para temas sensibles (Consejo Legal/Financiero/Específico no médico)
+        if matches.get('sensitive'):
+            return True, "Consulta sobre el Hospital Barros Luco"  # Permite la consulta pero con un tema neutral
+
+        return True, None
+
+    # -------------------------
+    # Lógica central del Agente (ReAct-like)
+    # -------------------------
+    # -----------------------------
+    # 4.6 Lógica Central (Decisión RAG / Directo)
+    # -----------------------------
+    def _wants_rag(self, cleaned_query, matches=None):
+        """Heurística de decisión RAG / directo (palabras clave hospitalarias) con índice disponible."""
+        matches = self.keyword_matcher.classify(cleaned_query) if matches is None else matches
+        return 'rag' in matches and self.embeddings is not None
+
+    async def _aprepare_agent_turn(self, query, span=None, started=None):
+        """
+        (4.6b) Seguridad, decisión RAG / directo y recuperación. El embedding de la consulta
+        se lanza antes del filtro ético (corre en paralelo) y se cancela si la consulta se bloquea.
+        `span`: tramo raíz de la traza del turno (4.9b); `started`: inicio del turno (`perf_counter`).
+        """
+        started = time.perf_counter() if started is None else started
+        with trace_span("sanitize", chars=len(query)):
+            cleaned_query = self.sanitize_input(query)
+        with trace_span("classify") as classify_span:
+            matches = self.keyword_matcher.classify(cleaned_query)  # (4.0d) Todas las familias en una pasada
+            use_rag = self._wants_rag(cleaned_query, matches)
+            classify_span.set(rag=use_rag)
+        # (4.0c) Solo turnos RAG (ya necesitan el embedding); en los directos la consulta a la caché
+        # costaría una llamada extra al proveedor en cada fallo, salvo `ATLAS_ANSWER_CACHE_DIRECT=true`.
+        # La caché es del proceso: una consulta con datos personales ni se busca ni se guarda, porque
+        # la respuesta podría repetirlos a otro usuario
+        has_pii = self._mask_pii(cleaned_query) != cleaned_query
+        use_cache = self.answer_cache is not None and (use_rag or answer_cache_direct) and not has_pii
+        embed_task = None
+        if use_rag or use_cache:
+            embed_task = asyncio.create_task(self.aget_query_embedding(cleaned_query))
+            await asyncio.sleep(0)  # deja salir la solicitud antes de seguir con los filtros
+        with trace_span("ethics"):
+            is_ethical, ethical_message = self.ethical_check(cleaned_query, matches)
+        turn = {'query': query, 'cleaned_query': cleaned_query, 'blocked': not is_ethical,
+                'ethical_message': ethical_message, 'context_text': "", 'results': [], 'rag_time': 0.0,
+                'q_vec': None, 'cache_namespace': None, 'cache_hit': None, 'span': span or NULL_SPAN,
+                'started': started, 'prepare_time': 0.0, 'context_tokens': 0}
+        span = turn['span'].set(rag=use_rag, blocked=not is_ethical)
+        if not is_ethical:
+            if embed_task is not None:
+                embed_task.cancel()
+                logger.info("agent_decision", action="cancel_tool", tool="query_embedding", reasoning="Blocked by ethical check")
+            turn['prepare_time'] = time.perf_counter() - started
+            return turn
+
+        q_emb = await embed_task if embed_task is not None else None
+        if use_cache and q_emb is not None:
+            # (4.0c) Consulta casi idéntica ya respondida con el mismo modelo y corpus: se reutiliza
+            with trace_span("answer_cache") as cache_span:
+                turn['q_vec'] = self._normalize_rows(q_emb)[0]
+                turn['cache_namespace'] = self._cache_namespace()
+                hit = self.answer_cache.get(turn['q_vec'], turn['cache_namespace'])
+                cache_span.set(hit=hit is not None)
+            span.set(cache_hit=hit is not None)
+            if hit is not None:
+                logger.info("agent_decision", action="answer_cache_hit", tool="none", similarity=round(hit['similarity'], 4))
+                turn['cache_hit'] = hit
+                self._build_context(turn, hit['results'])
+                turn['rag_time'] = turn['prepare_time'] = time.perf_counter() - started
+                return turn
+
+        # IL3.2: Trazabilidad de Decisión (Simulación ReAct)
+        if use_rag:
+            logger.info("agent_decision", action="use_tool", tool="RAG_Tool", reasoning="Keyword match (hospital related)")
+            if q_emb is not None:
+                with trace_span("search", top_k=3, documents=len(self.kb.snapshot.documents)) as search_span:
+                    results, _ = await asyncio.to_thread(self.hybrid_search_with_metrics, cleaned_query, 3, q_emb)
+                    search_span.set(results=len(results))
+                self._build_context(turn, results)
+                turn['rag_time'] = time.perf_counter() - started
+        else:
+            logger.info("agent_decision", action="llm_direct", tool="none", reasoning="General or non-hospital query")
+        turn['prepare_time'] = time.perf_counter() - started
+        return turn
+
+    def _build_context(self, turn, results):
+        """
+        (4.0h) Contexto del prompt dentro del presupuesto de tokens (`ContextBuilder`); `turn['results']`
+        queda con las fuentes que llegaron al prompt.
+        """
+        with trace_span("context", candidates=len(results)) as span:
+            turn['context_text'], turn['results'], stats = self.context_builder.build(turn['cleaned_query'], results)
+            span.set(**stats)
+        turn['context_tokens'] = stats['tokens']
+        if stats['tokens'] < stats['tokens_in']:
+            logger.info("context_build", **stats)
+
+    def _start_trace(self, **attrs):
+        """(4.9b) Tramo raíz de un turno del agente (`NULL_SPAN` con `ATLAS_TRACE=false`)."""
+        return self.tracer.start("agent_turn", **attrs) if tracing_enabled else NULL_SPAN
+
+    def _cache_namespace(self):
+        """(4.0c) Las respuestas en caché solo valen para el mismo modelo LLM, modelo de embeddings y corpus."""
+        return (self.llm_model, self.embeddings_model, self.corpus_version)
+
+    def _blocked_turn(self, turn):
+        """Registra (en segundo plano) una consulta bloqueada por el filtro ético y devuelve sus métricas."""
+        metrics = {'total_time': time.perf_counter() - turn['started'], 'faithfulness': 0.0, 'relevance': 0.0,
+                   'context_precision': 0.0}
+        self.pending_evaluation = _executor.submit(self._persist_turn, turn, turn['ethical_message'], metrics, True)
+        return metrics
+
+    def _persist_turn(self, turn, response, metrics, error_occurred):
+        """(4.9b) `log_interaction` dentro del tramo `persist` de la traza del turno."""
+        with turn['span'].child("persist"):
+            return self.log_interaction(turn['query'], response, metrics, turn['results'], error_occurred, turn.get('id'))
+
+    def _finalize_agent_turn(self, turn, response, generation_time, tokens_used, ttft, tokens_per_sec, generation_error=False):
+        """
+        Métricas de tiempo y uso disponibles al responder; el registro de la interacción y (4.9c) las
+        evaluaciones de calidad por lotes se completan fuera del camino de respuesta. Los puntajes
+        quedan solo en la entrada del log: quien llama recibe una copia con `interaction_id` para
+        leerlos después (`InteractionLog.evaluation`).
+        """
+        metrics = {
+            'total_time': time.perf_counter() - turn['started'],  # (4.9b) de punta a punta: desde el saneamiento
+            'faithfulness': 0.0,
+            'relevance': 0.0,
+            'context_precision': 0.0,
+            'evaluation': 'pending',  # (4.9c) hasta que `EvaluationWorker` escriba los puntajes
+            'tokens_used': tokens_used,  # IL3.1: Uso de Recursos
+            'rag_time': turn['rag_time'],
+            'ttft': turn['prepare_time'] + ttft,  # (4.4) Tiempo hasta el primer token visible (incluye filtros y RAG)
+            'tokens_per_sec': tokens_per_sec,
+            'context_tokens': turn.get('context_tokens', 0),  # (4.0h) tokens estimados del contexto enviado
+        }
+        if turn['cache_hit'] is not None:
+            saved = max(turn['cache_hit']['cost_sec'] - metrics['total_time'], 0.0)
+            metrics['cache_hit'], metrics['latency_saved'] = True, saved
+            self.answer_cache.record_saving(saved)
+        elif turn['q_vec'] is not None and not generation_error and turn['cache_namespace'] == self._cache_namespace():
+            self.answer_cache.put(turn['q_vec'], turn['cache_namespace'], response, turn['results'], metrics['total_time'])
+        turn['id'] = str(uuid.uuid4())
+        self.pending_evaluation = _executor.submit(self._log_and_evaluate, turn, response, metrics)
+        return dict(metrics, interaction_id=turn['id'])
+
+    def _log_and_evaluate(self, turn, response, metrics):
+        """IE3: log de la interacción (en `_executor`); IL3.1: la encola en el evaluador por lotes (4.9c)."""
+        logged = self._persist_turn(turn, response, metrics, error_occurred=False)
+        if logged:
+            self.evaluator.submit({'id': turn['id'], 'log': self.interaction_log, 'query': turn['cleaned_query'],
+                                   'response': response, 'context_text': turn['context_text'],
+                                   'results': turn['results'], 'span': turn['span']})
+        return logged
+
+    async def arun_agent_logic(self, query):
+        """(4.6b) Decide vía heurística si aplica RAG y calcula métricas finales (pipeline asíncrono)."""
+        started = time.perf_counter()
+        with self._start_trace(stream=False, query_chars=len(query)) as root:
+            turn = await self._aprepare_agent_turn(query, root, started)
+            if turn['blocked']:
+                return turn['ethical_message'], self._blocked_turn(turn), []
+
+            if turn['cache_hit'] is not None:
+                response, generation_time, tokens_used = turn['cache_hit']['response'], 0.0, {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0}
+            else:
+                # Generar respuesta con (posible) contexto
+                with trace_span("generate", stream=False, context_chars=len(turn['context_text'])):
+                    response, generation_time, _, tokens_used = await self.agenerate_response_with_metrics(turn['cleaned_query'], turn['context_text'])
+            # Sin streaming el primer token visible llega con la respuesta completa
+            tokens_per_sec = tokens_used.get('completion_tokens', 0) / generation_time if generation_time > 0 else 0.0
+            metrics = self._finalize_agent_turn(turn, response, generation_time, tokens_used, generation_time, tokens_per_sec,
+                                                generation_error=response.startswith("Error generando respuesta"))
+
+        # IE6: Adjuntar advertencia ética (si aplica)
+        if turn['ethical_message']:
+            response = f"**[Advertencia Ética/Legal]** {turn['ethical_message']}\n\n---\n\n{response}"
+
+        return response, metrics, turn['results']
+
+    def run_agent_logic(self, query):
+        """Decide vía heurística si aplica RAG y calcula métricas finales (envoltorio de `arun_agent_logic`)."""
+        return run_coroutine_sync(self.arun_agent_logic(query))
+
+    async def astream_agent_logic(self, query, outcome):
+        """
+        (4.6b) Variante en streaming de `arun_agent_logic`: produce la respuesta por fragmentos
+        y al terminar deja `response`, `metrics` y `results` en `outcome`.
+        Los tramos que abarcan `yield`s se terminan con `end()` (ver `Span`).
+        """
+        started = time.perf_counter()
+        root = self._start_trace(stream=True, query_chars=len(query))
+        try:
+            with root.activate():
+                turn = await self._aprepare_agent_turn(query, root, started)
+            if turn['blocked']:
+                outcome.update(response=turn['ethical_message'], metrics=self._blocked_turn(turn), results=[])
+                root.end()
+                yield turn['ethical_message']
+                return
+
+            # IE6: La advertencia ética (si aplica) se muestra antes de la respuesta
+            prefix = f"**[Advertencia Ética/Legal]** {turn['ethical_message']}\n\n---\n\n" if turn['ethical_message'] else ""
+            if prefix:
+                yield prefix
+            stats = {}
+            if turn['cache_hit'] is not None:
+                stats.update(response=turn['cache_hit']['response'], generation_time=0.0, ttft=0.0, tokens_per_sec=0.0,
+                             tokens_used={'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0}, error_occurred=False)
+                yield stats['response']
+            else:
+                generate = root.child("generate", stream=True, context_chars=len(turn['context_text']),
+                                      mode="github" if getattr(self, "github_mode", False) else "sdk", model=self.llm_model)
+                try:
+                    async for delta in self.astream_response_with_metrics(turn['cleaned_query'], turn['context_text'], stats):
+                        yield delta
+                finally:
+                    # También si el consumidor abandona el stream: el tramo queda registrado como interrumpido
+                    if 'tokens_used' in stats:
+                        generate.set(prompt_chars=stats.get('prompt_chars', 0), ttft=stats['ttft'], **stats['tokens_used'])
+                    generate.end("stream error" if stats.get('error_occurred') else
+                                 None if 'tokens_used' in stats else "stream aborted")
+            metrics = self._finalize_agent_turn(turn, stats['response'], stats['generation_time'], stats['tokens_used'],
+                                                stats['ttft'], stats['tokens_per_sec'], generation_error=stats['error_occurred'])
+            outcome.update(response=prefix + stats['response'], metrics=metrics, results=turn['results'])
+        finally:
+            root.end()  # idempotente; también si el consumidor abandona el stream
+
+    def stream_agent_logic(self, query, outcome):
+        """(4.4) Generador síncrono para `st.write_stream` (envoltorio de `astream_agent_logic`)."""
+        yield from iterate_async_sync(self.astream_agent_logic(query, outcome))
+
+    # -----------------------------
+    # 4.7 Métricas de Calidad (IL3.1): ver `HeuristicEvaluator` (4.9c), en segundo plano y por lotes
+    # -----------------------------
+    # -----------------------------
+    # 4.7 (continuación) Persistencia y Logs (IE3 / IE10)
+    # -----------------------------
+    def log_interaction(self, query, response, metrics, results, error_occurred, entry_id=None):
+        """Registra interacción y la agrega al log JSONL (enmascarada una sola vez, sin reescribir el historial)."""
+        try:
+            entry = {
+                'id': entry_id or str(uuid.uuid4()),
+                'timestamp': datetime.utcnow().isoformat(),
+                'query': query,
+                'response': response,
+                'metrics': dict(metrics),  # (4.9c) copia: el evaluador completa la del turno y la del log por separado
+                'error_occurred': error_occurred,
+                'context_count': len(results) if results else 0,
+                'context_scores': [r.get('combined_score') for r in results] if results else []
+            }
+            logger.info("interaction_end", **entry)  # Registro estructurado final (IL3.2)
+            # Persist logs to disk for reproducibility (IE6 / IE10): append-only, en segundo plano
+            try:
+                self.interaction_log.add(entry, self._masked_entry(entry))
+            except Exception as e:
+                logger.warning("log_persist_failed", error=str(e))
+            return True
+        except Exception as e:
+            logger.error("log_error", error=str(e), message="Fallo al registrar la interacción")
+            return False
+
+    def _masked_entry(self, entry):
+        """Copia persistible de una entrada con PII enmascarada en query/response."""
+        copy_e = dict(entry)
+        copy_e['query'] = self._mask_pii(str(copy_e.get('query', '')))
+        copy_e['response'] = self._mask_pii(str(copy_e.get('response', '')))
+        copy_e['metrics'] = copy_e.get('metrics', {})
+        return copy_e
+
+    def _get_log_writer(self):
+        """(4.9) Escritor JSONL en segundo plano del registro de interacciones."""
+        return self.interaction_log.get_writer()
+
+    def read_log_columns(self, columns, since=None, until=None):
+        """(4.9) Métricas en columnas NumPy para [since, until) (ver `InteractionLog.read_columns`)."""
+        return self.interaction_log.read_columns(columns, since=since, until=until)
+
+    def _rebuild_rollup(self):
+        """(4.9) Recalcula los agregados del dashboard desde el archivo columnar y el segmento activo."""
+        self.interaction_log.rebuild_rollup()
+
+    def _save_logs(self, entries=None):
+        """
+        Reescribe el log completo con `entries` (por defecto la ventana actual), con PII enmascarada
+        (exportación / restauración manual).
+        """
+        try:
+            entries = self.interaction_log.recent() if entries is None else InteractionLog.merge_evaluations(entries)
+            sanitized = [self._masked_entry(e) for e in entries]
+            self.interaction_log.rewrite(entries, sanitized)
+            logger.info("logs_saved", path=self.logs_path, count=len(sanitized))
+            return True
+        except Exception as e:
+            logger.error("logs_save_error", error=str(e))
+            raise
+
+    def _mask_pii(self, text: str) -> str:
+        """Enmascara patrones simples de PII (RUT, teléfonos, correos, secuencias largas de dígitos) para evitar guardar datos sensibles."""
+        try:
+            # Enmascarar correos
+            text = re.sub(r"[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}", "[REDACTED_EMAIL]", text)
+            # Enmascarar RUT chileno (12.345.678-9 / 12345678-K)
+            text = re.sub(r"\b\d{1,2}\.?\d{3}\.?\d{3}-[\dkK]\b", "[REDACTED_RUT]", text)
+            # Enmascarar teléfonos (7+ dígitos, con separadores)
+            text = re.sub(r"(\+?\d[\d\s\-()]{6,}\d)", "[REDACTED_PHONE]", text)
+            # Enmascarar secuencias largas de dígitos
+            text = re.sub(r"\b\d{7,}\b", "[REDACTED_NUMBER]", text)
+            return text
+        except Exception:
+            return text
+
+    def _save_message(self, role, content):
+        """
+        (4.9) Agrega un mensaje (con PII enmascarada) al historial de la conversación de la sesión,
+        en segundo plano, y lo devuelve con su `seq` y el contenido original para mostrarlo.
+        """
+        try:
+            message = self.message_store.append(self.conversation_id, role, self._mask_pii(content))
+            return dict(message, content=content)
+        except Exception as e:
+            logger.error("messages_save_error", error=str(e))
+            return {'role': role, 'content': content}
+
+    def _load_messages(self, before_seq=None, limit=None):
+        """(4.9) Últimos `limit` mensajes de la conversación (o los anteriores a `before_seq`), leídos desde el final del archivo."""
+        try:
+            messages = self.message_store.page(self.conversation_id, before_seq,
+                                               limit or (chat_page_size if before_seq is not None else chat_window))
+            logger.info("messages_loaded", conversation=self.conversation_id, count=len(messages), before_seq=before_seq)
+            return messages
+        except Exception as e:
+            logger.error("messages_load_error", error=str(e))
+            return []
+
+    # -----------------------------
+    # 4.8 Extensión / Documentos Externos
+    # -----------------------------
+    def add_external_documents(self, documents: list, ids=None, progress=None):
+        """
+        Agrega documentos externos indexando solo los nuevos (sin re-embeber el corpus).
+        Devuelve cuántos quedaron indexados (0 si ninguno): un lote fallido no descarta el resto.
+        """
+        try:
+            if not documents:
+                return 0
+            new_ids = self.append_documents(documents, ids=ids, progress=progress)
+            if not new_ids:
+                return 0
+            logger.info("external_docs_added", count=len(new_ids), requested=len(documents))
+            return len(new_ids)
+        except Exception as e:
+            logger.error("external_docs_error", error=str(e))
+            return 0
+
+    def ingest_file(self, fileobj, source, progress=None):
+        """
+        (4.0e) Ingesta en streaming de un archivo grande: los fragmentos de `StreamingChunker` se
+        embeben e indexan por tandas de `ingest_batch_chunks`, de modo que la memoria de la ingesta
+        no depende del tamaño del archivo. `progress(bytes_leidos, bytes_totales)`.
+        Devuelve (fragmentos indexados, fragmentos leídos).
+        """
+        size = fileobj.seek(0, os.SEEK_END)
+        fileobj.seek(0)
+        indexed = read = 0
+        batch, metas = [], []
+
+        def flush():
+            added = self.append_documents(batch, metadata=metas, persist=False) or []  # se persiste al final
+            if progress:
+                progress(min(fileobj.tell(), size), size)
+            return len(added)
+
+        try:
+            for text, meta in StreamingChunker().iter_file(fileobj, source):
+                batch.append(text)
+                metas.append(meta)
+                read += 1
+                if len(batch) >= ingest_batch_chunks:
+                    indexed += flush()
+                    batch, metas = [], []
+            if batch:
+                indexed += flush()
+        finally:
+            if indexed:
+                self._persist_external_documents()
+            logger.info("ingest_file", source=source, bytes=size, chunks=read, indexed=indexed)
+        return indexed, read
+
+    def append_documents(self, documents, ids=None, progress=None, metadata=None, persist=True):
+        """
+        (4.8) Indexación incremental: embebe solo `documents` (por lotes) y publica una instantánea
+        (4.0f) con la matriz ampliada sobre el buffer de reserva y copias copy-on-write de los índices.
+        Devuelve los ids de los documentos indexados (los de lotes fallidos se omiten) o None si no se
+        pudo embeber ninguno. Como `remove_documents` y `replace_document`, guarda los documentos
+        externos en disco salvo `persist=False` (ingestas por tandas que guardan al terminar).
+        """
+        ids = list(ids) if ids is not None else [f"ext-{uuid.uuid4().hex[:12]}" for _ in documents]
+        if len(ids) != len(documents) or (metadata is not None and len(metadata) != len(documents)):
+            raise ValueError("`ids` y `metadata` deben tener la misma longitud que `documents`")
+        documents = list(documents)
+        with self.kb.lock:
+            snap = self.kb.snapshot
+            if len(set(ids)) != len(ids) or any(i in snap.doc_rows for i in ids):
+                raise ValueError("Ids de documento duplicados")
+            doc_meta = snap.doc_meta
+            if metadata is not None:
+                doc_meta = dict(doc_meta)
+                doc_meta.update((i, m) for i, m in zip(ids, metadata) if m)
+            if snap.embedding_matrix is None and snap.documents:
+                # Sin índice previo: no hay filas que ampliar, reconstrucción completa
+                if self._reindex(snap.documents + documents, snap.doc_ids + ids, doc_meta, progress=progress) is None:
+                    return None
+                if persist:
+                    self._persist_external_documents()
+                logger.info("index_update", action="rebuild", count=len(ids), total=len(self.kb.snapshot.documents))
+                return ids
+            embedded = self._embed_texts(documents, allow_partial=True, progress=progress)
+            if embedded is None or not embedded[1]:
+                return None
+            matrix, rows = embedded
+            if len(rows) < len(documents):
+                logger.warning("index_update", action="append", status="partial", skipped=len(documents) - len(rows))
+                documents, ids = [documents[i] for i in rows], [ids[i] for i in rows]
+            start_row = 0 if snap.embedding_matrix is None else len(snap.embedding_matrix)
+            grown = self.kb.grow_matrix(snap.embedding_matrix, self._normalize_rows(matrix))
+            lexical_index = snap.lexical_index.copy()
+            for doc_id, doc in zip(ids, documents):
+                lexical_index.add(doc_id, doc)
+            ann_index = snap.ann_index.copy() if snap.ann_index is not None else None
+            if ann_index is not None:
+                ann_index.add(start_row, grown[start_row:])
+            candidate = snap.replace(documents=snap.documents + documents, doc_ids=snap.doc_ids + ids,
+                                     doc_meta=doc_meta, embedding_matrix=grown, lexical_index=lexical_index,
+                                     ann_index=ann_index)
+            candidate.ann_index = self._refresh_ann_index(candidate)
+            self._sync_embedding_backend(candidate, added=documents)
+            self.kb.publish(candidate)
+            if persist:
+                self._persist_external_documents()
+        logger.info("index_update", action="append", count=len(ids), total=len(candidate.documents))
+        return ids
+
+    def remove_documents(self, ids):
+        """(4.8) Elimina documentos por id (filas de la matriz y del índice léxico). Devuelve cuántos."""
+        targets = set(ids)
+        with self.kb.lock:
+            snap = self.kb.snapshot
+            keep = [i for i, doc_id in enumerate(snap.doc_ids) if doc_id not in targets]
+            removed_rows = [i for i, doc_id in enumerate(snap.doc_ids) if doc_id in targets]
+            removed = len(removed_rows)
+            if not removed:
+                return 0
+            lexical_index = snap.lexical_index.copy()
+            for doc_id in targets:
+                lexical_index.remove(doc_id)
+            changes = {
+                'documents': [snap.documents[i] for i in keep],
+                'doc_ids': [snap.doc_ids[i] for i in keep],
+                'doc_meta': {i: m for i, m in snap.doc_meta.items() if i not in targets},
+                'lexical_index': lexical_index,
+            }
+            if snap.embedding_matrix is not None:
+                changes['embedding_matrix'] = snap.embedding_matrix[keep]  # copia: la instantánea anterior no cambia
+                ann_index = snap.ann_index.copy() if snap.ann_index is not None else None
+                if ann_index is not None:
+                    ann_index.remove(removed_rows)
+                changes['ann_index'] = ann_index
+                self.kb.matrix_buffer = None
+            candidate = snap.replace(**changes)
+            if snap.embedding_matrix is not None:
+                candidate.ann_index = self._refresh_ann_index(candidate)
+            self._sync_embedding_backend(candidate, added=[], removed=[snap.documents[i] for i in removed_rows])
+            self.kb.publish(candidate)
+            self._persist_external_documents()
+        logger.info("index_update", action="remove", count=removed, total=len(candidate.documents))
+        return removed
+
+    def replace_document(self, doc_id, text, metadata=None):
+        """
+        (4.8) Sustituye el contenido de un documento re-embebiendo solo ese texto. La matriz se copia
+        (copy-on-write) para no alterar la instantánea que estén usando otras sesiones. La procedencia
+        del fragmento original (`doc_meta`) ya no describe el texto nuevo: se reemplaza por `metadata`
+        o se descarta.
+        """
+        with self.kb.lock:
+            snap = self.kb.snapshot
+            idx = snap.doc_rows.get(doc_id)
+            if idx is None:
+                return False
+            changes = {}
+            if snap.embedding_matrix is not None:
+                matrix = self._embed_texts([text])
+                if matrix is None:
+                    return False
+                embedding_matrix = snap.embedding_matrix.copy()
+                embedding_matrix[idx] = self._normalize_rows(matrix)[0]
+                ann_index = snap.ann_index.copy() if snap.ann_index is not None else None
+                if ann_index is not None:
+                    ann_index.update(idx, embedding_matrix[idx])
+                changes.update(embedding_matrix=embedding_matrix, ann_index=ann_index)
+                self.kb.matrix_buffer = None
+            lexical_index = snap.lexical_index.copy()
+            lexical_index.add(doc_id, text)
+            documents = list(snap.documents)
+            documents[idx] = text
+            doc_meta = {i: m for i, m in snap.doc_meta.items() if i != doc_id}
+            if metadata:
+                doc_meta[doc_id] = metadata
+            candidate = snap.replace(documents=documents, doc_meta=doc_meta, lexical_index=lexical_index, **changes)
+            if snap.embedding_matrix is not None:
+                candidate.ann_index = self._refresh_ann_index(candidate)
+            self._sync_embedding_backend(candidate, added=[text], removed=[snap.documents[idx]])
+            self.kb.publish(candidate)
+            self._persist_external_documents()
+        logger.info("index_update", action="replace", doc_id=doc_id, total=len(candidate.documents))
+        return True
+
+    def _persist_external_documents(self):
+        """Guarda en `data/external_docs.json` todos los documentos externos vigentes (con su id)."""
+        try:
+            with self.kb.lock:  # un solo escritor del archivo a la vez
+                snap = self.kb.snapshot
+                external = [(doc_id, doc) for doc_id, doc in zip(snap.doc_ids, snap.documents) if not doc_id.startswith("hbl-")]
+                ext_path = os.path.join('data', 'external_docs.json')
+                tmp_path = ext_path + ".tmp"
+                with open(tmp_path, 'w', encoding='utf-8') as fh:
+                    json.dump({'documents': [d for _, d in external], 'ids': [i for i, _ in external],
+                               'metadata': [snap.doc_meta.get(i) for i, _ in external],
+                               'added_at': datetime.utcnow().isoformat()}, fh, ensure_ascii=False, indent=2)
+                os.replace(tmp_path, ext_path)
+        except Exception:
+            pass
+
+    def load_external_documents(self):
+        """
+        Recupera los documentos externos persistidos en `data/external_docs.json` para que el
+        corpus (y sus índices persistidos) sea el mismo entre reinicios. Devuelve cuántos agregó.
+        """
+        ext_path = os.path.join('data', 'external_docs.json')
+        if not os.path.exists(ext_path):
+            return 0
+        try:
+            with open(ext_path, 'r', encoding='utf-8') as fh:
+                data = json.load(fh)
+            docs = data.get('documents') or []
+            ids = data.get('ids') or []
+            metadata = data.get('metadata') or []
+            if len(ids) != len(docs):
+                # Formato anterior sin ids: id determinista por contenido y posición
+                ids = [f"ext-{hashlib.sha256(f'{i}:{d}'.encode('utf-8')).hexdigest()[:12]}" for i, d in enumerate(docs)]
+            if len(metadata) != len(docs):
+                metadata = [None] * len(docs)
+            with self.kb.lock:
+                snap = self.kb.snapshot
+                entries = [(i, d, m) for i, d, m in zip(ids, docs, metadata)
+                           if isinstance(d, str) and len(d.strip()) >= 10 and i not in snap.doc_rows]
+                if not entries:
+                    return 0
+                count = len(entries)
+                if snap.embedding_matrix is not None:
+                    added = self.append_documents([d for _, d, _ in entries], ids=[i for i, _, _ in entries],
+                                                  metadata=[m for _, _, m in entries], persist=False)  # ya están en disco
+                    if added is None:
+                        return 0
+                    count = len(added)
+                else:
+                    # Aún sin índice: se embeben junto al resto en la siguiente reconstrucción
+                    doc_meta = dict(snap.doc_meta)
+                    doc_meta.update((i, m) for i, _, m in entries if m)
+                    self.kb.publish(snap.replace(documents=snap.documents + [d for _, d, _ in entries],
+                                                 doc_ids=snap.doc_ids + [i for i, _, _ in entries], doc_meta=doc_meta))
+            logger.info("external_docs_loaded", path=ext_path, count=count)
+            return count
+        except Exception as e:
+            logger.error("external_docs_error", error=str(e))
+            return 0
+
+    def clean_placeholder_documents(self) -> bool:
+        """Limpia documentos triviales / placeholder para mantener calidad."""
+        try:
+            snap = self.kb.snapshot
+            if not snap.documents:
+                return True
+            to_remove = []
+            for doc_id, doc in zip(snap.doc_ids, snap.documents):
+                if not doc or 'placeholder' in doc.lower() or 'test' in doc.lower() or len(doc.strip()) < 10:
+                    to_remove.append(doc_id)
+            if to_remove:
+                removed = self.remove_documents(to_remove)
+                logger.info("data_cleaning", removed_count=removed, message="Placeholders cleaned")
+            return True
+        except Exception as e:
+            logger.error("data_cleaning", error=str(e), message="Error cleaning placeholder documents")
+            return False
+
+ # ==============================================================
+ # 4.9 PERSISTENCIA APPEND-ONLY (escritor JSONL en segundo plano)
+ # ==============================================================
+def _iso_to_epoch(value):
+    """Timestamp ISO (UTC, como lo genera `log_interaction`) a segundos epoch; None si no es válido."""
+    try:
+        parsed = datetime.fromisoformat(str(value))
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=timezone.utc)
+        return parsed.timestamp()
+    except (TypeError, ValueError):
+        return None
+
+class AppendOnlyLogWriter:
+    """
+    (4.9) Escritor append-only de un fichero JSONL en un hilo de fondo.
+    Quien registra solo serializa la línea y la encola; el hilo agrupa las líneas
+    pendientes y hace un único write + fsync por lote. Nunca reescribe el historial.
+    Con `segments_dir`, el fichero activo se rota por nº de entradas, tamaño o antigüedad
+    y el segmento cerrado se entrega a `on_rotate` (p. ej. compactación columnar). `counts(entry)`
+    decide qué registros cuentan como entradas para `max_entries` (por defecto, todos).
+    """
+
+    def __init__(self, path, batch_size=256, segments_dir=None, max_entries=None, max_bytes=None,
+                 max_age_sec=None, on_rotate=None, counts=None):
+        self.path = path
+        self.counts = counts
+        self.batch_size = batch_size
+        self.segments_dir = segments_dir
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age_sec = max_age_sec
+        self.on_rotate = on_rotate
+        self.rotations = 0
+        self.lock = threading.Lock()  # serializa escrituras del hilo con reescrituras completas
+        self.written = 0
+        self.batches = 0
+        self._queue = queue.Queue()
+        self._closed = False
+        self._needs_newline = self._ends_mid_line()
+        # Sin segmentos no hay rotación: no hace falta recorrer el fichero existente
+        self._segment_entries, self._segment_started = self._scan_segment() if segments_dir else (0, None)
+        self._thread = threading.Thread(target=self._run, name="atlas-log-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _ends_mid_line(self):
+        """True si el fichero termina en una línea incompleta (escritura interrumpida)."""
+        try:
+            with open(self.path, "rb") as fh:
+                fh.seek(-1, os.SEEK_END)
+                return fh.read(1) != b"\n"
+        except OSError:
+            return False
+
+    def _scan_segment(self):
+        """Nº de entradas y timestamp (epoch) de la primera entrada del segmento activo."""
+        entries, started = 0, None
+        try:
+            with open(self.path, "r", encoding="utf-8") as fh:
+                for line in fh:
+                    if not line.strip():
+                        continue
+                    try:
+                        record = json.loads(line) if (started is None or self.counts is not None) else None
+                    except ValueError:
+                        record = None
+                    if started is None and isinstance(record, dict):
+                        started = _iso_to_epoch(record.get("timestamp"))
+                    entries += 1 if self._counts(record) else 0
+        except OSError:
+            pass
+        return entries, started
+
+    def _should_rotate(self, incoming=0):
+        if not self.segments_dir or not self._segment_entries:
+            return False
+        if self.max_entries and self._segment_entries + incoming > self.max_entries:
+            return True
+        if self.max_bytes and os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+            return True
+        started = self._segment_started
+        return bool(self.max_age_sec and started is not None and time.time() - started >= self.max_age_sec)
+
+    def _rotate(self):
+        """Cierra el segmento activo (se mueve a `segments_dir`) y notifica a `on_rotate`. Requiere `self.lock`."""
+        started = self._segment_started or time.time()
+        stamp = lambda t: datetime.fromtimestamp(t, tz=timezone.utc).strftime("%Y%m%dT%H%M%S")
+        os.makedirs(self.segments_dir, exist_ok=True)
+        closed = os.path.join(self.segments_dir, f"segment-{stamp(started)}-{stamp(time.time())}-{uuid.uuid4().hex[:6]}.jsonl")
+        os.replace(self.path, closed)
+        logger.info("logs_rotated", segment=closed, entries=self._segment_entries)
+        self._segment_entries, self._segment_started = 0, None
+        self._needs_newline = False
+        self.rotations += 1
+        if self.on_rotate is not None:
+            try:
+                self.on_rotate(closed)
+            except Exception as e:
+                logger.error("logs_compaction_error", segment=closed, error=str(e))
+
+    def _counts(self, entry):
+        return self.counts is None or (isinstance(entry, dict) and bool(self.counts(entry)))
+
+    def append(self, entry):
+        """Serializa `entry` (una vez) y la encola para escritura."""
+        self._queue.put((json.dumps(entry, ensure_ascii=False, default=str) + "\n", 1 if self._counts(entry) else 0))
+
+    def flush(self, timeout=5.0):
+        """Bloquea hasta que todo lo encolado antes de la llamada esté en disco."""
+        if self._closed:
+            return True
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self):
+        if not self._closed:
+            self.flush()
+            self._closed = True
+            self._queue.put(None)
+            atexit.unregister(self.close)  # escritores cerrados antes de salir (p. ej. conversaciones expulsadas)
+
+    def rewrite(self, entries):
+        """Reemplaza el fichero completo de forma atómica (exportar / restaurar logs)."""
+        self.flush()
+        with self.lock:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as fh:
+                for entry in entries:
+                    fh.write(json.dumps(entry, ensure_ascii=False, default=str) + "\n")
+                fh.flush()
+                os.fsync(fh.fileno())
+            os.replace(tmp_path, self.path)
+            self._needs_newline = False
+            self._segment_entries = sum(1 for entry in entries if self._counts(entry))
+            self._segment_started = _iso_to_epoch(entries[0].get("timestamp")) if entries else None
+
+    def _run(self):
+        with self.lock:
+            if self._should_rotate():
+                self._rotate()  # segmento heredado que ya supera los límites
+        while True:
+            item = self._queue.get()
+            batch, waiters, stop, counted = [], [], False, 0
+            while True:
+                if item is None:
+                    stop = True
+                elif isinstance(item, threading.Event):
+                    waiters.append(item)
+                else:
+                    batch.append(item[0])
+                    counted += item[1]
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            if batch:
+                try:
+                    with self.lock:
+                        if self._should_rotate(counted):
+                            self._rotate()
+                        with open(self.path, "a", encoding="utf-8") as fh:
+                            if self._needs_newline:
+                                fh.write("\n")  # aislar la línea truncada para que no corrompa la siguiente
+                                self._needs_newline = False
+                            fh.write("".join(batch))
+                            fh.flush()
+                            os.fsync(fh.fileno())
+                        if self._segment_started is None:
+                            try:
+                                self._segment_started = _iso_to_epoch(json.loads(batch[0]).get("timestamp"))
+                            except (ValueError, AttributeError):
+                                self._segment_started = time.time()
+                        self._segment_entries += counted
+                    self.written += len(batch)
+                    self.batches += 1
+                except Exception as e:
+                    logger.error("logs_save_error", error=str(e), lost=len(batch))
+            for waiter in waiters:
+                waiter.set()
+            if stop:
+                return
+
+class LogArchive:
+    """
+    (4.9) Archivo columnar de segmentos de log cerrados.
+    Cada segmento se compacta en un directorio con un `.npy` por columna (métricas
+    aplanadas, memory-mappable) y un manifiesto con el rango temporal de cada segmento.
+    Las lecturas cargan solo las columnas pedidas y los segmentos que solapan el rango.
+    """
+    COLUMNS = {
+        'timestamp': np.float64,          # epoch (s, UTC)
+        'total_time': np.float32,
+        'rag_time': np.float32,
+        'ttft': np.float32,
+        'tokens_per_sec': np.float32,
+        'prompt_tokens': np.int32,
+        'completion_tokens': np.int32,
+        'total_tokens': np.int32,
+        'faithfulness': np.float32,
+        'relevance': np.float32,
+        'context_precision': np.float32,
+        'context_count': np.int32,
+        'error_occurred': np.bool_,
+    }
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.manifest_path = os.path.join(directory, "manifest.json")
+        self._lock = threading.Lock()
+        self.segments = []
+        self.awaiting = {}  # (4.9c) id -> [segmento, fila] de entradas archivadas con evaluación pendiente
+        self.carried = []   # registros de evaluación cuya entrada aún no se compactó
+        if os.path.exists(self.manifest_path):
+            try:
+                with open(self.manifest_path, "r", encoding="utf-8") as fh:
+                    manifest = json.load(fh)
+                self.segments = manifest.get("segments", [])
+                self.awaiting = manifest.get("awaiting", {})
+                self.carried = manifest.get("carried", [])
+            except Exception as e:
+                logger.warning("log_archive", status="manifest_error", error=str(e))
+
+    @staticmethod
+    def flatten(entry):
+        """Valores de columna de una entrada de log (métricas anidadas aplanadas)."""
+        metrics = entry.get('metrics') or {}
+        tokens = metrics.get('tokens_used') or {}
+        return {
+            'timestamp': _iso_to_epoch(entry.get('timestamp')) or 0.0,
+            'total_time': metrics.get('total_time') or 0.0,
+            'rag_time': metrics.get('rag_time') or 0.0,
+            'ttft': metrics.get('ttft') or 0.0,
+            'tokens_per_sec': metrics.get('tokens_per_sec') or 0.0,
+            'prompt_tokens': tokens.get('prompt_tokens') or 0,
+            'completion_tokens': tokens.get('completion_tokens') or 0,
+            'total_tokens': tokens.get('total_tokens') or 0,
+            'faithfulness': metrics.get('faithfulness') or 0.0,
+            'relevance': metrics.get('relevance') or 0.0,
+            'context_precision': metrics.get('context_precision') or 0.0,
+            'context_count': entry.get('context_count') or 0,
+            'error_occurred': bool(entry.get('error_occurred')),
+        }
+
+    @classmethod
+    def columns_from_entries(cls, entries, columns=None):
+        """Columnas NumPy a partir de entradas en memoria (p. ej. el segmento activo)."""
+        columns = columns or list(cls.COLUMNS)
+        rows = [cls.flatten(e) for e in entries]
+        return {c: np.array([r[c] for r in rows], dtype=cls.COLUMNS[c]) for c in columns}
+
+    @property
+    def count(self):
+        return sum(seg['count'] for seg in self.segments)
+
+    @property
+    def last_timestamp(self):
+        return max((seg['end'] for seg in self.segments), default=None)
+
+    @classmethod
+    def _patch_values(cls, patch):
+        return {c: (v or 0.0) for c, v in (patch.get('metrics') or {}).items() if c in cls.COLUMNS}
+
+    def compact(self, segment_path, max_carried=10000):
+        """
+        Compacta un segmento JSONL cerrado (lectura en streaming) a columnas `.npy`. Los registros de
+        evaluación (4.9c) se aplican a su entrada: en el mismo segmento, en uno ya archivado que la
+        esperaba (`awaiting`, se reescriben sus columnas) o, si la entrada aún no se compactó, se
+        arrastran en el manifiesto (`carried`) a la compactación siguiente.
+        """
+        values = {c: [] for c in self.COLUMNS}
+        rows, pending = {}, set()
+        with self._lock:
+            patches = list(self.carried)
+        with open(segment_path, "r", encoding="utf-8") as fh:
+            for line in fh:
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                    if InteractionLog.is_evaluation(record):
+                        patches.append(record)
+                        continue
+                    row = self.flatten(record)
+                except (ValueError, AttributeError):
+                    continue
+                rows[record.get('id')] = len(values['timestamp'])
+                if (record.get('metrics') or {}).get('evaluation') == 'pending':
+                    pending.add(record.get('id'))
+                for c in self.COLUMNS:
+                    values[c].append(row[c])
+        name = os.path.splitext(os.path.basename(segment_path))[0]
+        earlier, carried = defaultdict(list), []
+        with self._lock:
+            awaiting = dict(self.awaiting)
+        for patch in patches:
+            entry_id = patch.get('id')
+            if entry_id in rows:
+                for c, v in self._patch_values(patch).items():
+                    values[c][rows[entry_id]] = v
+                pending.discard(entry_id)
+            elif entry_id in awaiting:
+                seg_name, row = awaiting.pop(entry_id)
+                earlier[seg_name].append((row, patch))
+            else:
+                carried.append(patch)
+        seg_dir = os.path.join(self.directory, name)
+        os.makedirs(seg_dir, exist_ok=True)
+        for c, dtype in self.COLUMNS.items():
+            np.save(os.path.join(seg_dir, f"{c}.npy"), np.array(values[c], dtype=dtype))
+        for seg_name, updates in earlier.items():
+            self._rewrite_rows(seg_name, updates)
+        ts = values['timestamp']
+        info = {'name': name, 'start': min(ts, default=0.0), 'end': max(ts, default=0.0), 'count': len(ts),
+                'source': segment_path}
+        with self._lock:
+            self.segments = [seg for seg in self.segments if seg['name'] != name] + [info]
+            self.segments.sort(key=lambda seg: seg['start'])
+            # Solo se esperan evaluaciones para el segmento anterior y este (las más viejas ya no llegarán)
+            keep = {seg['name'] for seg in self.segments[-2:]}
+            awaiting.update({entry_id: [name, rows[entry_id]] for entry_id in pending})
+            self.awaiting = {k: v for k, v in awaiting.items() if v[0] in keep}
+            self.carried = carried[-max_carried:]
+            tmp_path = self.manifest_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as fh:
+                json.dump({'columns': {c: np.dtype(d).name for c, d in self.COLUMNS.items()}, 'segments': self.segments,
+                           'awaiting': self.awaiting, 'carried': self.carried}, fh, indent=2)
+            os.replace(tmp_path, self.manifest_path)
+        logger.info("logs_compacted", segment=name, count=info['count'])
+        return info
+
+    def _rewrite_rows(self, seg_name, updates):
+        """Aplica registros de evaluación a filas de un segmento ya archivado (reescribe solo esas columnas)."""
+        seg_dir = os.path.join(self.directory, seg_name)
+        columns = {c for _, patch in updates for c in self._patch_values(patch)}
+        for c in columns:
+            col_path = os.path.join(seg_dir, f"{c}.npy")
+            if not os.path.exists(col_path):
+                continue
+            col = np.array(np.load(col_path))
+            for row, patch in updates:
+                value = self._patch_values(patch).get(c)
+                if value is not None and row < len(col):
+                    col[row] = value
+            tmp_path = col_path + ".tmp.npy"
+            np.save(tmp_path, col)
+            os.replace(tmp_path, col_path)
+
+    def compact_pending(self, segments_dir):
+        """Compacta segmentos cerrados que aún no figuran en el manifiesto (p. ej. tras un corte)."""
+        if not os.path.isdir(segments_dir):
+            return 0
+        done = {seg['name'] for seg in self.segments}
+        pending = [f for f in sorted(os.listdir(segments_dir)) if f.endswith(".jsonl") and f[:-len(".jsonl")] not in done]
+        for fname in pending:
+            self.compact(os.path.join(segments_dir, fname))
+        return len(pending)
+
+    def read(self, columns, since=None, until=None):
+        """Columnas pedidas de los segmentos que solapan [since, until) (epoch), vía memory-map."""
+        parts = {c: [] for c in columns}
+        for seg in list(self.segments):
+            if (since is not None and seg['end'] < since) or (until is not None and seg['start'] >= until):
+                continue
+            seg_dir = os.path.join(self.directory, seg['name'])
+            ts = np.load(os.path.join(seg_dir, "timestamp.npy"), mmap_mode="r")
+            mask = np.ones(len(ts), dtype=bool)
+            if since is not None:
+                mask &= ts >= since
+            if until is not None:
+                mask &= ts < until
+            for c in columns:
+                col_path = os.path.join(seg_dir, f"{c}.npy")
+                if not os.path.exists(col_path):
+                    # Columna añadida después de compactar este segmento
+                    parts[c].append(np.zeros(int(mask.sum()), dtype=self.COLUMNS[c]))
+                    continue
+                parts[c].append(np.asarray(np.load(col_path, mmap_mode="r")[mask]))
+        return {c: np.concatenate(parts[c]) if parts[c] else np.zeros(0, dtype=self.COLUMNS[c]) for c in columns}
+
+
+class QuantileSketch:
+    """
+    (4.9) Sketch de cuantiles en streaming con error relativo acotado (buckets logarítmicos).
+    `add` es O(1); la memoria depende del rango de valores, no del número de muestras.
+    """
+
+    def __init__(self, relative_accuracy=0.01, min_value=1e-4):
+        self.gamma = (1.0 + relative_accuracy) / (1.0 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.min_value = min_value
+        self.bins = defaultdict(int)
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, value, n=1):
+        if value <= self.min_value:
+            self.zero_count += n
+        else:
+            self.bins[math.ceil(math.log(value) / self._log_gamma)] += n
+        self.count += n
+
+    def merge(self, other):
+        """Acumula otro sketch con la misma precisión (p. ej. para combinar buckets por minuto)."""
+        for key, n in other.bins.items():
+            self.bins[key] += n
+        self.zero_count += other.zero_count
+        self.count += other.count
+
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for key in sorted(self.bins):
+            seen += self.bins[key]
+            if seen > rank:
+                return 2.0 * self.gamma ** key / (self.gamma + 1.0)
+        return 2.0 * self.gamma ** max(self.bins) / (self.gamma + 1.0)
+
+
+class MetricsRollup:
+    """
+    (4.9) Agregados incrementales para el dashboard: contadores, sumas, errores, RAG vs directo,
+    buckets por minuto y sketches de latencia. `add` es O(1) por interacción; `snapshot`
+    solo recorre los buckets del rango pedido, nunca el historial de logs.
+    """
+    SUM_FIELDS = ('total_time', 'rag_time', 'ttft', 'tokens_per_sec', 'prompt_tokens', 'completion_tokens', 'total_tokens',
+                  'faithfulness', 'relevance', 'context_precision')
+    GENERATION_FIELDS = ('ttft', 'tokens_per_sec')  # promedios sobre interacciones con generación
+    COLUMNS = ('timestamp',) + SUM_FIELDS + ('context_count', 'error_occurred')
+
+    def __init__(self, bucket_sec=60, retention_sec=7 * 86400):
+        self.bucket_sec = bucket_sec
+        self.retention_sec = retention_sec
+        self._lock = threading.Lock()
+        self.reset()
+
+    @classmethod
+    def _new_bucket(cls):
+        return {'count': 0, 'errors': 0, 'rag': 0, 'generated': 0, 'sums': dict.fromkeys(cls.SUM_FIELDS, 0.0),
+                'latency': QuantileSketch(), 'ttft': QuantileSketch()}
+
+    @classmethod
+    def _accumulate(cls, bucket, row):
+        bucket['count'] += 1
+        bucket['errors'] += 1 if row.get('error_occurred') else 0
+        bucket['rag'] += 1 if (row.get('context_count') or 0) > 0 else 0
+        for field in cls.SUM_FIELDS:
+            bucket['sums'][field] += float(row.get(field) or 0.0)
+        bucket['latency'].add(float(row.get('total_time') or 0.0))
+        if row.get('ttft'):
+            # Solo interacciones con generación LLM (las bloqueadas no tienen TTFT)
+            bucket['generated'] += 1
+            bucket['ttft'].add(float(row['ttft']))
+
+    def reset(self):
+        with self._lock:
+            self.total = self._new_bucket()
+            self.buckets = OrderedDict()  # inicio del minuto (epoch) -> bucket
+            self.newest = None
+
+    def add(self, row):
+        """Suma una interacción aplanada (ver `LogArchive.flatten`)."""
+        ts = float(row.get('timestamp') or 0.0)
+        key = int(ts // self.bucket_sec) * self.bucket_sec
+        with self._lock:
+            self._accumulate(self.total, row)
+            self.newest = key if self.newest is None else max(self.newest, key)
+            cutoff = self.newest - self.retention_sec
+            if key >= cutoff:
+                bucket = self.buckets.get(key)
+                if bucket is None:
+                    bucket = self.buckets[key] = self._new_bucket()
+                self._accumulate(bucket, row)
+            while self.buckets and next(iter(self.buckets)) < cutoff:
+                self.buckets.popitem(last=False)
+
+    def add_entry(self, entry):
+        self.add(LogArchive.flatten(entry))
+
+    def amend(self, before, after):
+        """(4.9c) Corrige las sumas de una interacción ya agregada (p. ej. puntajes evaluados después)."""
+        deltas = {f: float(after.get(f) or 0.0) - float(before.get(f) or 0.0) for f in self.SUM_FIELDS}
+        key = int(float(after.get('timestamp') or 0.0) // self.bucket_sec) * self.bucket_sec
+        with self._lock:
+            for bucket in (self.total, self.buckets.get(key)):
+                if bucket is not None:
+                    for field, delta in deltas.items():
+                        bucket['sums'][field] += delta
+
+    def add_columns(self, columns):
+        """Siembra los agregados desde columnas NumPy (archivo columnar + segmento activo)."""
+        names = [c for c in self.COLUMNS if c in columns]
+        for values in zip(*(columns[c].tolist() for c in names)):
+            self.add(dict(zip(names, values)))
+
+    def snapshot(self, since=None):
+        """Resumen para el dashboard (todo el historial o los buckets desde `since`)."""
+        with self._lock:
+            if since is None:
+                agg = self.total
+            else:
+                agg = self._new_bucket()
+                for key, bucket in self.buckets.items():
+                    if key + self.bucket_sec > since:
+                        agg['count'] += bucket['count']
+                        agg['errors'] += bucket['errors']
+                        agg['rag'] += bucket['rag']
+                        agg['generated'] += bucket['generated']
+                        for field in self.SUM_FIELDS:
+                            agg['sums'][field] += bucket['sums'][field]
+                        agg['latency'].merge(bucket['latency'])
+                        agg['ttft'].merge(bucket['ttft'])
+            timeline = [
+                {'minute': key, 'count': b['count'], 'errors': b['errors'],
+                 'avg_latency': b['sums']['total_time'] / b['count']}
+                for key, b in self.buckets.items() if since is None or key + self.bucket_sec > since
+            ]
+            count = agg['count']
+            return {
+                'count': count,
+                'errors': agg['errors'],
+                'error_rate': agg['errors'] / count if count else 0.0,
+                'rag': agg['rag'],
+                'direct': count - agg['rag'],
+                'sums': dict(agg['sums']),
+                'means': {f: (agg['sums'][f] / denom if denom else 0.0)
+                          for f in self.SUM_FIELDS
+                          for denom in [agg['generated'] if f in self.GENERATION_FIELDS else count]},
+                'latency_quantiles': {q: agg['latency'].quantile(q) for q in (0.5, 0.95, 0.99)},
+                'ttft_quantiles': {q: agg['ttft'].quantile(q) for q in (0.5, 0.95, 0.99)},
+                'timeline': sorted(timeline, key=lambda t: t['minute']),
+            }
+
+
+class InteractionLog:
+    """
+    (4.9) Registro de interacciones del proceso, compartido por todas las sesiones (`get_interaction_log`):
+    un único escritor append-only de `logs.jsonl` (con segmentos y archivo columnar), la ventana
+    reciente en memoria y los agregados del dashboard. `lock` protege la ventana y los agregados
+    frente al hilo de evaluación y a las otras sesiones.
+    """
+
+    def __init__(self, data_dir="data"):
+        self.lock = threading.Lock()
+        try:
+            os.makedirs(data_dir, exist_ok=True)
+        except Exception:
+            pass
+        self.path = os.path.join(data_dir, "logs.jsonl")          # Log append-only (JSONL)
+        self.legacy_path = os.path.join(data_dir, "logs.json")    # Formato anterior (se migra al iniciar)
+        self.segments_dir = os.path.join(data_dir, "logs", "segments")        # Segmentos cerrados (JSONL)
+        self.archive = LogArchive(os.path.join(data_dir, "logs", "archive"))  # Columnas compactadas
+        self.writer = None
+        self.entries = deque(maxlen=log_segment_max_entries)  # Ventana reciente (segmento activo)
+        try:
+            self.archive.compact_pending(self.segments_dir)
+        except Exception as e:
+            logger.warning("log_archive", status="compaction_error", error=str(e))
+        # Cargar logs existentes si están presentes
+        try:
+            self.load()
+        except Exception:
+            # No fallar la inicialización si la carga falla
+            pass
+        self.rollup = MetricsRollup()  # Agregados O(1) por interacción para el dashboard
+        self.rebuild_rollup()
+
+    def get_writer(self):
+        """Escritor JSONL en segundo plano asociado a `self.path`."""
+        if self.writer is None or self.writer.path != self.path:
+            self.writer = AppendOnlyLogWriter(
+                self.path, segments_dir=self.segments_dir, max_entries=log_segment_max_entries,
+                max_bytes=log_segment_max_bytes, max_age_sec=log_segment_max_hours * 3600,
+                on_rotate=self.archive.compact, counts=lambda record: not self.is_evaluation(record))
+        return self.writer
+
+    def add(self, entry, persisted):
+        """Agrega `entry` a la ventana y los agregados, y encola `persisted` (enmascarada) en disco."""
+        with self.lock:
+            self.entries.append(entry)
+            self.rollup.add_entry(entry)
+            writer = self.get_writer()
+        writer.append(persisted)
+
+    def update_metrics(self, entry_id, values):
+        """
+        (4.9c) Agrega métricas calculadas después del registro (evaluación en segundo plano) a la
+        entrada `entry_id` de la ventana y a los agregados, y las persiste como un registro de
+        evaluación (`{'type': 'evaluation', 'id', 'metrics'}`) que `load` y la compactación aplican.
+        """
+        with self.lock:
+            entry = next((e for e in reversed(self.entries) if e.get('id') == entry_id), None)
+            if entry is not None:
+                before = LogArchive.flatten(entry)
+                entry['metrics'] = {**(entry.get('metrics') or {}), **values}
+                self.rollup.amend(before, LogArchive.flatten(entry))
+            writer = self.get_writer()
+        writer.append({'type': 'evaluation', 'id': entry_id, 'timestamp': datetime.utcnow().isoformat(),
+                       'metrics': values})
+        return entry is not None
+
+    def evaluation(self, entry_id):
+        """(4.9c) Copia de las métricas de `entry_id` si sigue en la ventana y ya fue evaluada; si no, None."""
+        with self.lock:
+            entry = next((e for e in reversed(self.entries) if e.get('id') == entry_id), None)
+            metrics = dict(entry.get('metrics') or {}) if entry is not None else {}
+        return metrics if metrics.get('evaluation') == 'done' else None
+
+    @staticmethod
+    def is_evaluation(record):
+        return isinstance(record, dict) and record.get('type') == 'evaluation'
+
+    @classmethod
+    def merge_evaluations(cls, records):
+        """Entradas de `records` con sus registros de evaluación aplicados (en el orden original)."""
+        entries, by_id = [], {}
+        for record in records:
+            if cls.is_evaluation(record):
+                entry = by_id.get(record.get('id'))
+                if entry is not None:
+                    entry['metrics'] = {**(entry.get('metrics') or {}), **(record.get('metrics') or {})}
+                continue
+            entries.append(record)
+            if isinstance(record, dict) and record.get('id'):
+                by_id[record['id']] = record
+        return entries
+
+    def recent(self):
+        """Copia de la ventana reciente."""
+        with self.lock:
+            return list(self.entries)
+
+    def snapshot(self, since=None):
+        """Agregados del dashboard desde `since` (ver `MetricsRollup.snapshot`)."""
+        with self.lock:
+            return self.rollup.snapshot(since=since)
+
+    def read_columns(self, columns, since=None, until=None):
+        """
+        Métricas aplanadas en columnas NumPy para el rango [since, until) (epoch):
+        segmentos archivados (memory-mapped) + entradas del segmento activo en memoria.
+        """
+        columns = list(dict.fromkeys(list(columns) + ['timestamp']))
+        archived = self.archive.read(columns, since=since, until=until)
+        last = self.archive.last_timestamp
+        active = LogArchive.columns_from_entries(
+            [e for e in self.recent() if last is None or (_iso_to_epoch(e.get('timestamp')) or 0.0) > last], columns)
+        mask = np.ones(len(active['timestamp']), dtype=bool)
+        if since is not None:
+            mask &= active['timestamp'] >= since
+        if until is not None:
+            mask &= active['timestamp'] < until
+        return {c: np.concatenate([archived[c], active[c][mask]]) for c in columns}
+
+    def rebuild_rollup(self):
+        """Recalcula los agregados del dashboard desde el archivo columnar y el segmento activo."""
+        try:
+            columns = self.read_columns(MetricsRollup.COLUMNS)
+            with self.lock:
+                self.rollup.reset()
+                self.rollup.add_columns(columns)
+            logger.info("rollup_rebuilt", count=self.rollup.total['count'])
+        except Exception as e:
+            logger.warning("rollup_rebuild_error", error=str(e))
 
-    # -----------------------------
-    # 4.2 Documentos Base (Hospital)
-    # -----------------------------
-    def initialize_hospital_documents(self) -> bool:
-        """Carga documentos por defecto (fuente interna)."""
+    def rewrite(self, entries, persisted):
+        """Sustituye la ventana por `entries` y reescribe el log completo con `persisted` (ya enmascaradas)."""
+        with self.lock:
+            self.entries = deque(entries, maxlen=log_segment_max_entries)
+            writer = self.get_writer()
+        writer.rewrite(persisted)
+        self.rebuild_rollup()
+
+    def load(self):
+        """Carga logs desde `self.path` (JSONL, línea a línea); migra el `logs.json` antiguo si es necesario."""
+        if not os.path.exists(self.path) and os.path.exists(self.legacy_path):
+            self._migrate_legacy()
+        if os.path.exists(self.path):
+            try:
+                records = []
+                with open(self.path, "r", encoding="utf-8") as fh:
+                    for line_no, line in enumerate(fh, 1):
+                        if not line.strip():
+                            continue
+                        try:
+                            records.append(json.loads(line))
+                        except json.JSONDecodeError:
+                            # Línea incompleta (p. ej. corte durante una escritura): se omite
+                            logger.warning("logs_load_skip", path=self.path, line=line_no)
+                # (4.9c) Los registros de evaluación completan su entrada
+                self.entries = deque(self.merge_evaluations(records), maxlen=log_segment_max_entries)
+                logger.info("logs_loaded", path=self.path, count=len(self.entries))
+                return True
+            except Exception as e:
+                logger.error("logs_load_error", error=str(e))
+                raise
+        return False
+
+    def _migrate_legacy(self):
+        """Convierte el arreglo JSON de `logs.json` al formato JSONL (una vez; el original se conserva)."""
         try:
-            docs = [
-                "El Hospital Barros Luco ubicado en Santiago de Chile cuenta con los siguientes servicios: Emergencias 24/7, Cuidados Intensivos (UCI), Cardiología, Neurología, Pediatría, Ginecología y Obstetricia, Oncología, Ortopedia y Traumatología, Radiología e Imágenes, Laboratorio Clínico, Farmacia, y Rehabilitación Física.",
-                "Horarios de atención: Emergencias 24 horas. Consultas externas: Lunes a Viernes 7:00 AM - 6:00 PM, Sábados 8:00 AM - 2:00 PM. Teléfono principal: (01) 234-5678. Emergencias: 911. Dirección: Av. Salud 123, Lima, Perú.",
-                "Protocolo de emergencias: En caso de emergencia médica, dirigirse inmediatamente al área de Emergencias en el primer piso. El personal de triaje evaluará la urgencia. Código Azul: Paro cardiorrespiratorio. Código Rojo: Emergencia médica. Código Amarillo: Emergencia quirúrgica.",
-                "Proceso de hospitalización: 1) Admisión con documento de identidad y seguro médico. 2) Evaluación médica inicial. 3) Asignación de habitación según disponibilidad. 4) Entrega de brazalete de identificación. 5) Orientación sobre normas hospitalarias. Horarios de visita: 2:00 PM - 4:00 PM y 6:00 PM - 8:00 PM.",
-                "El uso de IA en radiología ayuda a detectar anomalías en imágenes médicas con mayor precisión. Nuestro Hospital Barros Luco utiliza sistemas de inteligencia artificial para análisis de radiografías, tomografías y resonancias magnéticas, lo que permite diagnósticos más rápidos y exactos.",
-                "La telemedicina permite realizar consultas médicas a distancia, mejorando el acceso en zonas rurales. El Hospital Barros Luco ofrece servicios de teleconsulta para seguimiento de pacientes crónicos, consultas de especialidades y orientación médica inicial.",
-            ]
-            self.documents = docs
-            self.embeddings = None
-            self.embedding_matrix = None
-            logger.info("data_load", status="success", doc_count=len(docs), message="Documentos del hospital cargados")
+            with open(self.legacy_path, "r", encoding="utf-8") as fh:
+                data = json.load(fh)
+            if not isinstance(data, list):
+                return False
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as fh:
+                for entry in data:
+                    fh.write(json.dumps(entry, ensure_ascii=False, default=str) + "\n")
+            os.replace(tmp_path, self.path)
+            logger.info("logs_migrated", source=self.legacy_path, path=self.path, count=len(data))
             return True
         except Exception as e:
-            logger.error("data_load", status="error", message=f"Error inicializando documentos: {e}")
-            st.warning(f"⚠ Error inicializando documentos: {e}")
+            logger.error("logs_migration_error", error=str(e))
             return False
 
-    # -----------------------------
-    # 4.3 Embeddings y Recuperación
-    # -----------------------------
-    def _github_post(self, path, payload):
-        """POST genérico a GitHub inference (modo alternativo)."""
-        url = f"{self.github_inference_url.rstrip('/')}/{path.lstrip('/')}"
-        headers = {
-            "Authorization": f"Bearer {self.github_token}",
-            "Accept": "application/json",
-            "Content-Type": "application/json",
-        }
-        resp = requests.post(url, headers=headers, json=payload, timeout=30)
-        resp.raise_for_status()
-        return resp.json()
 
-    def get_embeddings(self, documents):
-        """Genera embeddings usando OpenAI SDK o GitHub inference (según modo)."""
+@st.cache_resource
+def get_interaction_log():
+    """(4.9) Un solo registro de interacciones por proceso (un único escritor de `data/logs.jsonl`)."""
+    return InteractionLog()
+
+
+class ChatConversation:
+    """
+    (4.9) Historial de una conversación en `messages/<id>.jsonl`: cada mensaje se agrega con el
+    escritor append-only (nunca se reescribe el archivo) con un número de secuencia `seq`. Las
+    páginas se leen hacia atrás desde el final del archivo por bloques, así cargar una página
+    anterior no depende del largo del historial.
+    """
+
+    def __init__(self, path, block_bytes=64 * 1024, max_cursors=1024):
+        self.path = path
+        self.block_bytes = block_bytes
+        self.max_cursors = max_cursors
+        self.lock = threading.Lock()
+        self.writer = None
+        self._cursors = OrderedDict()  # seq -> offset (bytes) de su línea, en los bordes de página ya leídos
+        last = self._read_back(self._size(), 1)[0]
+        self.next_seq = last[-1]['seq'] + 1 if last else 0
+
+    def _size(self):
         try:
-            if getattr(self, "github_mode", False):
-                start_time = time.time()
-                payload = {"model": self.embeddings_model, "input": documents}
-                resp = self._github_post("embeddings", payload)
-                # Adaptación según formato: intentar claves comunes
-                embs = [item.get("embedding") or item.get("vector") for item in resp.get("data", [])]
-            else:
-                if not self.client:
-                    return None
-                start_time = time.time()
-                resp = self.client.embeddings.create(model=self.embeddings_model, input=documents)
-                embs = [d.embedding for d in resp.data]
-            self.embeddings = embs
-            self.embedding_matrix = np.array(embs, dtype=float)
-            duration = time.time() - start_time
-            logger.info("tool_call", tool="embedding_generation", status="success", duration_sec=duration, doc_count=len(documents))
-            return embs
-        except Exception as e:
-            self.error_count += 1
-            logger.error("tool_call", tool="embedding_generation", status="error", error=str(e), doc_count=len(documents))
-            st.warning(f"⚠ Error generando embeddings: {e}")
-            return None
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
 
-    def get_query_embedding(self, query):
+    def append(self, role, content):
+        """Agrega un mensaje al historial (en segundo plano) y lo devuelve con su `seq`."""
+        with self.lock:
+            message = {'seq': self.next_seq, 'timestamp': datetime.utcnow().isoformat(), 'role': role, 'content': content}
+            self.next_seq += 1
+            if self.writer is None:
+                self.writer = AppendOnlyLogWriter(self.path)
+            writer = self.writer
+        writer.append(message)
+        return message
+
+    def page(self, before_seq=None, limit=20):
+        """Hasta `limit` mensajes (en orden) anteriores a `before_seq` (None = los últimos del historial)."""
+        if self.writer is not None:
+            self.writer.flush()
+        with self.lock:
+            end = self._cursors.get(before_seq) if before_seq is not None else None
+        messages, offset = self._read_back(self._size() if end is None else end, limit, before_seq)
+        if messages:
+            with self.lock:
+                self._cursors[messages[0]['seq']] = offset
+                self._cursors.move_to_end(messages[0]['seq'])
+                while len(self._cursors) > self.max_cursors:
+                    self._cursors.popitem(last=False)
+        return messages
+
+    def close(self):
+        with self.lock:
+            writer, self.writer = self.writer, None
+        if writer is not None:
+            writer.close()
+
+    def _read_back(self, end, limit, before_seq=None):
+        """Mensajes válidos (hasta `limit`, con seq < `before_seq`) que terminan antes del byte `end`, y el offset del primero."""
+        found, pos, carry = [], end, b""
         try:
-            if getattr(self, "github_mode", False):
-                payload = {"model": self.embeddings_model, "input": [query]}
-                resp = self._github_post("embeddings", payload)
-                emb = (resp.get("data") or [{}])[0].get("embedding") or (resp.get("data") or [{}])[0].get("vector")
-                return np.array(emb, dtype=float)
-            else:
-                if not self.client:
-                    return None
-                resp = self.client.embeddings.create(model=self.embeddings_model, input=[query])
-                emb = resp.data[0].embedding
-                return np.array(emb, dtype=float)
-        except Exception as e:
-            self.error_count += 1
-            logger.error("tool_call", tool="query_embedding", status="error", error=str(e))
-            st.warning(f"⚠ Error obteniendo embedding de la query: {e}")
-            return None
+            with open(self.path, "rb") as fh:
+                while len(found) < limit and (pos > 0 or carry):
+                    step = min(self.block_bytes, pos)
+                    pos -= step
+                    fh.seek(pos)
+                    chunk = fh.read(step) + carry
+                    lines = chunk.split(b"\n")
+                    carry = lines.pop(0) if pos > 0 else b""  # primera línea posiblemente incompleta
+                    start = pos + len(chunk)
+                    for line in reversed(lines):
+                        start -= len(line)
+                        try:
+                            message = json.loads(line) if line.strip() else None
+                        except ValueError:
+                            message = None  # línea truncada (corte durante una escritura)
+                        if isinstance(message, dict) and 'seq' in message and (before_seq is None or message['seq'] < before_seq):
+                            found.append((start, message))
+                            if len(found) >= limit:
+                                break
+                        start -= 1
+        except OSError:
+            return [], 0
+        found.reverse()
+        return [m for _, m in found], (found[0][0] if found else 0)
 
-    def hybrid_search_with_metrics(self, query, top_k=3):
-        """Búsqueda híbrida (semantic + lexical) + latencia."""
-        start = time.time()
+
+class ChatMessageStore:
+    """
+    (4.9) Historiales del chat del proceso (`get_message_store`), uno por conversación: cada
+    sesión escribe y lee solo `data/messages/<conversation_id>.jsonl`, nunca el de otra. Se
+    mantienen abiertas hasta `max_open` conversaciones (LRU); al expulsar una se cierra su
+    escritor y se vuelve a abrir desde el archivo si la sesión sigue activa. Los archivos sin
+    actividad en `retention_days` se borran (como mucho una pasada cada `cleanup_interval` s).
+    """
+    ID_RE = re.compile(r"[0-9a-f]{32}")
+
+    def __init__(self, data_dir="data", max_open=64, retention_days=None, cleanup_interval=3600.0, **conversation_options):
+        self.dir = os.path.join(data_dir, "messages")
         try:
-            if not self.documents or self.embedding_matrix is None:
-                logger.warning("rag_search", status="skipped", reason="No documents/embeddings available")
-                return [], 0.0
+            os.makedirs(self.dir, exist_ok=True)
+        except Exception:
+            pass
+        self.max_open = max_open
+        self.conversation_options = conversation_options
+        self.lock = threading.Lock()
+        self._open = OrderedDict()  # conversation_id -> ChatConversation
+        retention_days = chat_retention_days if retention_days is None else retention_days
+        self.retention_sec = retention_days * 86400.0 if retention_days > 0 else None
+        self.cleanup_interval = cleanup_interval
+        self._next_cleanup = 0.0
+        # Formatos anteriores: un único historial mezclado de todas las sesiones; no se carga en ninguna
+        for legacy in ("messages.json", "messages.jsonl"):
+            if os.path.exists(os.path.join(data_dir, legacy)):
+                logger.warning("messages_legacy_ignored", path=os.path.join(data_dir, legacy))
 
-            q_emb = self.get_query_embedding(query)
-            if q_emb is None:
-                return [], 0.0
-            sims = cosine_similarity(self.embedding_matrix, q_emb.reshape(1, -1)).reshape(-1)
-            q_words = set([w.strip(".,?¡!():;\"'").lower() for w in query.split() if len(w) > 2])
-            results = []
-            for idx, doc in enumerate(self.documents):
-                doc_words = set([w.strip(".,?¡!():;\"'").lower() for w in doc.split() if len(w) > 2])
-                lexical = 0.0
-                if q_words:
-                    lexical = len(q_words.intersection(doc_words)) / max(1, len(q_words))
-                semantic = float(sims[idx])
-                combined = 0.7 * semantic + 0.3 * lexical
-                results.append({
-                    'id': idx,
-                    'document': doc,
-                    'semantic_score': semantic,
-                    'lexical_score': lexical,
-                    'combined_score': combined
-                })
-            results = sorted(results, key=lambda x: x['combined_score'], reverse=True)[:top_k]
-            retrieval_time = time.time() - start
-            logger.info("rag_search", status="success", duration_sec=retrieval_time, top_k=top_k)  # IL3.2: Trazabilidad
-            return results, retrieval_time
-        except Exception as e:
-            self.error_count += 1
-            logger.error("rag_search", status="error", error=str(e))
-            st.warning(f"⚠ Error en búsqueda híbrida: {e}")
-            return [], 0.0
+    @staticmethod
+    def new_conversation_id():
+        return uuid.uuid4().hex
 
-    # -----------------------------
-    # 4.4 Generación de Respuesta LLM
-    # -----------------------------
-    def generate_response_with_metrics(self, query, context):
-        """Genera respuesta LLM con contexto y reporta uso de tokens."""
-        start = time.time()
-        tokens_used = {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0}
+    @classmethod
+    def is_valid_id(cls, conversation_id):
+        return isinstance(conversation_id, str) and cls.ID_RE.fullmatch(conversation_id) is not None
+
+    def cleanup(self, now=None):
+        """Borra las conversaciones cerradas sin escrituras en `retention_days`. Devuelve cuántas."""
+        if self.retention_sec is None:
+            return 0
+        cutoff = (time.time() if now is None else now) - self.retention_sec
+        removed = 0
         try:
-            prompt = f"Contexto:\n{context}\n\nPregunta: {query}\n\nResponda de forma clara y concisa:"
-            if getattr(self, "github_mode", False):
-                # Llamada simple al endpoint de chat/completions de GitHub (modo inferencia)
-                payload = {
-                    "model": self.llm_model,
-                    "messages": [{"role": "user", "content": prompt}],
-                    "temperature": 0.1,
-                    "max_tokens": 600
-                }
-                resp = self._github_post("chat/completions", payload)
-                # Adaptar según respuesta: intento de extracción común
-                response_text = (resp.get("choices") or [{}])[0].get("message", {}).get("content") or (resp.get("choices") or [{}])[0].get("text")
-                usage = resp.get("usage", {}) or {}
-            else:
-                chat_resp = self.client.chat.completions.create(  # Llamada SDK OpenAI/Azure
-                    model=self.llm_model,
-                    messages=[{"role": "user", "content": prompt}],
-                    temperature=0.1,
-                    max_tokens=600
-                )
-                response_text = chat_resp.choices[0].message.content
-                usage = getattr(chat_resp, "usage", {}) or {}
-
-            if usage:
-                tokens_used = {
-                    'prompt_tokens': usage.get('prompt_tokens', 0),
-                    'completion_tokens': usage.get('completion_tokens', 0),
-                    'total_tokens': usage.get('total_tokens', 0)
-                }
-            generation_time = time.time() - start
-            logger.info("llm_generation", status="success", duration_sec=generation_time, **tokens_used)
-            return response_text or "", generation_time, context, tokens_used
-        except Exception as e:
-            self.error_count += 1
-            logger.error("llm_generation", status="error", error=str(e), prompt_length=len(prompt))  # Error generando respuesta LLM
-            generation_time = time.time() - start
-            return f"Error generando respuesta: {e}", generation_time, context, tokens_used
+            with os.scandir(self.dir) as entries:
+                candidates = [e for e in entries if e.name.endswith(".jsonl") and e.stat().st_mtime < cutoff]
+        except OSError:
+            return 0
+        for entry in candidates:
+            with self.lock:
+                if entry.name[:-len(".jsonl")] in self._open:
+                    continue  # la sesión sigue activa
+                try:
+                    os.remove(entry.path)
+                    removed += 1
+                except OSError:
+                    pass
+        if removed:
+            logger.info("messages_cleanup", removed=removed, retention_days=self.retention_sec / 86400.0)
+        return removed
 
-    # -----------------------------
-    # 4.5 Seguridad y Ética (IL3.3 / IE6)
-    # -----------------------------
-    def sanitize_input(self, user_input):
-        """
-        IE6: Saneamiento de input para mitigar Prompt Injection y XSS (aunque es menos relevante aquí).
-        Remueve caracteres peligrosos y detecta patrones de inyección.
-        """
-        # Patrón simple para detectar intento de inyección de prompt
-        injection_patterns = r"(\bignora\s+las\s+instrucciones\b|\bactua\s+como\b|\bdesactiva\s+el\s+filtro\b)"
+    def conversation(self, conversation_id):
+        """`ChatConversation` de `conversation_id` (abre su archivo si no estaba abierta)."""
+        if not self.is_valid_id(conversation_id):
+            raise ValueError(f"Id de conversación inválido: {conversation_id!r}")
+        evicted, cleanup = [], False
+        with self.lock:
+            conversation = self._open.get(conversation_id)
+            if conversation is None:
+                now = time.time()
+                cleanup = now >= self._next_cleanup
+                if cleanup:
+                    self._next_cleanup = now + self.cleanup_interval
+                conversation = ChatConversation(os.path.join(self.dir, f"{conversation_id}.jsonl"),
+                                                **self.conversation_options)
+                self._open[conversation_id] = conversation
+            self._open.move_to_end(conversation_id)
+            while len(self._open) > self.max_open:
+                evicted.append(self._open.popitem(last=False)[1])
+        for old in evicted:
+            old.close()
+        if cleanup:
+            self.cleanup()
+        return conversation
 
-        if re.search(injection_patterns, user_input, re.IGNORECASE):
-            logger.warning("security_violation", type="prompt_injection", input=user_input[:50], action="blocked_sanitized")
-            # Reemplazar patrones para neutralizar
-            user_input = re.sub(injection_patterns, "consulta sobre el hospital", user_input, flags=re.IGNORECASE)
+    def append(self, conversation_id, role, content):
+        return self.conversation(conversation_id).append(role, content)
 
-        # Saneamiento general de caracteres potencialmente peligrosos (ej. para XSS o inyección)
-        cleaned_input = re.sub(r'[<>{}\[\]\&|;`\$]', '', user_input)
+    def page(self, conversation_id, before_seq=None, limit=20):
+        return self.conversation(conversation_id).page(before_seq, limit)
 
-        return cleaned_input
 
-    def ethical_check(self, query):
-        """
-        IE6: Filtro ético para contenido dañino o fuera de alcance médico.
-        """
-        prohibited_keywords = [
-            "suicid", "suicidi", "matarme", "morir", "muerte",  # Salud mental crítica
-            "hackear", "hack", "exploit", "vulnerabilidad",  # Seguridad
-            "violencia", "violen", "agredir", "golpear", "matar", "dañ", "herir", "lastim", "pegar",  # Violencia y daño
-            "terrorismo", "terrorista", "bomba", "explosivo", "atentado",  # Terrorismo
-            "droga", "cocaína", "heroína", "metanfetamina", "narcotraf",  # Drogas ilegales
-            "arma", "pistola", "rifle", "ametralladora", "cuchillo"  # Armas
-        ]
-        for keyword in prohibited_keywords:
-            if keyword in query.lower():
-                logger.warning("ethical_violation", type="harmful_content", keyword=keyword, query=query[:50], action="blocked")
-                # Mensaje con recursos de ayuda
-                return False, (
-                    "Lo siento, no puedo ayudar con ese tipo de consultas. "
-                    "Si estás pasando por un momento difícil, por favor contacta:\n\n"
-                    "🆘 **Salud Responde (Minsal Chile)**: 600 360 7777\n"
-                    "🆘 **Línea de Prevención del Suicidio**: 1412 (24/7 gratuito)\n"
-                    "🆘 **Urgencias Hospital Barros Luco**: +56 2 2576 2000\n\n"
-                    "Para consultas sobre servicios del hospital, pregúntame sobre horarios, ubicaciones o procedimientos administrativos."
-                )
+@st.cache_resource
+def get_message_store():
+    """(4.9) Historiales del chat del proceso (un archivo y un escritor por conversación abierta)."""
+    return ChatMessageStore()
 
-        # IE6: Advertencia para temas sensibles (Consejo Legal/Financiero/Específico no médico)
-        sensitive_keywords = ["inversión", "abogado", "ley", "demanda"]
-        for keyword in sensitive_keywords:
-            if keyword in query.lower():
-                return True, "Consulta sobre el Hospital Barros Luco"  # Permite la consulta pero con un tema neutral
 
-        return True, None
+ # ==============================================================
+ # 4.9b TRAZAS (tramos anidados por etapa, histogramas de latencia, exportación JSONL)
+ # ==============================================================
+_active_span = contextvars.ContextVar("atlas_active_span", default=None)
 
-    # -------------------------
-    # Lógica central del Agente (ReAct-like)
-    # -------------------------
-    # -----------------------------
-    # 4.6 Lógica Central (Decisión RAG / Directo)
-    # -----------------------------
-    def run_agent_logic(self, query):
-        """Decide vía heurística si aplica RAG y calcula métricas finales."""
-        # IL3.3: 1. Seguridad y Ética
-        cleaned_query = self.sanitize_input(query)
-        is_ethical, ethical_message = self.ethical_check(cleaned_query)
 
-        if not is_ethical:
-            metrics = {'total_time': 0.0, 'faithfulness': 0.0, 'relevance': 0.0, 'context_precision': 0.0}
-            self.log_interaction(query, ethical_message, metrics, [], error_occurred=True)
-            return ethical_message, metrics, []
+class LatencyHistogram:
+    """
+    (4.9b) Histograma de latencias con buckets fijos (segundos): `observe` es O(log nº de buckets)
+    y la memoria no crece con las muestras. Los cuantiles se interpolan dentro del bucket.
+    """
+    BOUNDS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
 
-        low = cleaned_query.lower()
-        rag_keywords = ["horari", "protocolo", "servicio", "emerg", "urgenc", "hospital", "teléfono", "telefono", "direcci", "ubicac", "consulta", "cita"]
-        use_rag = any(k in low for k in rag_keywords)
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)  # el último bucket es (60 s, inf)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
 
-        context_text = ""
-        results = []
-        rag_time = 0.0
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
 
-        # IL3.2: Trazabilidad de Decisión (Simulación ReAct)
-        if use_rag and self.embeddings is not None:
-            logger.info("agent_decision", action="use_tool", tool="RAG_Tool", reasoning="Keyword match (hospital related)")
-            results, rag_time = self.hybrid_search_with_metrics(cleaned_query, top_k=3)
-            if results:
-                context_text = "\n\n".join([f"Fuente {r['id']+1}: {r['document']}" for r in results])
-        else:
-            logger.info("agent_decision", action="llm_direct", tool="none", reasoning="General or non-hospital query")
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank, seen = q * self.count, 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lo = self.BOUNDS[i - 1] if i else 0.0
+                hi = self.BOUNDS[i] if i < len(self.BOUNDS) else self.max
+                return min(lo + (hi - lo) * (rank - seen) / n, self.max)
+            seen += n
+        return self.max
 
-        # Generar respuesta con (posible) contexto
-        total_start = time.time()
-        response, generation_time, _, tokens_used = self.generate_response_with_metrics(cleaned_query, context_text)
-        total_time = (time.time() - total_start) + rag_time
+    def summary(self):
+        return {'count': self.count, 'mean': self.total / self.count if self.count else 0.0,
+                'p50': self.quantile(0.5), 'p95': self.quantile(0.95), 'p99': self.quantile(0.99), 'max': self.max}
 
-        # IL3.1: Evaluaciones de Calidad (Precisión, Consistencia)
-        faith = self.evaluate_faithfulness(cleaned_query, context_text, response)
-        rel = self.evaluate_relevance(cleaned_query, response)
-        ctx_prec = self.evaluate_context_precision(cleaned_query, results) if results else 0.0
 
-        metrics = {
-            'total_time': total_time,
-            'faithfulness': faith,
-            'relevance': rel,
-            'context_precision': ctx_prec,
-            'tokens_used': tokens_used,  # IL3.1: Uso de Recursos
-            'rag_time': rag_time
-        }
+class Span:
+    """
+    (4.9b) Tramo de una traza: nombre, padre, duración y atributos (tamaños de solicitud, tokens...).
+    `with span:` lo activa (los `trace_span` abiertos dentro, también en tareas e hilos de
+    `asyncio.to_thread`, quedan como hijos) y lo termina al salir. Si el tramo abarca `yield`s
+    de un generador asíncrono se termina con `end()` y solo se activa con `activate()` en tramos
+    sin `yield` (cada paso del generador puede correr en otro contexto).
+    """
+    __slots__ = ("tracer", "name", "trace_id", "span_id", "parent_id", "started", "attrs", "duration", "error",
+                 "_t0", "_token")
 
-        # IE3: Log de interacción final
-        self.log_interaction(query, response, metrics, results, error_occurred=False)
+    def __init__(self, tracer, name, trace_id=None, parent_id=None, attrs=None):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id or uuid.uuid4().hex[:16]
+        self.span_id = uuid.uuid4().hex[:8]
+        self.parent_id = parent_id
+        self.started = time.time()
+        self.attrs = attrs or {}
+        self.duration = None
+        self.error = None
+        self._t0 = time.perf_counter()
+        self._token = None
 
-        # IE6: Adjuntar advertencia ética (si aplica)
-        if ethical_message and is_ethical:
-            response = f"**[Advertencia Ética/Legal]** {ethical_message}\n\n---\n\n{response}"
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+        return self
 
-        return response, metrics, results
+    def child(self, name, **attrs):
+        return Span(self.tracer, name, self.trace_id, self.span_id, attrs)
 
-    # -----------------------------
-    # 4.7 Métricas de Calidad (IL3.1)
-    # -----------------------------
-    def evaluate_faithfulness(self, query, context_text, response_text):
+    def end(self, error=None):
+        """Termina el tramo (una sola vez) y lo entrega al tracer. Devuelve la duración en segundos."""
+        if self.duration is None:
+            self.duration = time.perf_counter() - self._t0
+            if error is not None:
+                self.error = str(error) or type(error).__name__
+            self.tracer.record(self)
+        return self.duration
+
+    @contextlib.contextmanager
+    def activate(self):
+        """Hace de este tramo el padre de los que se abran dentro, sin terminarlo."""
+        token = _active_span.set(self)
+        try:
+            yield self
+        finally:
+            _active_span.reset(token)
+
+    def __enter__(self):
+        self._token = _active_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _active_span.reset(self._token)
+        self.end(exc)
+        return False
+
+
+class _NullSpan:
+    """Tramo vacío (sin traza en curso o trazas desactivadas): mismas operaciones, sin costo."""
+    duration = 0.0
+
+    def set(self, **attrs):
+        return self
+
+    def child(self, name, **attrs):
+        return self
+
+    def end(self, error=None):
+        return 0.0
+
+    def activate(self):
+        return contextlib.nullcontext(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+def trace_span(name, **attrs):
+    """(4.9b) Tramo hijo del tramo activo; sin traza en curso devuelve `NULL_SPAN` (no-op)."""
+    parent = _active_span.get()
+    return parent.child(name, **attrs) if parent is not None else NULL_SPAN
+
+
+class Tracer:
+    """
+    (4.9b) Trazas del proceso: cada tramo terminado alimenta el histograma de su nombre y, con
+    `path`, se exporta como una línea JSONL (escritor append-only en segundo plano, rotado por
+    tamaño; se conservan los últimos `keep_segments` segmentos).
+    """
+
+    def __init__(self, path=None, max_bytes=None, keep_segments=None):
+        self.lock = threading.Lock()
+        self.histograms = defaultdict(LatencyHistogram)
+        self.path = path
+        self.segments_dir = os.path.splitext(path)[0] if path else None
+        self.keep_segments = trace_keep_segments if keep_segments is None else keep_segments
+        self.exported = 0
+        self.writer = None
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self.writer = AppendOnlyLogWriter(path, segments_dir=self.segments_dir,
+                                              max_bytes=max_bytes or trace_segment_bytes, on_rotate=self._prune)
+
+    def start(self, name, **attrs):
+        """Tramo raíz de una traza nueva."""
+        return Span(self, name, attrs=attrs)
+
+    def record(self, span):
+        with self.lock:
+            self.histograms[span.name].observe(span.duration)
+        if self.writer is not None:
+            record = {'timestamp': datetime.fromtimestamp(span.started, tz=timezone.utc).isoformat(),
+                      'trace_id': span.trace_id, 'span_id': span.span_id, 'parent_id': span.parent_id,
+                      'name': span.name, 'duration_ms': round(span.duration * 1000, 3), 'attrs': span.attrs}
+            if span.error is not None:
+                record['error'] = span.error
+            self.writer.append(record)
+            self.exported += 1
+
+    def summary(self):
+        """{nombre de tramo: {count, mean, p50, p95, p99, max}} (segundos) desde el arranque del proceso."""
+        with self.lock:
+            return {name: hist.summary() for name, hist in self.histograms.items()}
+
+    def _prune(self, closed_segment):
+        segments = sorted(f for f in os.listdir(self.segments_dir) if f.endswith(".jsonl"))
+        for name in segments[:max(0, len(segments) - self.keep_segments)]:
+            os.remove(os.path.join(self.segments_dir, name))
+
+
+@st.cache_resource
+def get_tracer():
+    """(4.9b) Tracer del proceso (histogramas y exportador compartidos por las sesiones)."""
+    return Tracer(trace_file or None)
+
+
+ # ==============================================================
+ # 4.9c EVALUACIÓN EN SEGUNDO PLANO (evaluadores enchufables por lotes)
+ # ==============================================================
+class EvaluationBatch:
+    """
+    (4.9c) Lote de interacciones completadas a evaluar. Cada texto (consulta, respuesta, contexto,
+    documentos fuente) se normaliza y tokeniza una sola vez por lote, aunque lo usen varios
+    evaluadores o varias interacciones (los documentos fuente suelen repetirse entre consultas).
+    Cada ítem: {'query', 'response', 'context_text', 'results', ...}.
+    """
+    STRIP_CHARS = ".,?¡!():;\"'"
+
+    def __init__(self, items):
+        self.items = list(items)
+        self._lower = {}
+        self._words = {}
+        self._sentences = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def lower(self, text):
+        value = self._lower.get(text)
+        if value is None:
+            value = self._lower[text] = text.lower()
+        return value
+
+    def words(self, text):
+        """Conjunto de palabras (>2 caracteres, sin puntuación, minúsculas) de `text`."""
+        value = self._words.get(text)
+        if value is None:
+            value = self._words[text] = {w.lower().strip(self.STRIP_CHARS) for w in text.split() if len(w) > 2}
+        return value
+
+    def sentences(self, text):
+        """Oraciones de `text` (separadas por punto)."""
+        value = self._sentences.get(text)
+        if value is None:
+            value = self._sentences[text] = [s.strip() for s in text.split('.') if s.strip()]
+        return value
+
+
+class Evaluator(abc.ABC):
+    """
+    (4.9c) Interfaz de un evaluador de calidad. `evaluate` recibe un `EvaluationBatch` y devuelve
+    una lista (un dict de puntajes por ítem, en el mismo orden). Corre en el hilo de
+    `EvaluationWorker`, nunca en el camino de respuesta, así que puede ser costoso (p. ej. un juez
+    LLM que evalúe el lote en una sola solicitud). Para agregar uno: subclase + entrada en `EVALUATORS`.
+    """
+    name = None
+    fields = ()  # métricas que produce
+
+    @abc.abstractmethod
+    def evaluate(self, batch):
+        """Lista de dicts de puntajes, uno por ítem de `batch.items`."""
+
+
+class HeuristicEvaluator(Evaluator):
+    """(4.9c / IL3.1) Heurísticas de solapamiento de palabras: faithfulness, relevance y context precision."""
+    name = "heuristic"
+    fields = ('faithfulness', 'relevance', 'context_precision')
+
+    def evaluate(self, batch):
+        return [{'faithfulness': self.faithfulness(batch, item), 'relevance': self.relevance(batch, item),
+                 'context_precision': self.context_precision(batch, item)} for item in batch.items]
+
+    @staticmethod
+    def faithfulness(batch, item):
         # Heurística simple para medir consistencia con el contexto (faithfulness)
         try:
-            ctx = context_text.lower()
-            sentences = [s.strip() for s in response_text.split('.') if s.strip()]
+            ctx = batch.lower(item['context_text'])
+            sentences = batch.sentences(item['response'])
             if not sentences:
                 return 0.0
-            overlap = sum(1 for s in sentences if s.lower()[:30] in ctx or 'servicio' in s.lower())
+            overlap = 0
+            for s in sentences:
+                lowered = batch.lower(s)
+                overlap += 1 if lowered[:30] in ctx or 'servicio' in lowered else 0
             score = (overlap / len(sentences)) * 10.0
             return float(max(0.0, min(10.0, score)))
         except Exception:
             return 0.0
 
-    def evaluate_relevance(self, query, response_text):
+    @staticmethod
+    def relevance(batch, item):
         # Heurística simple para medir relevancia respecto a la consulta
         try:
-            q_words = set([w.lower().strip(".,?¡!():;\"'") for w in query.split() if len(w) > 2])
-            r_words = set([w.lower().strip(".,?¡!():;\"'") for w in response_text.split() if len(w) > 2])
+            q_words = batch.words(item['query'])
             if not q_words:
                 return 0.0
-            overlap = len(q_words.intersection(r_words))
+            overlap = len(q_words & batch.words(item['response']))
             score = (overlap / len(q_words)) * 10.0
             return float(max(0.0, min(10.0, score)))
         except Exception:
             return 0.0
 
-    def evaluate_context_precision(self, query, results):
+    @staticmethod
+    def context_precision(batch, item):
         # Mide la precisión del contexto recuperado (proporción de documentos relevantes)
         try:
-            q_words = set([w.lower().strip(".,?¡!():;\"'") for w in query.split() if len(w) > 2])
+            q_words, results = batch.words(item['query']), item.get('results')
             if not q_words or not results:
                 return 0.0
-            count = 0
-            for r in results:
-                content_words = set([w.lower().strip(".,?¡!():;\"'") for w in r['document'].split() if len(w) > 2])
-                if q_words.intersection(content_words):
-                    count += 1
+            count = sum(1 for r in results if not q_words.isdisjoint(batch.words(r['document'])))
             return float(count / len(results))
         except Exception:
             return 0.0
 
-    # -----------------------------
-    # 4.7 (continuación) Persistencia y Logs (IE3 / IE10)
-    # -----------------------------
-    def log_interaction(self, query, response, metrics, results, error_occurred):
-        """Registra interacción y persiste (trazabilidad)."""
-        try:
-            entry = {
-                'id': str(uuid.uuid4()),
-                'timestamp': datetime.utcnow().isoformat(),
-                'query': query,
-                'response': response,
-                'metrics': metrics,
-                'error_occurred': error_occurred,
-                'context_count': len(results) if results else 0,
-                'context_scores': [r.get('combined_score') for r in results] if results else []
-            }
-            self.interaction_logs.append(entry)
-            logger.info("interaction_end", **entry)  # Registro estructurado final (IL3.2)
-            # Persist logs to disk for reproducibility (IE6 / IE10)
+
+EVALUATORS = {"heuristic": HeuristicEvaluator}
+
+
+class EvaluationWorker:
+    """
+    (4.9c) Evalúa en un hilo propio las interacciones ya registradas: toma de la cola hasta
+    `batch_size` ítems (esperando como máximo `linger` s a que se complete el lote), corre cada
+    evaluador una vez por lote y agrega los puntajes a la entrada del log (`InteractionLog.update_metrics`).
+    Un evaluador que falla no afecta a los demás ni a la respuesta ya entregada.
+    """
+
+    def __init__(self, evaluators=None, batch_size=None, linger=None):
+        if evaluators is None:
+            evaluators = []
+            for name in (n.strip() for n in evaluator_names.split(",")):
+                if name in EVALUATORS:
+                    evaluators.append(EVALUATORS[name]())
+                elif name:
+                    logger.warning("evaluator_unknown", evaluator=name)
+        self.evaluators = evaluators
+        self.batch_size = max(1, batch_size or eval_batch_size)
+        self.linger = eval_linger_ms / 1000.0 if linger is None else linger
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.stats = {'batches': 0, 'items': 0, 'max_batch': 0, 'errors': 0}
+
+    def submit(self, item):
+        """
+        Encola una interacción registrada: {'id', 'log', 'query', 'response', 'context_text',
+        'results', 'span'}. Devuelve un Future que se resuelve con los puntajes.
+        """
+        item['future'] = concurrent.futures.Future()
+        item['queued'] = time.perf_counter()
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="atlas-evaluator", daemon=True)
+                self._thread.start()
+        self._queue.put(item)
+        return item['future']
+
+    def drain(self):
+        """Espera a que se evalúen todas las interacciones encoladas (benchmark / pruebas)."""
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.linger
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
             try:
-                self._save_logs()
+                self.process(batch)
             except Exception as e:
-                logger.warning("log_persist_failed", error=str(e))
-            return True
-        except Exception as e:
-            logger.error("log_error", error=str(e), message="Fallo al registrar la interacción")
-            return False
+                logger.error("evaluation_batch_error", error=str(e), size=len(batch))
+                for item in batch:
+                    if not item['future'].done():
+                        item['future'].set_exception(e)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
 
-    def _save_logs(self):
-        """Guarda `self.interaction_logs` en `self.logs_path` como JSON."""
-        try:
-            # Ensure serializable: create a sanitized copy and convert non-serializable types using str()
-            sanitized = []
-            for e in self.interaction_logs:
-                copy_e = dict(e)
-                # Mask PII in query/response before persisting
-                copy_e['query'] = self._mask_pii(str(copy_e.get('query', '')))
-                copy_e['response'] = self._mask_pii(str(copy_e.get('response', '')))
-                # Ensure metrics are serializable
-                copy_e['metrics'] = copy_e.get('metrics', {})
-                sanitized.append(copy_e)
-            with open(self.logs_path, "w", encoding="utf-8") as fh:
-                json.dump(sanitized, fh, ensure_ascii=False, indent=2, default=str)
-            logger.info("logs_saved", path=self.logs_path, count=len(sanitized))
-            return True
-        except Exception as e:
-            logger.error("logs_save_error", error=str(e))
-            raise
+    def process(self, items):
+        """Evalúa un lote y escribe los puntajes de vuelta en la entrada del log (nunca en dicts de la UI)."""
+        started = time.perf_counter()
+        spans = [item['span'].child("evaluate", batch=len(items), queued_ms=round((started - item['queued']) * 1000, 3))
+                 for item in items]
+        batch = EvaluationBatch(items)
+        scores = [{} for _ in items]
+        for evaluator in self.evaluators:
+            try:
+                for target, values in zip(scores, evaluator.evaluate(batch)):
+                    target.update(values)
+            except Exception as e:
+                self.stats['errors'] += 1
+                logger.warning("evaluation_error", evaluator=evaluator.name, error=str(e), size=len(items))
+        elapsed = time.perf_counter() - started
+        self.stats['batches'] += 1
+        self.stats['items'] += len(items)
+        self.stats['max_batch'] = max(self.stats['max_batch'], len(items))
+        for item, values, span in zip(items, scores, spans):
+            values.update(evaluation='done', evaluation_time=elapsed / len(items),  # amortizado en el lote
+                          evaluators=[e.name for e in self.evaluators])
+            item['log'].update_metrics(item['id'], values)
+            span.end()
+            item['future'].set_result(values)
+
+
+@st.cache_resource
+def get_evaluation_worker():
+    """(4.9c) Evaluador en segundo plano del proceso (una cola y un hilo para todas las sesiones)."""
+    return EvaluationWorker()
+
+
+ # ==============================================================
+ # 5. RATE LIMITER (Control simple de frecuencia)
+ # ==============================================================
+class MemoryRateStore:
+    """
+    (5) Estado del limitador en memoria del proceso: clave -> (estado, último acceso) en un
+    OrderedDict ordenado por acceso, de modo que las claves inactivas quedan al principio y
+    se expulsan sin recorrer el resto.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._states = OrderedDict()
+
+    def __len__(self):
+        return len(self._states)
+
+    def apply(self, key, step, now):
+        """Aplica `step(estado | None, now) -> (permitido, estado nuevo)` de forma atómica."""
+        with self._lock:
+            state = self._states.pop(key, (None, now))[0]
+            allowed, state = step(state, now)
+            self._states[key] = (state, now)  # al final: acceso más reciente
+        return allowed
+
+    def evict(self, idle_before):
+        """Elimina las claves sin acceso desde `idle_before`. Devuelve cuántas."""
+        evicted = 0
+        with self._lock:
+            while self._states:
+                key, (_, last) = next(iter(self._states.items()))
+                if last >= idle_before:
+                    break
+                del self._states[key]
+                evicted += 1
+        return evicted
+
+
+class SQLiteRateStore:
+    """
+    (5) Estado del limitador en una base SQLite compartida: varios procesos del servidor que
+    apunten al mismo archivo aplican un único límite. Cada comprobación es una transacción
+    `BEGIN IMMEDIATE` sobre una fila (lectura + escritura por clave primaria); las claves
+    inactivas se borran con el índice por `updated`.
+    """
+
+    def __init__(self, path, timeout=5.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()  # una conexión por hilo
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS rate_limits (key TEXT PRIMARY KEY, a REAL, b REAL, c REAL, updated REAL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS rate_limits_updated ON rate_limits (updated)")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def __len__(self):
+        return self._conn().execute("SELECT COUNT(*) FROM rate_limits").fetchone()[0]
 
-    def _mask_pii(self, text: str) -> str:
-        """Enmascara patrones simples de PII (teléfonos, correos, secuencias largas de dígitos) para evitar guardar datos sensibles."""
+    def apply(self, key, step, now):
+        """Aplica `step(estado | None, now) -> (permitido, estado nuevo)` en una transacción."""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
         try:
-            # Enmascarar correos
-            text = re.sub(r"[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}", "[REDACTED_EMAIL]", text)
-            # Enmascarar teléfonos (7+ dígitos, con separadores)
-            text = re.sub(r"(\+?\d[\d\s\-()]{6,}\d)", "[REDACTED_PHONE]", text)
-            # Enmascarar secuencias largas de dígitos
-            text = re.sub(r"\b\d{7,}\b", "[REDACTED_NUMBER]", text)
-            return text
+            row = conn.execute("SELECT a, b, c FROM rate_limits WHERE key = ?", (key,)).fetchone()
+            allowed, state = step(tuple(row) if row else None, now)
+            conn.execute("INSERT OR REPLACE INTO rate_limits (key, a, b, c, updated) VALUES (?, ?, ?, ?, ?)",
+                         (key, *state, now))
+            conn.execute("COMMIT")
         except Exception:
-            return text
+            conn.execute("ROLLBACK")
+            raise
+        return allowed
 
-    def _save_messages(self, path=None):
-        """Guardar `st.session_state.messages` si existe en `data/messages.json`."""
-        try:
-            path = path or os.path.join("data", "messages.json")
-            msgs = getattr(self, 'session_messages', None)
-            if msgs is None and hasattr(self, 'interaction_logs'):
-                # fallback: do not attempt to reconstruct messages from logs
-                msgs = []
-            with open(path, 'w', encoding='utf-8') as fh:
-                json.dump(msgs, fh, ensure_ascii=False, indent=2, default=str)
-            logger.info("messages_saved", path=path, count=len(msgs))
-            return True
-        except Exception as e:
-            logger.error("messages_save_error", error=str(e))
-            return False
+    def evict(self, idle_before):
+        """Elimina las claves sin acceso desde `idle_before`. Devuelve cuántas."""
+        return self._conn().execute("DELETE FROM rate_limits WHERE updated < ?", (idle_before,)).rowcount
 
-    def _load_messages(self, path=None):
-        """Cargar mensajes guardados si existen."""
-        path = path or os.path.join("data", "messages.json")
-        if os.path.exists(path):
-            try:
-                with open(path, 'r', encoding='utf-8') as fh:
-                    msgs = json.load(fh)
-                # store in attribute for later saving
-                self.session_messages = msgs
-                logger.info("messages_loaded", path=path, count=len(msgs))
-                return msgs
-            except Exception as e:
-                logger.error("messages_load_error", error=str(e))
-                return []
-        return []
 
-    # -----------------------------
-    # 4.8 Extensión / Documentos Externos
-    # -----------------------------
-    def add_external_documents(self, documents: list):
-        """Agrega documentos externos y regenera embeddings."""
-        try:
-            if not documents:
-                return False
-            # append documents
-            self.documents.extend(documents)
-            # regenerate embeddings for all documents (simple approach)
-            embs = self.get_embeddings(self.documents)
-            if embs is not None:
-                self.embeddings = embs
-                self.embedding_matrix = self.embedding_matrix if self.embedding_matrix is not None else np.array(embs, dtype=float)
-                # if get_embeddings recomputed embedding_matrix, it already updated
-            # persist external docs
-            try:
-                ext_path = os.path.join('data', 'external_docs.json')
-                with open(ext_path, 'w', encoding='utf-8') as fh:
-                    json.dump({'documents': documents, 'added_at': datetime.utcnow().isoformat()}, fh, ensure_ascii=False, indent=2)
-            except Exception:
-                pass
-            logger.info("external_docs_added", count=len(documents))
-            return True
-        except Exception as e:
-            logger.error("external_docs_error", error=str(e))
-            return False
+class RateLimiter:
+    """
+    (5) Limitador de frecuencia por clave (p. ej. cliente) con coste O(1) por comprobación.
+    - "token_bucket": cubeta de `burst` fichas que se rellena a `requests_per_minute` / 60 por segundo.
+    - "sliding_window": contador de ventana deslizante (ventana actual + fracción de la anterior).
+    El estado por clave son tres números en `backend` (`MemoryRateStore` por defecto, o
+    `SQLiteRateStore` para compartir el límite entre procesos). Cada `sweep_interval` segundos se
+    expulsan las claves inactivas más tiempo del que tarda su estado en volver al inicial, por lo
+    que la expulsión no cambia ninguna decisión. `requests_per_minute <= 0` desactiva el límite.
+    Si el backend falla, `fail_open` decide si la consulta pasa; los fallos se cuentan en `stats`.
+    """
+    ALGORITHMS = ("token_bucket", "sliding_window")
+    WINDOW_SEC = 60.0
 
-    def _load_logs(self):
-        """Carga logs desde `self.logs_path` si existe."""
-        if os.path.exists(self.logs_path):
+    def __init__(self, requests_per_minute=60, algorithm="token_bucket", burst=None, backend=None,
+                 idle_ttl=None, sweep_interval=60.0, fail_open=True):
+        if algorithm not in self.ALGORITHMS:
+            raise ValueError(f"Algoritmo de rate limiting desconocido: {algorithm}")
+        self.requests_per_minute = requests_per_minute
+        self.algorithm = algorithm
+        self.capacity = float(burst or requests_per_minute)
+        self.rate = requests_per_minute / self.WINDOW_SEC  # fichas por segundo
+        self.backend = backend if backend is not None else MemoryRateStore()
+        reset_sec = self.capacity / self.rate if algorithm == "token_bucket" and self.rate > 0 else 2 * self.WINDOW_SEC
+        self.idle_ttl = max(idle_ttl or 0.0, reset_sec)
+        self.sweep_interval = sweep_interval
+        self._next_sweep = time.time() + sweep_interval
+        self._lock = threading.Lock()  # expulsión periódica y contadores
+        self.fail_open = fail_open
+        self.stats = {'allowed': 0, 'limited': 0, 'backend_errors': 0, 'evicted': 0}
+        self._step = self._token_bucket if algorithm == "token_bucket" else self._sliding_window
+
+    def _token_bucket(self, state, now):
+        tokens, last = (state[0], state[1]) if state else (self.capacity, now)
+        tokens = min(self.capacity, tokens + max(0.0, now - last) * self.rate)
+        allowed = tokens >= 1.0
+        return allowed, (tokens - 1.0 if allowed else tokens, now, 0.0)
+
+    def _sliding_window(self, state, now):
+        window = math.floor(now / self.WINDOW_SEC)
+        current_window, current, previous = state if state else (window, 0.0, 0.0)
+        if window != current_window:
+            previous = current if window == current_window + 1 else 0.0
+            current = 0.0
+        elapsed = (now - window * self.WINDOW_SEC) / self.WINDOW_SEC
+        allowed = previous * (1.0 - elapsed) + current < self.requests_per_minute
+        return allowed, (window, current + 1.0 if allowed else current, previous)
+
+    def is_allowed(self, user_id, now=None):
+        if self.requests_per_minute <= 0:
+            return True
+        now = time.time() if now is None else now
+        with self._lock:  # un solo hilo gana la expulsión de cada intervalo
+            sweep = now >= self._next_sweep
+            if sweep:
+                self._next_sweep = now + self.sweep_interval
+        if sweep:
             try:
-                with open(self.logs_path, "r", encoding="utf-8") as fh:
-                    data = json.load(fh)
-                if isinstance(data, list):
-                    self.interaction_logs = data
-                    logger.info("logs_loaded", path=self.logs_path, count=len(self.interaction_logs))
-                    return True
+                evicted = self.backend.evict(now - self.idle_ttl)
+                with self._lock:
+                    self.stats['evicted'] += evicted
+                if evicted:
+                    logger.info("rate_limiter", action="evict", evicted=evicted)
             except Exception as e:
-                logger.error("logs_load_error", error=str(e))
-                raise
-        return False
-
-    def clean_placeholder_documents(self) -> bool:
-        """Limpia documentos triviales / placeholder para mantener calidad."""
+                logger.warning("rate_limiter", status="evict_error", error=str(e))
         try:
-            if not self.documents:
-                return True
-            cleaned = []
-            removed = 0
-            for doc in self.documents:
-                if not doc or 'placeholder' in doc.lower() or 'test' in doc.lower() or len(doc.strip()) < 10:
-                    removed += 1
-                    continue
-                cleaned.append(doc)
-            if removed:
-                self.documents = cleaned
-                self.embeddings = None
-                self.embedding_matrix = None
-                logger.info("data_cleaning", removed_count=removed, message="Placeholders cleaned")
-            return True
+            allowed = self.backend.apply(str(user_id), self._step, now)
         except Exception as e:
-            logger.error("data_cleaning", error=str(e), message="Error cleaning placeholder documents")
-            return False
+            # Backend compartido no disponible (p. ej. base bloqueada): decide `fail_open`, y queda contado
+            with self._lock:
+                self.stats['backend_errors'] += 1
+            logger.warning("rate_limiter", status="backend_error", error=str(e), fail_open=self.fail_open)
+            allowed = self.fail_open
+        with self._lock:
+            self.stats['allowed' if allowed else 'limited'] += 1
+        return allowed
 
- # ==============================================================
- # 5. RATE LIMITER (Control simple de frecuencia)
- # ==============================================================
-class RateLimiter:
-    def __init__(self, requests_per_minute=60):
-        self.requests_per_minute = requests_per_minute
-        self.user_requests = defaultdict(list)
-
-    def is_allowed(self, user_id):
-        now = time.time()
-        window_start = now - 60
-        reqs = [t for t in self.user_requests[user_id] if t > window_start]
-        self.user_requests[user_id] = reqs
-        if len(reqs) >= self.requests_per_minute:
-            return False
-        self.user_requests[user_id].append(now)
-        return True
+
+@st.cache_resource
+def get_rate_limiter():
+    """(5) Limitador compartido por las sesiones del proceso (y entre procesos con `ATLAS_RATE_LIMIT_DB`)."""
+    backend = SQLiteRateStore(rate_limit_db) if rate_limit_db else None
+    return RateLimiter(rate_limit_rpm, algorithm=rate_limit_algorithm, burst=rate_limit_burst or None,
+                       backend=backend, idle_ttl=rate_limit_idle_sec, fail_open=rate_limit_fail_open)
+
+
+def client_rate_key():
+    """
+    (5) Identidad estable del cliente para el limitador: la IP de la conexión (`st.context.ip_address`).
+    Las cabeceras las puede fijar el propio cliente, así que el usuario que informa el proxy
+    (`ATLAS_RATE_LIMIT_USER_HEADER`) y la primera IP de `X-Forwarded-For` / `X-Real-Ip` solo se
+    usan con `ATLAS_TRUSTED_PROXY=true` (Streamlit detrás de un proxy que las reescribe). Recargar
+    la página no crea una cubeta nueva. Sin ninguna de ellas se usa una clave por sesión.
+    """
+    try:
+        forwarded = None
+        if rate_limit_trusted_proxy:
+            headers = st.context.headers
+            user = headers.get(rate_limit_user_header) if rate_limit_user_header else None
+            if user:
+                return f"user-{user.strip()}"
+            forwarded = (headers.get("X-Forwarded-For") or "").split(",")[0].strip() or headers.get("X-Real-Ip")
+        ip = forwarded or getattr(st.context, "ip_address", None)
+        if isinstance(ip, str) and ip.strip():
+            return f"ip-{ip.strip()}"
+    except Exception as e:
+        logger.warning("rate_limiter", status="client_key_error", error=str(e))
+    return f"session-{uuid.uuid4().hex}"
 
  # ==============================================================
- # 6. UTILIDAD ASÍNCRONA (Embeddings en segundo plano)
+ # 6. UTILIDAD ASÍNCRONA (Embeddings en segundo plano, bucle asyncio del agente)
  # ==============================================================
 _executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+_async_loop = None
+_async_loop_lock = threading.Lock()
+
+
+def _get_async_loop():
+    """(4.6b) Bucle asyncio persistente en un hilo de fondo (los clientes asíncronos quedan ligados a él)."""
+    global _async_loop
+    with _async_loop_lock:
+        if _async_loop is None:
+            _async_loop = asyncio.new_event_loop()
+            threading.Thread(target=_async_loop.run_forever, name="atlas-asyncio", daemon=True).start()
+    return _async_loop
+
+
+def run_coroutine_sync(coro):
+    """Ejecuta una corrutina en el bucle de fondo y espera su resultado (API síncrona de la UI)."""
+    return asyncio.run_coroutine_threadsafe(coro, _get_async_loop()).result()
+
+
+def iterate_async_sync(agen):
+    """Consume un generador asíncrono desde código síncrono (p. ej. `st.write_stream`)."""
+    loop = _get_async_loop()
+    try:
+        while True:
+            try:
+                yield asyncio.run_coroutine_threadsafe(agen.__anext__(), loop).result()
+            except StopAsyncIteration:
+                return
+    finally:
+        asyncio.run_coroutine_threadsafe(agen.aclose(), loop).result()
+
+
+async def iterate_in_thread(iterator):
+    """Adapta un iterador bloqueante (SSE de GitHub, stream del SDK síncrono) a `async for`, un paso por hilo."""
+    done = object()
+    iterator = iter(iterator)
+    while (item := await asyncio.to_thread(next, iterator, done)) is not done:
+        yield item
+
 
 def async_get_embeddings(chatbot, documents):
     """Ejecutar get_embeddings en background para no bloquear Streamlit."""
@@ -687,318 +4382,1117 @@ def async_get_embeddings(chatbot, documents):
  # ==============================================================
  # 7. INTERFAZ STREAMLIT (Tabs: Chat / Documentos / Métricas)
  # ==============================================================
+def _lazy_tabs(labels):
+    """
+    (7c) Pestañas con ejecución diferida: solo corre el contenido de la pestaña seleccionada
+    (`on_change="rerun"`), así el dashboard y sus dependencias no se cargan mientras se usa el chat.
+    Con versiones de Streamlit sin esa opción se dibujan todas, como antes.
+    """
+    try:
+        return st.tabs(labels, key="main_tab", on_change="rerun")
+    except TypeError:
+        return st.tabs(labels)
+
+
+def _tab_open(tab):
+    """True si la pestaña está seleccionada (o si Streamlit no informa la selección)."""
+    return getattr(tab, "open", None) is not False
+
+
+def _push_chat_message(message):
+    """
+    (4.9) Agrega un mensaje a la ventana acotada de la sesión. Si el usuario ya cargó páginas
+    anteriores, el mensaje que sale de la ventana pasa a ellas para que el historial visible siga continuo.
+    """
+    window = st.session_state.messages
+    if st.session_state.older_messages and len(window) == window.maxlen:
+        st.session_state.older_messages.append(window[0])
+    window.append(message)
+
+
+def _render_evaluation(message):
+    """
+    (4.9c) Puntajes de calidad de una respuesta del chat, leídos del log por `interaction_id` cuando
+    el evaluador en segundo plano terminó; una vez encontrados quedan en el mensaje de la sesión.
+    """
+    if 'scores' not in message and message.get('interaction_id'):
+        scores = st.session_state.chatbot_rag.interaction_log.evaluation(message['interaction_id'])
+        if scores is not None:
+            message['scores'] = scores
+    scores = message.get('scores')
+    if scores:
+        st.caption(f"Faithfulness: {scores.get('faithfulness', 0.0):.1f} / 10 · Relevance: {scores.get('relevance', 0.0):.1f} / 10")
+
+
 def main():
     # Tema inicial
     inject_hospital_theme(logo_path="assets/hospital_logo.png")
 
     if "chatbot_rag" not in st.session_state:
-        chatbot = ChatbotMedicoRAG()
+        # (4.0f) Estado ligero por sesión; corpus, índices, logs y caché de respuestas son del proceso
+        # (4.9) El id de la conversación va en la URL (`?c=`): recargar la página retoma la propia
+        conversation_id = st.query_params.get("c")
+        if not ChatMessageStore.is_valid_id(conversation_id):
+            conversation_id = ChatMessageStore.new_conversation_id()
+            st.query_params["c"] = conversation_id
+        chatbot = ChatbotMedicoRAG(knowledge_base=get_knowledge_base(), interaction_log=get_interaction_log(),
+                                   answer_cache=get_answer_cache(), tracer=get_tracer(),
+                                   evaluator=get_evaluation_worker(), message_store=get_message_store(),
+                                   conversation_id=conversation_id)
         st.session_state.chatbot_rag = chatbot
+        st.session_state.rate_limit_key = client_rate_key()  # (5) Clave del rate limiter (por cliente)
 
-        if not chatbot.initialize_client():
-            return
+        if not chatbot.initialize_client() and chatbot.embedding_backend is None:
+            return  # (4.0g) con embeddings locales la recuperación y los documentos funcionan sin proveedor
 
-        chatbot.initialize_hospital_documents()
         try:
-            embs = chatbot.get_embeddings(chatbot.documents)
-            if embs is not None:
-                st.session_state.chatbot_rag.embeddings = embs
-                st.session_state.chatbot_rag.embedding_matrix = chatbot.embedding_matrix
-                st.success("✅ Embeddings generados automáticamente para los documentos cargados")
+            if chatbot.ensure_knowledge_base():
+                st.success("✅ Embeddings disponibles para los documentos cargados")
             else:
                 st.info("ℹ️ Embeddings no generados automáticamente.")
         except Exception:
             pass
 
         if "messages" not in st.session_state:
-            st.session_state.messages = []
-        # try load persisted messages
-        try:
-            loaded_msgs = chatbot._load_messages()
-            if loaded_msgs:
-                st.session_state.messages = loaded_msgs
-        except Exception:
-            pass
+            # (4.9) Solo la conversación de la sesión (vacía si es nueva): ventana con sus mensajes más
+            # recientes; los anteriores se leen por páginas desde su archivo
+            st.session_state.messages = deque(chatbot._load_messages(), maxlen=chat_window)
+            st.session_state.older_messages = []
+            st.session_state.history_exhausted = False
 
-    tabs = st.tabs(["💬 Chat", "📄 Documentos", "📊 Métricas y Dashboard"])
+    tabs = _lazy_tabs(["💬 Chat", "📄 Documentos", "📊 Métricas y Dashboard"])
     tab1, tab2, tab3 = tabs
 
     # ----------------------- TAB 1: CHAT -----------------------
     with tab1:
-        st.subheader("💬 Agente Funcional Médico (HBL)")
-        for message in st.session_state.messages:
-            with st.chat_message(message["role"]):
-                st.markdown(message["content"])
-
-        if prompt := st.chat_input("🏥 Pregúntame sobre horarios, servicios médicos, procedimientos..."):
-            st.session_state.messages.append({"role": "user", "content": prompt})
-            with st.chat_message("user"):
-                st.markdown(prompt)
-
-            with st.chat_message("assistant"):
-                with st.spinner("Agente de IA procesando..."):
+        if _tab_open(tab1):
+            st.subheader("💬 Agente Funcional Médico (HBL)")
+            # (4.9) Solo se dibuja la ventana reciente y las páginas anteriores pedidas explícitamente
+            oldest = (st.session_state.older_messages or st.session_state.messages or [None])[0]
+            if oldest is not None and oldest.get('seq', 0) > 0 and not st.session_state.history_exhausted:
+                if st.button("⬆️ Cargar mensajes anteriores"):
+                    older = st.session_state.chatbot_rag._load_messages(before_seq=oldest['seq'])
+                    st.session_state.older_messages = older + st.session_state.older_messages
+                    st.session_state.history_exhausted = len(older) < chat_page_size
+            for message in st.session_state.older_messages + list(st.session_state.messages):
+                with st.chat_message(message["role"]):
+                    st.markdown(message["content"])
+                    _render_evaluation(message)
+
+            if prompt := st.chat_input("🏥 Pregúntame sobre horarios, servicios médicos, procedimientos..."):
+                _push_chat_message(st.session_state.chatbot_rag._save_message("user", prompt))
+                with st.chat_message("user"):
+                    st.markdown(prompt)
+
+                with st.chat_message("assistant"):
                     chatbot = st.session_state.chatbot_rag
                     try:
-                        response, metrics, results = chatbot.run_agent_logic(prompt)
+                        if not get_rate_limiter().is_allowed(st.session_state.rate_limit_key):
+                            # (5) Límite de consultas por minuto del cliente
+                            response = "⏳ Has alcanzado el límite de consultas por minuto. Intenta nuevamente en unos segundos."
+                            metrics, results = {}, []
+                            logger.warning("rate_limited", key=st.session_state.rate_limit_key)
+                            st.markdown(response)
+                        elif streaming_enabled:
+                            # (4.4) Los tokens se muestran a medida que llegan
+                            outcome = {}
+                            st.write_stream(chatbot.stream_agent_logic(prompt, outcome))
+                            response, metrics, results = outcome['response'], outcome['metrics'], outcome['results']
+                        else:
+                            with st.spinner("Agente de IA procesando..."):
+                                response, metrics, results = chatbot.run_agent_logic(prompt)
+                            st.markdown(response)
                     except Exception as e:
                         response = f"Error interno ejecutando lógica del agente: {e}"
                         metrics = {}
                         results = []
                         st.session_state.chatbot_rag.error_count += 1
                         logger.error("runtime_error", error=str(e), query=prompt[:50])
+                        st.markdown(response)
 
-                    st.markdown(response)
-                    st.session_state.messages.append({"role": "assistant", "content": response})
+                    if chatbot.query_embedding_error is not None:
+                        # (4.6b) El embedding corre fuera del hilo de Streamlit; el aviso se muestra aquí
+                        st.warning(f"⚠ Error obteniendo embedding de la query: {chatbot.query_embedding_error}")
+                        chatbot.query_embedding_error = None
+                    saved = chatbot._save_message("assistant", response)
+                    if metrics.get('interaction_id'):
+                        saved['interaction_id'] = metrics['interaction_id']  # (4.9c) puntajes al siguiente rerun
+                    _push_chat_message(saved)
 
                     # --- AÑADIR TRAZABILIDAD MEJORADA ---
                     if metrics:
                         with st.expander("🔎 Trazabilidad y Métricas de la Respuesta"):
                             st.markdown(f"**Latencia Total:** `{metrics.get('total_time', 0.0):.3f}s` (RAG: `{metrics.get('rag_time', 0.0):.3f}s`)")
+                            if metrics.get('cache_hit'):
+                                st.markdown(f"**Caché Semántica:** respuesta reutilizada (ahorro: `{metrics.get('latency_saved', 0.0):.3f}s`)")
+                            st.markdown(f"**Primer Token (TTFT):** `{metrics.get('ttft', 0.0):.3f}s` · **Velocidad:** `{metrics.get('tokens_per_sec', 0.0):.1f}` tokens/s")
                             st.markdown(f"**Tokens Usados:** `{metrics.get('tokens_used', {}).get('total_tokens', 0)}`")
-                            st.markdown(f"**Faithfulness (0-10):** `{metrics.get('faithfulness', 0.0):.1f}`")
-                            st.markdown(f"**Relevance (0-10):** `{metrics.get('relevance', 0.0):.1f}`")
+                            if metrics.get('evaluation') == 'pending':
+                                st.markdown("**Faithfulness / Relevance:** evaluación en curso (aparece junto a la respuesta al actualizar el chat)")
+                            else:
+                                st.markdown(f"**Faithfulness (0-10):** `{metrics.get('faithfulness', 0.0):.1f}`")
+                                st.markdown(f"**Relevance (0-10):** `{metrics.get('relevance', 0.0):.1f}`")
 
                             if results:
                                 st.subheader("Documentos Fuente (Contexto RAG):")
                                 for r in results:
                                     score_color = "#28a745" if r['combined_score'] > 0.5 else "#ffc107"
                                     st.markdown(f"""
-                                    <div style='background-color:#f8f9fa; padding: 8px; border-radius: 5px; margin-bottom: 5px; border-left: 4px solid {score_color};'>
-                                        **Score:** <span style='color:{score_color}'>{r['combined_score']:.2f}</span><br>
-                                        **Contenido:** <span style='color:var(--muted); font-size:0.9em;'>{r['document']}</span>
-                                    </div>
-                                    """, unsafe_allow_html=True)
+                                <div style='background-color:#f8f9fa; padding: 8px; border-radius: 5px; margin-bottom: 5px; border-left: 4px solid {score_color};'>
+                                    **Score:** <span style='color:{score_color}'>{r['combined_score']:.2f}</span><br>
+                                    **Contenido:** <span style='color:var(--muted); font-size:0.9em;'>{r['document']}</span>
+                                </div>
+                                """, unsafe_allow_html=True)
                             else:
                                 st.info("No se utilizó RAG (respuesta directa del LLM).")
-                    # -----------------------------------
+                # -----------------------------------
 
     # -------------------- TAB 2: DOCUMENTOS --------------------
     with tab2:
-        st.header("📄 Gestión de Documentos y Embeddings")
-        st.info("Aquí puedes ver y gestionar los documentos de conocimiento del Hospital Barros Luco. Estos documentos son la base para el componente RAG.")
+        if _tab_open(tab2):
+            import pandas as pd  # (7c) diferido: solo al abrir la pestaña
+            st.header("📄 Gestión de Documentos y Embeddings")
+            st.info("Aquí puedes ver y gestionar los documentos de conocimiento del Hospital Barros Luco. Estos documentos son la base para el componente RAG.")
 
-        st.subheader("Documentos Cargados")
-        doc_df = pd.DataFrame({'ID': range(len(st.session_state.chatbot_rag.documents)), 'Contenido': st.session_state.chatbot_rag.documents})
-        st.dataframe(doc_df, use_container_width=True)
+            st.subheader("Documentos Cargados")
+            snap = st.session_state.chatbot_rag.kb.snapshot  # (4.0f) vista coherente del corpus compartido
+            doc_df = pd.DataFrame({'ID': snap.doc_ids, 'Contenido': snap.documents,
+                                   'Origen': ["{source} #{record} @{offset}".format(**snap.doc_meta[i]) if i in snap.doc_meta else ""
+                                              for i in snap.doc_ids]})
+            st.dataframe(doc_df, use_container_width=True)
 
-        st.subheader("Estado del Embedding")
-        if st.session_state.chatbot_rag.embeddings is not None:
-            st.success(f"Embeddings generados para {len(st.session_state.chatbot_rag.documents)} documentos usando `{st.session_state.chatbot_rag.embeddings_model}`.")
-        else:
-            st.warning("Embeddings no generados o fallidos.")
+            # (4.8) Edición incremental: solo se re-embebe el documento afectado
+            with st.expander("✏️ Editar o eliminar un documento"):
+                selected_id = st.selectbox("Documento", snap.doc_ids)
+                if selected_id is not None:
+                    current = snap.documents[snap.doc_rows[selected_id]]
+                    new_text = st.text_area("Contenido", value=current, key=f"edit_{selected_id}")
+                    col_rep, col_del = st.columns(2)
+                    with col_rep:
+                        if st.button("💾 Reemplazar contenido") and new_text.strip() and new_text != current:
+                            if st.session_state.chatbot_rag.replace_document(selected_id, new_text):
+                                st.success(f"Documento {selected_id} actualizado.")
+                            else:
+                                st.error("No se pudo actualizar el documento.")
+                    with col_del:
+                        if st.button("🗑️ Eliminar documento"):
+                            st.session_state.chatbot_rag.remove_documents([selected_id])
+                            st.success(f"Documento {selected_id} eliminado.")
 
-        if st.button("🔄 Regenerar Embeddings", type="primary"):
-            with st.spinner("Generando Embeddings..."):
-                st.session_state.chatbot_rag.get_embeddings(st.session_state.chatbot_rag.documents)
-            try:
-                st.experimental_rerun()
-            except Exception:
-                st.success("Embeddings generados. Recarga la página manualmente si es necesario.")
-                st.stop()
-        st.markdown("---")
-        st.subheader("📥 Añadir documentos externos (CSV/TXT)")
-        uploaded_file = st.file_uploader("Sube un CSV (columna 'content' o 'text') o un .txt", type=["csv", "txt"], accept_multiple_files=False)
-        if uploaded_file is not None:
-            try:
-                docs_to_add = []
-                if uploaded_file.name.lower().endswith('.csv'):
-                    df_up = pd.read_csv(uploaded_file)
-                    # try common column names
-                    if 'content' in df_up.columns:
-                        docs_to_add = df_up['content'].dropna().astype(str).tolist()
-                    elif 'text' in df_up.columns:
-                        docs_to_add = df_up['text'].dropna().astype(str).tolist()
-                    else:
-                        # take first text-like column
-                        first_col = df_up.columns[0]
-                        docs_to_add = df_up[first_col].dropna().astype(str).tolist()
+            st.subheader("Estado del Embedding")
+            if st.session_state.chatbot_rag.embeddings is not None:
+                st.success(f"Embeddings generados para {len(st.session_state.chatbot_rag.documents)} documentos usando `{st.session_state.chatbot_rag.embeddings_model}`.")
+            else:
+                st.warning("Embeddings no generados o fallidos.")
+
+            # (4.0) Componente léxico de la búsqueda híbrida (índice invertido precalculado)
+            scorer_options = ["overlap", "bm25"]
+            current_scorer = st.session_state.chatbot_rag.lexical_scorer
+            st.session_state.chatbot_rag.lexical_scorer = st.radio(
+                "Puntuación léxica", scorer_options, horizontal=True,
+                index=scorer_options.index(current_scorer) if current_scorer in scorer_options else 0,
+                help="overlap: fracción de términos de la consulta presentes en el documento. bm25: Okapi BM25 normalizado.")
+            st.caption(f"Índice léxico: {len(st.session_state.chatbot_rag.lexical_index)} documentos, {len(st.session_state.chatbot_rag.lexical_index.postings)} términos.")
+
+            # (4.0) Índice ANN (IVF) para bases de conocimiento grandes
+            with st.expander("⚡ Índice aproximado (ANN / IVF)"):
+                ann = st.session_state.chatbot_rag.ann_index
+                if ann is not None:
+                    st.write(f"Activo: {ann.nlist} listas, {len(ann)} vectores (modo `{st.session_state.chatbot_rag.ann_mode}`).")
                 else:
-                    raw = uploaded_file.getvalue().decode('utf-8')
-                    # split by double-newline or by lines
-                    parts = [p.strip() for p in raw.split('\n\n') if p.strip()]
-                    if parts:
-                        docs_to_add = parts
-                    else:
-                        docs_to_add = [raw]
+                    st.write(f"Inactivo: búsqueda exacta (modo `{st.session_state.chatbot_rag.ann_mode}`, umbral {ann_min_docs} documentos).")
+                st.session_state.chatbot_rag.ann_nprobe = st.slider("nprobe (listas exploradas por consulta)", 1, 64, st.session_state.chatbot_rag.ann_nprobe)
+                if st.button("📏 Medir recall@k vs latencia") and st.session_state.chatbot_rag.embedding_matrix is not None:
+                    with st.spinner("Comparando ANN con búsqueda exacta..."):
+                        report = st.session_state.chatbot_rag.ann_recall_report()
+                    st.dataframe(pd.DataFrame(report), use_container_width=True)
 
-                if docs_to_add:
-                    st.write(f"Documentos detectados: {len(docs_to_add)}")
+            if st.button("🔄 Regenerar Embeddings", type="primary"):
+                regen_bar = st.progress(0.0, text="Generando Embeddings...")
+                st.session_state.chatbot_rag.get_embeddings(
+                    st.session_state.chatbot_rag.documents, force_refresh=True,
+                    progress=lambda done, total: regen_bar.progress(done / max(total, 1), text=f"Generando Embeddings... {done}/{total}"))
+                try:
+                    st.experimental_rerun()
+                except Exception:
+                    st.success("Embeddings generados. Recarga la página manualmente si es necesario.")
+                    st.stop()
+            st.markdown("---")
+            st.subheader("📥 Añadir documentos externos (CSV/TXT/JSON)")
+            uploaded_file = st.file_uploader("Sube un CSV (columna 'content' o 'text'), un .txt o un JSON/JSONL (textos u objetos con 'content'/'text')",
+                                             type=["csv", "txt", "json", "jsonl"], accept_multiple_files=False)
+            if uploaded_file is not None:
+                try:
+                    # (4.0e) Sin leer el archivo completo: se fragmenta e indexa por tandas al agregar
+                    st.write(f"Archivo: `{uploaded_file.name}` ({uploaded_file.size / 1024:.0f} KB), fragmentos de ~{chunk_tokens} tokens con {chunk_overlap} de solapamiento.")
                     if st.button("➕ Agregar a la base de conocimiento"):
-                        added = st.session_state.chatbot_rag.add_external_documents(docs_to_add)
+                        ingest_bar = st.progress(0.0, text="Indexando documentos...")
+                        added, total = st.session_state.chatbot_rag.ingest_file(
+                            uploaded_file, uploaded_file.name,
+                            progress=lambda done, size: ingest_bar.progress(done / max(size, 1), text=f"Indexando documentos... {done / 1024:.0f}/{size / 1024:.0f} KB"))
                         if added:
-                            st.success(f"{len(docs_to_add)} documentos agregados y embeddings regenerados (si procede).")
+                            st.success(f"{added} de {total} fragmentos agregados e indexados.")
+                            if added < total:
+                                st.warning(f"{total - added} fragmentos no se pudieron indexar (lotes fallidos; ver logs).")
                             try:
                                 st.experimental_rerun()
                             except Exception:
                                 st.info("Recarga manual necesaria para ver cambios.")
-                        else:
+                        elif total:
                             st.error("No se pudieron agregar los documentos.")
-                else:
-                    st.error("No se encontraron documentos procesables en el archivo.")
-            except Exception as e:
-                st.error(f"Error procesando archivo: {e}")
+                        else:
+                            st.error("No se encontraron documentos procesables en el archivo.")
+                except Exception as e:
+                    st.error(f"Error procesando archivo: {e}")
 
     # -------------------- TAB 3: DASHBOARD ---------------------
     with tab3:
-        st.header("📊 Dashboard de Observabilidad del Agente")
-        logs = st.session_state.chatbot_rag.interaction_logs or []
+        if _tab_open(tab3):
+            # (7c) Pila de gráficos diferida: solo al abrir la pestaña
+            import pandas as pd
+            import plotly.express as px
+            import plotly.graph_objects as go
+            st.header("📊 Dashboard de Observabilidad del Agente")
+            logs = st.session_state.chatbot_rag.interaction_log.recent()
 
-        if not logs:
-            st.info("No hay interacciones registradas aún. ¡Empieza a chatear!")
-        else:
-            df = pd.DataFrame(logs)
-            df['Fecha'] = pd.to_datetime(df['timestamp'])
-
-            # --- 1. INDICADORES DE RENDIMIENTO (IE2) ---
-            st.subheader("1. Rendimiento y Uso de Recursos (IE2)")
-            col_perf_1, col_perf_2, col_perf_3 = st.columns(3)
-
-            # Cálculos
-            avg_latency = df['metrics'].apply(lambda x: x.get('total_time', 0.0)).mean()
-            error_rate = df['error_occurred'].sum() / len(df)
-            total_tokens = df['metrics'].apply(lambda x: x.get('tokens_used', {}).get('total_tokens', 0)).sum()
-
-            with col_perf_1:
-                st.metric("Total de Consultas", len(df))
-            with col_perf_2:
-                st.metric("Latencia Media Total (s)", f"{avg_latency:.2f}s", delta=f"{avg_latency*1000:.0f} ms")
-            with col_perf_3:
-                st.metric("Total Tokens LLM Usados", f"{total_tokens:,}")
-
-            # Gráficos de Desglose
-            col_chart_1, col_chart_2 = st.columns(2)
-
-            with col_chart_1:
-                st.caption("Desglose de Latencia (Media)")
-                latencies = df['metrics'].apply(lambda x: pd.Series({
-                    'RAG Time': x.get('rag_time', 0.0),
-                    'LLM Gen Time': x.get('total_time', 0.0) - x.get('rag_time', 0.0)
-                })).clip(lower=0)
-
-                fig_comp = px.bar(
-                    latencies.mean().reset_index().rename(columns={'index': 'Componente', 0: 'Tiempo Promedio (s)'}),
-                    x='Componente', y='Tiempo Promedio (s)',
-                    title='Latencia Media por Componente',
-                    color='Componente',
-                    color_discrete_map={'RAG Time': '#0d6efd', 'LLM Gen Time': '#0b5ed7'}
-                )
-                fig_comp.update_layout(template='plotly_white', title_font_size=16)
-                st.plotly_chart(fig_comp, use_container_width=True)
-
-            with col_chart_2:
-                df['Decisión Agente'] = df['context_count'].apply(lambda x: 'Usó RAG' if x > 0 else 'LLM Directo')
-                decision_counts = df['Decisión Agente'].value_counts().reset_index(name='Count')
-                fig_decision = px.pie(
-                    decision_counts, values='Count', names='Decisión Agente',
-                    title='Uso de la Herramienta RAG (Decisión del Agente)',
-                    color_discrete_sequence=['#0d6efd', '#6c757d']
+            # (4.9) Métricas desde agregados incrementales (actualizados en `log_interaction`, sin recorrer el historial)
+            range_options = {"Última hora": 3600, "Últimas 24 h": 86400, "Últimos 7 días": 7 * 86400, "Todo": None}
+            range_label = st.selectbox("Rango temporal", list(range_options), index=3)
+            since = time.time() - range_options[range_label] if range_options[range_label] else None
+            rollup = st.session_state.chatbot_rag.interaction_log.snapshot(since=since)
+
+            if rollup['count'] == 0:
+                st.info("No hay interacciones registradas aún. ¡Empieza a chatear!")
+            else:
+
+                # --- 1. INDICADORES DE RENDIMIENTO (IE2) ---
+                st.subheader("1. Rendimiento y Uso de Recursos (IE2)")
+                col_perf_1, col_perf_2, col_perf_3 = st.columns(3)
+
+                # Cálculos
+                means = rollup['means']
+                avg_latency = means['total_time']
+                error_rate = rollup['error_rate']
+                total_tokens = int(rollup['sums']['total_tokens'])
+
+                with col_perf_1:
+                    st.metric("Total de Consultas", rollup['count'])
+                with col_perf_2:
+                    st.metric("Latencia Media Total (s)", f"{avg_latency:.2f}s", delta=f"{avg_latency*1000:.0f} ms")
+                with col_perf_3:
+                    st.metric("Total Tokens LLM Usados", f"{total_tokens:,}")
+
+                col_p50, col_p95, col_p99 = st.columns(3)
+                for col_q, (q, label) in zip((col_p50, col_p95, col_p99), ((0.5, "p50"), (0.95, "p95"), (0.99, "p99"))):
+                    with col_q:
+                        st.metric(f"Latencia {label} (s)", f"{rollup['latency_quantiles'][q] or 0.0:.2f}s")
+
+                # (4.4) Latencia percibida: tiempo hasta el primer token y velocidad de generación
+                col_ttft, col_ttft_p95, col_tps = st.columns(3)
+                with col_ttft:
+                    st.metric("TTFT Medio (s)", f"{means['ttft']:.2f}s")
+                with col_ttft_p95:
+                    st.metric("TTFT p95 (s)", f"{rollup['ttft_quantiles'][0.95] or 0.0:.2f}s")
+                with col_tps:
+                    st.metric("Tokens/seg Medio", f"{means['tokens_per_sec']:.1f}")
+
+                # Gráficos de Desglose
+                col_chart_1, col_chart_2 = st.columns(2)
+
+                with col_chart_1:
+                    st.caption("Desglose de Latencia (Media)")
+                    latencies = pd.DataFrame({
+                        'Componente': ['RAG Time', 'LLM Gen Time'],
+                        'Tiempo Promedio (s)': [means['rag_time'], max(means['total_time'] - means['rag_time'], 0.0)]
+                    })
+
+                    fig_comp = px.bar(
+                        latencies,
+                        x='Componente', y='Tiempo Promedio (s)',
+                        title='Latencia Media por Componente',
+                        color='Componente',
+                        color_discrete_map={'RAG Time': '#0d6efd', 'LLM Gen Time': '#0b5ed7'}
+                    )
+                    fig_comp.update_layout(template='plotly_white', title_font_size=16)
+                    st.plotly_chart(fig_comp, use_container_width=True)
+
+                with col_chart_2:
+                    decision_counts = pd.DataFrame({
+                        'Decisión Agente': ['Usó RAG', 'LLM Directo'],
+                        'Count': [rollup['rag'], rollup['direct']]
+                    })
+                    fig_decision = px.pie(
+                        decision_counts, values='Count', names='Decisión Agente',
+                        title='Uso de la Herramienta RAG (Decisión del Agente)',
+                        color_discrete_sequence=['#0d6efd', '#6c757d']
+                    )
+                    fig_decision.update_traces(textposition='inside', textinfo='percent+label')
+                    fig_decision.update_layout(template='plotly_white', title_font_size=16)
+                    st.plotly_chart(fig_decision, use_container_width=True)
+
+                # (4.9b) Desglose por etapa desde los histogramas de las trazas (proceso actual)
+                span_stats = st.session_state.chatbot_rag.tracer.summary()
+                if span_stats:
+                    with st.expander("⏱️ Latencia por etapa (trazas)", expanded=True):
+                        order = ["agent_turn", "sanitize", "classify", "ethics", "embed", "provider.embeddings", "answer_cache",
+                                 "search", "context", "generate", "provider.chat", "evaluate", "persist"]
+                        names = [n for n in order if n in span_stats] + sorted(n for n in span_stats if n not in order)
+                        stage_df = pd.DataFrame([{'Etapa': n, 'Muestras': span_stats[n]['count'],
+                                                  'Media (ms)': span_stats[n]['mean'] * 1000,
+                                                  'p50 (ms)': (span_stats[n]['p50'] or 0.0) * 1000,
+                                                  'p95 (ms)': (span_stats[n]['p95'] or 0.0) * 1000,
+                                                  'p99 (ms)': (span_stats[n]['p99'] or 0.0) * 1000} for n in names])
+                        fig_stages = px.bar(stage_df[stage_df['Etapa'] != 'agent_turn'].melt(
+                                                id_vars='Etapa', value_vars=['p50 (ms)', 'p95 (ms)'],
+                                                var_name='Percentil', value_name='Latencia (ms)'),
+                                            x='Etapa', y='Latencia (ms)', color='Percentil', barmode='group',
+                                            title='Latencia p50 / p95 por Etapa',
+                                            color_discrete_map={'p50 (ms)': '#0d6efd', 'p95 (ms)': '#dc3545'})
+                        fig_stages.update_layout(template='plotly_white', title_font_size=16)
+                        st.plotly_chart(fig_stages, use_container_width=True)
+                        st.dataframe(stage_df.round(2), use_container_width=True, hide_index=True)
+                        tracer = st.session_state.chatbot_rag.tracer
+                        st.caption("Histogramas con buckets fijos desde el arranque del proceso; `evaluate` y `persist` corren "
+                               "fuera del camino de respuesta. " +
+                                   (f"Trazas exportadas a `{tracer.path}` ({tracer.exported} tramos)." if tracer.path else ""))
+
+                if rollup['timeline']:
+                    timeline = pd.DataFrame(rollup['timeline'])
+                    timeline['Minuto'] = pd.to_datetime(timeline['minute'], unit='s', utc=True)
+                    fig_timeline = px.bar(timeline, x='Minuto', y='count', hover_data=['errors', 'avg_latency'],
+                                          title='Consultas por Minuto', labels={'count': 'Consultas'},
+                                          color_discrete_sequence=['#0d6efd'])
+                    fig_timeline.update_layout(template='plotly_white', title_font_size=16)
+                    st.plotly_chart(fig_timeline, use_container_width=True)
+
+                # (4.0c) Caché semántica de respuestas
+                answer_cache = st.session_state.chatbot_rag.answer_cache
+                if answer_cache is not None:
+                    cache_stats = answer_cache.stats()
+                    col_cache_1, col_cache_2, col_cache_3 = st.columns(3)
+                    with col_cache_1:
+                        st.metric("Aciertos de Caché", f"{cache_stats['hit_rate']:.0%}",
+                                  delta=f"{cache_stats['hits']} de {cache_stats['hits'] + cache_stats['misses']}", delta_color="off")
+                    with col_cache_2:
+                        st.metric("Latencia Ahorrada (s)", f"{cache_stats['saved_sec']:.1f}s")
+                    with col_cache_3:
+                        st.metric("Respuestas en Caché", f"{cache_stats['entries']} / {answer_cache.max_entries}")
+
+                # (4.0c) Caché exacta de embeddings de consulta (compartida por el proceso)
+                q_stats = get_query_embedding_cache().stats()
+                st.caption(f"Caché de embeddings de consulta: {q_stats['hit_rate']:.0%} aciertos "
+                       f"({q_stats['hits']} aciertos, {q_stats['disk_hits']} desde disco, {q_stats['misses']} fallos; "
+                       f"{q_stats['entries']} entradas)")
+                rl_stats = get_rate_limiter().stats
+                st.caption(f"Rate limiter: {rl_stats['allowed']} permitidas, {rl_stats['limited']} limitadas, "
+                           f"{rl_stats['backend_errors']} errores de backend "
+                           f"({'se permiten' if get_rate_limiter().fail_open else 'se rechazan'} al fallar)")
+
+                # (4.0b) Transporte HTTP de GitHub inference (contadores del proceso actual)
+                transport = st.session_state.chatbot_rag.http_transport
+                if transport is not None:
+                    with st.expander("🌐 Transporte HTTP (GitHub inference)"):
+                        http_stats = transport.stats()
+                        col_http_1, col_http_2, col_http_3, col_http_4 = st.columns(4)
+                        with col_http_1:
+                            st.metric("Solicitudes", http_stats['requests'], delta=f"{http_stats['retries']} reintentos", delta_color="inverse")
+                        with col_http_2:
+                            st.metric("Conexiones Reutilizadas", f"{http_stats['reuse_ratio']:.0%}",
+                                      delta=f"{http_stats['connections_opened']} abiertas", delta_color="off")
+                        with col_http_3:
+                            st.metric("Latencia HTTP p50 / p95 (s)",
+                                      f"{http_stats['latency_p50'] or 0.0:.2f} / {http_stats['latency_p95'] or 0.0:.2f}")
+                        with col_http_4:
+                            st.metric("Fallos", http_stats['failures'])
+                        st.caption("Respuestas por código de estado: " +
+                                   ", ".join(f"{k}: {v}" for k, v in sorted(http_stats['status_counts'].items())))
+
+                st.markdown("---")
+
+                # --- 2. CALIDAD Y ESTABILIDAD (IE1) ---
+                st.subheader("2. Calidad y Estabilidad (IE1)")
+                col_qual_1, col_qual_2 = st.columns(2)
+
+                with col_qual_1:
+                    st.metric("Tasa de Error Global", f"{error_rate:.1%}", delta_color="inverse")
+                    error_counts = pd.Series({'Éxito': rollup['count'] - rollup['errors'], 'Error': rollup['errors']})
+                    error_counts = error_counts[error_counts > 0]
+                    if not error_counts.empty:
+                        fig_error = go.Figure(data=[go.Pie(
+                            labels=error_counts.index,
+                            values=error_counts.values,
+                            hole=.3,
+                            marker={'colors': ['#0d6efd' if l == 'Éxito' else '#dc3545' for l in error_counts.index]}
+                        )])
+                        fig_error.update_layout(title_text="Proporción de Éxito/Error", template='plotly_white', title_font_size=16)
+                        st.plotly_chart(fig_error, use_container_width=True)
+                    else:
+                        st.info("No hay suficiente información de errores.")
+
+                with col_qual_2:
+                    st.caption("Promedios de Métricas de Calidad (0-10)")
+                    avg_quality = pd.DataFrame({
+                        'Métrica': ['Faithfulness', 'Relevance', 'Context Precision'],
+                        'Puntaje Promedio': [means['faithfulness'], means['relevance'], means['context_precision'] * 10.0]
+                    })
+
+                    fig_quality = px.bar(avg_quality, x='Métrica', y='Puntaje Promedio',
+                                         title='Puntajes Promedio de Calidad', color='Métrica',
+                                         range_y=[0, 10],
+                                         color_discrete_map={'Faithfulness': '#198754', 'Relevance': '#ffc107', 'Context Precision': '#0d6efd'})
+                    fig_quality.update_layout(template='plotly_white', title_font_size=16)
+                    st.plotly_chart(fig_quality, use_container_width=True)
+
+                st.markdown("---")
+
+                # --- 3. TRAZABILIDAD Y LOGS CRUDOS (IE3) ---
+                st.subheader("3. Logs de Interacción y Trazabilidad (IE3)")
+                st.info("Los logs estructurados completos (JSON) están en la terminal para un análisis detallado de cada paso.")
+                st.caption(f"Detalle de las {len(logs)} interacciones recientes (segmento activo); "
+                       f"{st.session_state.chatbot_rag.log_archive.count} interacciones anteriores archivadas en data/logs/.")
+                df = pd.DataFrame(logs) if logs else pd.DataFrame(columns=['timestamp', 'query', 'context_count', 'error_occurred', 'metrics'])
+                df['Fecha'] = pd.to_datetime(df['timestamp'])
+                df['Decisión Agente'] = np.where(df['context_count'].fillna(0) > 0, 'Usó RAG', 'LLM Directo')
+
+                st.download_button(
+                    label="📥 Descargar Logs de Interacción (CSV)",
+                    data=df.to_csv().encode('utf-8'),
+                    file_name=f'logs_interacciones_hbl_{datetime.now().strftime("%Y%m%d_%H%M")}.csv',
+                    mime='text/csv',
+                    type="primary"
                 )
-                fig_decision.update_traces(textposition='inside', textinfo='percent+label')
-                fig_decision.update_layout(template='plotly_white', title_font_size=16)
-                st.plotly_chart(fig_decision, use_container_width=True)
+                # Guardar / Cargar logs (JSON) - persistencia local
+                col_save, col_load = st.columns([1, 2])
+                with col_save:
+                    # (4.9) Cada interacción ya se agrega a data/logs.jsonl; esto reescribe el fichero completo
+                    if st.button("💾 Reescribir data/logs.jsonl", type="primary"):
+                        try:
+                            saved = st.session_state.chatbot_rag._save_logs()
+                            if saved:
+                                st.success(f"Logs guardados en {st.session_state.chatbot_rag.logs_path}")
+                        except Exception as e:
+                            st.error(f"Error guardando logs: {e}")
+                with col_load:
+                    uploaded = st.file_uploader("📂 Cargar logs (JSON o JSONL)", type=["json", "jsonl"])
+                    if uploaded is not None:
+                        try:
+                            if uploaded.name.lower().endswith('.jsonl'):
+                                loaded = [json.loads(line) for line in uploaded.getvalue().decode('utf-8').splitlines() if line.strip()]
+                            else:
+                                loaded = json.load(uploaded)
+                            if isinstance(loaded, list):
+                                # (4.9) Sustituye la ventana compartida, persiste en disco y recalcula los agregados
+                                try:
+                                    st.session_state.chatbot_rag._save_logs(loaded)
+                                except Exception:
+                                    pass
+                                st.success("Logs cargados en la sesión y guardados localmente.")
+                                try:
+                                    st.experimental_rerun()
+                                except Exception:
+                                    st.info("Recarga manual necesaria para ver los cambios.")
+                            else:
+                                st.error("Formato inesperado: se esperaba una lista JSON de logs.")
+                        except Exception as e:
+                            st.error(f"Error procesando archivo: {e}")
+                # Mostrar las columnas más relevantes
+                # Asegurar columnas existentes antes de mostrar (evita KeyError cuando la clave fue registrada en inglés)
+                if 'error_ocurrred' in df.columns:
+                    # typo guard: unlikely but handle
+                    df['error_ocurrido'] = df['error_ocurrred']
+                if 'error_occurred' in df.columns and 'error_ocurrido' not in df.columns:
+                    df['error_ocurrido'] = df['error_occurred']
+                if 'error_ocurrido' not in df.columns:
+                    # crear columna por compatibilidad (valor False si no existe)
+                    df['error_ocurrido'] = False
 
-            st.markdown("---")
+                subset_cols = [c for c in ['Fecha', 'query', 'Decisión Agente', 'error_ocurrido', 'metrics'] if c in df.columns]
+                display_df = df[subset_cols].rename(columns={'query': 'Consulta', 'error_ocurrido': 'Error'})
+                st.dataframe(display_df, height=300, use_container_width=True)
+
+
+ # ==============================================================
+ # 7b. BENCHMARK OFFLINE (proveedores simulados, percentiles por etapa)
+ # ==============================================================
+class StubObject:
+    """(7b) Respuesta simulada con acceso por atributo (como los objetos del SDK) y `model_dump()`."""
+
+    def __init__(self, data):
+        self._data = data
+
+    def __getattr__(self, name):
+        try:
+            value = self._data[name]
+        except KeyError:
+            raise AttributeError(name) from None
+        if isinstance(value, dict):
+            return StubObject(value)
+        if isinstance(value, list):
+            return [StubObject(v) if isinstance(v, dict) else v for v in value]
+        return value
+
+    def model_dump(self):
+        return self._data
+
+
+class StubLLMBackend:
+    """
+    (7b) Proveedor determinista para medir sin red: embeddings por hashing de palabras (textos
+    parecidos quedan cerca, así la búsqueda híbrida trabaja sobre datos realistas) y respuestas de
+    chat fijas. Cada llamada duerme la latencia configurada (± `jitter` relativo); el chat reparte
+    `chat_latency` entre el primer token (`ttft`) y `tokens` fragmentos.
+    """
+
+    def __init__(self, dim=256, embed_latency=0.02, chat_latency=0.3, ttft=0.08, tokens=40, jitter=0.1, seed=0):
+        self.dim = dim
+        self.embed_latency = embed_latency
+        self.chat_latency = chat_latency
+        self.ttft = min(ttft, chat_latency)
+        self.tokens = max(1, tokens)
+        self.jitter = jitter
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def delay(self, base):
+        with self._lock:
+            return max(0.0, base * (1.0 + self.jitter * self._rng.uniform(-1.0, 1.0)))
+
+    def vector(self, text):
+        vec = np.zeros(self.dim, dtype=np.float32)
+        for term in LexicalIndex.tokenize(text):
+            digest = hashlib.blake2b(term.encode("utf-8"), digest_size=8).digest()
+            vec[int.from_bytes(digest[:4], "little") % self.dim] += 1.0 if digest[4] & 1 else -1.0
+        return vec.tolist()
+
+    def embeddings_response(self, texts):
+        return {"data": [{"embedding": self.vector(t), "index": i} for i, t in enumerate(texts)]}
+
+    def _answer(self, payload):
+        prompt = payload["messages"][0]["content"]
+        words = ["Según", "la", "información", "del", "hospital,", "el", "servicio", "está", "disponible."]
+        pieces = [words[i % len(words)] + " " for i in range(self.tokens)]
+        usage = {"prompt_tokens": len(prompt) // 4, "completion_tokens": self.tokens,
+                 "total_tokens": len(prompt) // 4 + self.tokens}
+        return pieces, usage
 
-            # --- 2. CALIDAD Y ESTABILIDAD (IE1) ---
-            st.subheader("2. Calidad y Estabilidad (IE1)")
-            col_qual_1, col_qual_2 = st.columns(2)
-
-            with col_qual_1:
-                st.metric("Tasa de Error Global", f"{error_rate:.1%}", delta_color="inverse")
-                error_counts = df['error_occurred'].value_counts().rename({True: 'Error', False: 'Éxito'})
-                if not error_counts.empty:
-                    fig_error = go.Figure(data=[go.Pie(
-                        labels=error_counts.index,
-                        values=error_counts.values,
-                        hole=.3,
-                        marker={'colors': ['#0d6efd' if l == 'Éxito' else '#dc3545' for l in error_counts.index]}
-                    )])
-                    fig_error.update_layout(title_text="Proporción de Éxito/Error", template='plotly_white', title_font_size=16)
-                    st.plotly_chart(fig_error, use_container_width=True)
+    def chat_response(self, payload):
+        pieces, usage = self._answer(payload)
+        return {"choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(pieces).strip()}}],
+                "usage": usage}
+
+    def chat_events(self, payload):
+        """Eventos de streaming: (espera previa, evento) por fragmento, más el evento final con `usage`."""
+        pieces, usage = self._answer(payload)
+        step = (self.chat_latency - self.ttft) / len(pieces)
+        for i, piece in enumerate(pieces):
+            yield self.delay(self.ttft if i == 0 else step), {"choices": [{"index": 0, "delta": {"content": piece}}]}
+        yield 0.0, {"choices": [], "usage": usage}
+
+
+class StubOpenAI:
+    """(7b) Sustituto síncrono de `OpenAI` sobre `StubLLMBackend` (embeddings y chat/completions)."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.embeddings = StubObject({"create": self._embeddings})
+        self.chat = StubObject({"completions": {"create": self._chat}})
+
+    def _embeddings(self, model, input, **_):
+        time.sleep(self.backend.delay(self.backend.embed_latency))
+        return StubObject(self.backend.embeddings_response(input))
+
+    def _chat(self, stream=False, stream_options=None, **payload):
+        if not stream:
+            time.sleep(self.backend.delay(self.backend.chat_latency))
+            return StubObject(self.backend.chat_response(payload))
+        return self._stream(payload)
+
+    def _stream(self, payload):
+        for wait, event in self.backend.chat_events(payload):
+            time.sleep(wait)
+            yield StubObject(event)
+
+
+class StubAsyncOpenAI(StubOpenAI):
+    """(7b) Sustituto de `AsyncOpenAI`: mismas respuestas, esperas con `asyncio.sleep`."""
+
+    async def _embeddings(self, model, input, **_):
+        await asyncio.sleep(self.backend.delay(self.backend.embed_latency))
+        return StubObject(self.backend.embeddings_response(input))
+
+    async def _chat(self, stream=False, stream_options=None, **payload):
+        if not stream:
+            await asyncio.sleep(self.backend.delay(self.backend.chat_latency))
+            return StubObject(self.backend.chat_response(payload))
+        return self._stream(payload)
+
+    async def _stream(self, payload):
+        for wait, event in self.backend.chat_events(payload):
+            await asyncio.sleep(wait)
+            yield StubObject(event)
+
+
+class StubHTTPServer:
+    """
+    (7b) Servidor HTTP local que imita GitHub inference (`POST /embeddings`, `POST /chat/completions`,
+    con SSE en streaming) sobre `StubLLMBackend`, para medir el modo `github_mode` con el transporte real.
+    """
+
+    def __init__(self, backend, host="127.0.0.1", port=0):
+        backend_ref = backend
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True  # cabeceras y cuerpo van en escrituras separadas (evita +40 ms por ACK diferido)
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, body, content_type="application/json"):
+                data = body.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if self.path.rstrip("/").endswith("/embeddings"):
+                    time.sleep(backend_ref.delay(backend_ref.embed_latency))
+                    self._send(json.dumps(backend_ref.embeddings_response(payload.get("input") or [])))
+                elif not payload.get("stream"):
+                    time.sleep(backend_ref.delay(backend_ref.chat_latency))
+                    self._send(json.dumps(backend_ref.chat_response(payload)))
                 else:
-                    st.info("No hay suficiente información de errores.")
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/event-stream")
+                    self.send_header("Transfer-Encoding", "chunked")
+                    self.end_headers()
+                    for wait, event in backend_ref.chat_events(payload):
+                        time.sleep(wait)
+                        chunk = f"data: {json.dumps(event)}\n\n".encode("utf-8")
+                        self.wfile.write(f"{len(chunk):x}\r\n".encode("ascii") + chunk + b"\r\n")
+                        self.wfile.flush()
+                    done = b"data: [DONE]\n\n"
+                    self.wfile.write(f"{len(done):x}\r\n".encode("ascii") + done + b"\r\n0\r\n\r\n")
 
-            with col_qual_2:
-                st.caption("Promedios de Métricas de Calidad (0-10)")
-                quality_metrics = df['metrics'].apply(lambda x: pd.Series({
-                    'Faithfulness': x.get('faithfulness', 0.0),
-                    'Relevance': x.get('relevance', 0.0),
-                    'Context Precision': x.get('context_precision', 0.0) * 10.0
-                })).apply(pd.Series)
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://{host}:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, name="atlas-stub-http", daemon=True).start()
 
-                avg_quality = quality_metrics.mean().reset_index().rename(columns={'index': 'Métrica', 0: 'Puntaje Promedio'})
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
 
-                fig_quality = px.bar(avg_quality, x='Métrica', y='Puntaje Promedio',
-                                     title='Puntajes Promedio de Calidad', color='Métrica',
-                                     range_y=[0, 10],
-                                     color_discrete_map={'Faithfulness': '#198754', 'Relevance': '#ffc107', 'Context Precision': '#0d6efd'})
-                fig_quality.update_layout(template='plotly_white', title_font_size=16)
-                st.plotly_chart(fig_quality, use_container_width=True)
 
-            st.markdown("---")
+class StageRecorder:
+    """
+    (7b) Tiempos por etapa de cada consulta. `instrument` envuelve, en una instancia concreta del
+    agente, los métodos que implementan cada etapa (las etapas pueden solaparse: el embedding
+    corre en paralelo a los filtros). Una instancia por trabajador: las consultas de un mismo
+    trabajador son secuenciales.
+    """
+    STAGES = ("sanitize", "ethics", "embed", "search", "generate", "persist")
 
-            # --- 3. TRAZABILIDAD Y LOGS CRUDOS (IE3) ---
-            st.subheader("3. Logs de Interacción y Trazabilidad (IE3)")
-            st.info("Los logs estructurados completos (JSON) están en la terminal para un análisis detallado de cada paso.")
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._current = defaultdict(float)
 
-            st.download_button(
-                label="📥 Descargar Logs de Interacción (CSV)",
-                data=df.to_csv().encode('utf-8'),
-                file_name=f'logs_interacciones_hbl_{datetime.now().strftime("%Y%m%d_%H%M")}.csv',
-                mime='text/csv',
-                type="primary"
-            )
-            # Guardar / Cargar logs (JSON) - persistencia local
-            col_save, col_load = st.columns([1, 2])
-            with col_save:
-                if st.button("💾 Guardar logs en data/logs.json", type="primary"):
-                    try:
-                        saved = st.session_state.chatbot_rag._save_logs()
-                        if saved:
-                            st.success(f"Logs guardados en {st.session_state.chatbot_rag.logs_path}")
-                    except Exception as e:
-                        st.error(f"Error guardando logs: {e}")
-            with col_load:
-                uploaded = st.file_uploader("📂 Cargar logs (archivo JSON)", type=["json"])
-                if uploaded is not None:
-                    try:
-                        loaded = json.load(uploaded)
-                        if isinstance(loaded, list):
-                            st.session_state.chatbot_rag.interaction_logs = loaded
-                            # also persist loaded logs to disk
-                            try:
-                                st.session_state.chatbot_rag._save_logs()
-                            except Exception:
-                                pass
-                            st.success("Logs cargados en la sesión y guardados localmente.")
-                            try:
-                                st.experimental_rerun()
-                            except Exception:
-                                st.info("Recarga manual necesaria para ver los cambios.")
-                        else:
-                            st.error("Formato inesperado: se esperaba una lista JSON de logs.")
-                    except Exception as e:
-                        st.error(f"Error procesando archivo: {e}")
-            # Mostrar las columnas más relevantes
-            # Asegurar columnas existentes antes de mostrar (evita KeyError cuando la clave fue registrada en inglés)
-            if 'error_ocurrred' in df.columns:
-                # typo guard: unlikely but handle
-                df['error_ocurrido'] = df['error_ocurrred']
-            if 'error_occurred' in df.columns and 'error_ocurrido' not in df.columns:
-                df['error_ocurrido'] = df['error_occurred']
-            if 'error_ocurrido' not in df.columns:
-                # crear columna por compatibilidad (valor False si no existe)
-                df['error_ocurrido'] = False
+    def add(self, stage, seconds):
+        with self._lock:
+            self._current[stage] += seconds
+
+    def begin(self):
+        with self._lock:
+            self._current = defaultdict(float)
+
+    def end(self):
+        with self._lock:
+            return dict(self._current)
+
+    def _timed(self, stage, fn):
+        if inspect.isasyncgenfunction(fn):
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    async for item in fn(*args, **kwargs):
+                        yield item
+                finally:
+                    self.add(stage, time.perf_counter() - start)
+        elif inspect.iscoroutinefunction(fn):
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    self.add(stage, time.perf_counter() - start)
+        else:
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self.add(stage, time.perf_counter() - start)
+        return wrapper
+
+    def instrument(self, chatbot):
+        stages = {
+            'sanitize': ["sanitize_input"],
+            'ethics': ["ethical_check"],
+            'embed': ["aget_query_embedding"],
+            'search': ["hybrid_search_with_metrics"],
+            'generate': ["agenerate_response_with_metrics", "astream_response_with_metrics"],
+            'persist': ["log_interaction"],
+        }
+        for stage, names in stages.items():
+            for name in names:
+                setattr(chatbot, name, self._timed(stage, getattr(chatbot, name)))
+        # La clasificación por palabras clave forma parte del filtro ético
+        chatbot.keyword_matcher = StubObject({'classify': self._timed('ethics', chatbot.keyword_matcher.classify)})
+        return chatbot
+
+
+BENCHMARK_TOPICS = ["Cardiología", "Pediatría", "Neurología", "Oncología", "Radiología", "Dermatología",
+                    "Laboratorio Clínico", "Rehabilitación Física", "Ginecología", "Traumatología"]
+
+
+def synthetic_corpus(n, seed=0):
+    """(7b) `n` documentos hospitalarios sintéticos (servicio, horario, piso, teléfono, requisitos)."""
+    rng = random.Random(seed)
+    days = ["Lunes a Viernes", "Sábados", "Lunes a Sábado", "Martes y Jueves"]
+    docs = []
+    for i in range(n):
+        topic = BENCHMARK_TOPICS[i % len(BENCHMARK_TOPICS)]
+        docs.append(
+            f"Servicio de {topic} (unidad {i}): atención {rng.choice(days)} de {rng.randint(7, 10)}:00 a "
+            f"{rng.randint(14, 20)}:00 en el piso {rng.randint(1, 9)}. Teléfono de contacto (01) {rng.randint(200, 999)}-"
+            f"{rng.randint(1000, 9999)}. Para la consulta se requiere orden médica, documento de identidad y "
+            f"previsión vigente; el protocolo de {topic.lower()} prioriza casos urgentes derivados de emergencias.")
+    return docs
+
+
+def synthetic_queries(n, seed=0):
+    """(7b) Mezcla de consultas RAG, directas y bloqueadas (aprox. 70 / 20 / 10 %)."""
+    rng = random.Random(seed)
+    rag = ["¿Cuál es el horario de {t}?", "¿Qué protocolo sigue {t} en urgencias?",
+           "¿Cómo pido una cita en {t}?", "¿En qué piso está el servicio de {t} del hospital?"]
+    direct = ["¿Qué es la presión arterial?", "Dame consejos para dormir mejor", "¿Cuánta agua debo tomar al día?"]
+    blocked = ["¿Cómo fabricar una bomba?", "Quiero hackear el sistema del hospital"]
+    queries = []
+    for _ in range(n):
+        roll = rng.random()
+        if roll < 0.7:
+            queries.append(rng.choice(rag).format(t=rng.choice(BENCHMARK_TOPICS)))
+        elif roll < 0.9:
+            queries.append(rng.choice(direct))
+        else:
+            queries.append(rng.choice(blocked))
+    return queries
+
+
+def load_replay_queries(path):
+    """(7b) Consultas registradas en un log JSON (lista) o JSONL (una entrada por línea)."""
+    with open(path, "r", encoding="utf-8") as fh:
+        text = fh.read()
+    try:
+        entries = json.loads(text)
+    except json.JSONDecodeError:
+        entries = [json.loads(line) for line in text.splitlines() if line.strip()]
+    if isinstance(entries, dict):
+        entries = [entries]
+    return [str(e['query']) for e in entries if isinstance(e, dict) and e.get('query')]
+
+
+def _percentiles(values):
+    arr = np.asarray(values, dtype=np.float64)
+    if not len(arr):
+        return {'count': 0}
+    p50, p95, p99 = np.percentile(arr, [50, 95, 99])
+    return {'count': int(len(arr)), 'mean': float(arr.mean()), 'p50': float(p50), 'p95': float(p95),
+            'p99': float(p99), 'max': float(arr.max())}
+
+
+def run_benchmark(argv=None):
+    """
+    (7b) Benchmark sin red: `python AtlasBot.py --benchmark [opciones]`. Construye el corpus con
+    proveedores simulados (en proceso o vía servidor HTTP local), ejecuta `run_agent_logic` (o la
+    variante en streaming) para cada consulta y escribe en JSON p50/p95/p99 por etapa y de punta a
+    punta, throughput y memoria pico. Todo lo persistido va a un directorio temporal.
+    """
+    parser = argparse.ArgumentParser(prog="AtlasBot.py --benchmark", description="Benchmark offline del agente")
+    parser.add_argument("--mode", choices=["sdk", "http"], default="sdk", help="stubs del SDK en proceso o servidor HTTP local (github_mode)")
+    parser.add_argument("--docs", type=int, default=1000, help="documentos del corpus sintético")
+    parser.add_argument("--queries", type=int, default=200, help="consultas sintéticas (si no hay --replay)")
+    parser.add_argument("--replay", help="log JSON/JSONL cuyas consultas se reproducen (p. ej. data/logs.json)")
+    parser.add_argument("--concurrency", type=int, default=1, help="sesiones simultáneas (comparten la base de conocimiento)")
+    parser.add_argument("--stream", action="store_true", help="usar la generación en streaming")
+    parser.add_argument("--answer-cache", action="store_true", help="habilitar la caché semántica de respuestas")
+    parser.add_argument("--embed-latency", type=float, default=0.02, help="s por llamada de embeddings")
+    parser.add_argument("--chat-latency", type=float, default=0.3, help="s por respuesta de chat")
+    parser.add_argument("--ttft", type=float, default=0.08, help="s hasta el primer token en streaming")
+    parser.add_argument("--jitter", type=float, default=0.1, help="variación relativa de las latencias")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-tracemalloc", action="store_true", help="no medir memoria con tracemalloc (menos overhead)")
+    parser.add_argument("--output", help="archivo JSON de salida (por defecto stdout)")
+    parser.add_argument("--verbose", action="store_true", help="mantener los logs INFO (por defecto solo errores)")
+    args = parser.parse_args(argv)
+
+    queries = load_replay_queries(args.replay) if args.replay else synthetic_queries(args.queries, args.seed)
+    if not queries:
+        parser.error("no hay consultas para ejecutar")
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.ERROR)
+    backend = StubLLMBackend(embed_latency=args.embed_latency, chat_latency=args.chat_latency, ttft=args.ttft,
+                             jitter=args.jitter, seed=args.seed)
+    server = StubHTTPServer(backend) if args.mode == "http" else None
+    workdir, cwd = tempfile.mkdtemp(prefix="atlas-bench-"), os.getcwd()
+    trace_memory = not args.no_tracemalloc
+    try:
+        os.chdir(workdir)  # logs, almacén de embeddings y documentos del benchmark quedan aislados
+        if trace_memory:
+            tracemalloc.start()
+        kb, interaction_log, tracer, evaluator = KnowledgeBase(), InteractionLog(), Tracer(), EvaluationWorker()
+        workers = []
+        for _ in range(max(1, args.concurrency)):
+            chatbot = ChatbotMedicoRAG(knowledge_base=kb, interaction_log=interaction_log, tracer=tracer, evaluator=evaluator)
+            if not args.answer_cache:
+                chatbot.answer_cache = None
+            if server is not None:
+                chatbot.github_mode, chatbot.github_token, chatbot.github_inference_url = True, "stub", server.url
+            else:
+                chatbot.github_mode = False
+                chatbot.client, chatbot.async_client = StubOpenAI(backend), StubAsyncOpenAI(backend)
+            recorder = StageRecorder()
+            recorder.instrument(chatbot)
+            workers.append((chatbot, recorder))
+
+        start = time.perf_counter()
+        builder = workers[0][0]
+        builder.initialize_hospital_documents()
+        if args.docs:
+            builder.append_documents(synthetic_corpus(args.docs, args.seed), persist=False)
+        else:
+            builder.get_embeddings(builder.documents)
+        index_sec = time.perf_counter() - start
+
+        samples = defaultdict(list)
+        totals, ttfts, errors = [], [], 0
+        samples_lock = threading.Lock()
+
+        def run_worker(worker_index):
+            nonlocal errors
+            chatbot, recorder = workers[worker_index]
+            for query in queries[worker_index::len(workers)]:
+                recorder.begin()
+                t0 = time.perf_counter()
+                try:
+                    if args.stream:
+                        outcome = {}
+                        for _ in chatbot.stream_agent_logic(query, outcome):
+                            pass
+                        metrics = outcome.get('metrics') or {}
+                    else:
+                        _, metrics, _ = chatbot.run_agent_logic(query)
+                    elapsed = time.perf_counter() - t0
+                    if chatbot.pending_evaluation is not None:
+                        chatbot.pending_evaluation.result()  # registro (fuera del camino de respuesta)
+                        chatbot.pending_evaluation = None
+                    failed = False
+                except Exception as e:
+                    elapsed, metrics, failed = time.perf_counter() - t0, {}, True
+                    logger.warning("benchmark_query_error", error=str(e))
+                stages = recorder.end()
+                with samples_lock:
+                    errors += failed
+                    totals.append(elapsed)
+                    if metrics.get('ttft'):
+                        ttfts.append(metrics['ttft'])
+                    for stage, seconds in stages.items():
+                        samples[stage].append(seconds)
+
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(workers)) as pool:
+            list(pool.map(run_worker, range(len(workers))))
+        wall_sec = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+        evaluator.drain()  # (4.9c) evaluaciones por lotes pendientes (fuera del tiempo medido)
+        interaction_log.get_writer().flush()
+
+        report = {
+            'config': {k: v for k, v in vars(args).items() if k not in ("output", "verbose")},
+            'corpus': {'documents': len(kb.snapshot.documents), 'index_sec': index_sec,
+                       'ann': kb.snapshot.ann_index is not None},
+            'queries': len(queries),
+            'errors': errors,
+            'wall_sec': wall_sec,
+            'throughput_qps': len(queries) / wall_sec if wall_sec > 0 else 0.0,
+            'total': _percentiles(totals),
+            'ttft': _percentiles(ttfts),
+            'stages': {stage: _percentiles(samples.get(stage, [])) for stage in StageRecorder.STAGES},
+            'spans': tracer.summary(),  # (4.9b) histogramas de buckets fijos del propio agente
+            'evaluation': dict(evaluator.stats),  # (4.9c) lotes del evaluador en segundo plano
+            'memory': {'tracemalloc_peak_mb': peak / 2 ** 20 if peak is not None else None},
+        }
+        try:
+            import resource
+            scale = 1 if sys.platform == "darwin" else 1024  # ru_maxrss: bytes en macOS, KiB en Linux
+            report['memory']['rss_peak_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2 ** 20
+        except Exception:
+            pass
+    finally:
+        if trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        os.chdir(cwd)
+        if server is not None:
+            server.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as fh:
+            fh.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+
+ # ==============================================================
+ # 7c. PRESUPUESTO DE ARRANQUE (importación diferida y tiempo de arranque medidos)
+ # ==============================================================
+DEFERRED_IMPORTS = {
+    # grupo -> módulos que se importan solo al usar su función (ver comentario (7c) en los imports)
+    'openai': ["openai"],
+    'requests': ["requests"],
+    'pandas': ["pandas"],
+    'plotly': ["plotly.express"],  # `plotly.graph_objects` ya lo importa Streamlit
+    'scikit-learn': ["scipy.sparse", "sklearn.feature_extraction.text", "sklearn.random_projection", "sklearn.preprocessing"],
+}  # scikit-learn importa pandas: con el backend local de embeddings pandas se carga con él
+
+_IMPORT_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import AtlasBot
+elapsed = time.perf_counter() - start
+print(json.dumps({'sec': elapsed, 'loaded': sorted(g for g, mods in AtlasBot.DEFERRED_IMPORTS.items()
+                                                   if any(m in sys.modules for m in mods))}))
+"""
+
+_DEFERRED_PROBE = """
+import json, sys, time, importlib
+import streamlit, numpy
+start = time.perf_counter()
+for name in sys.argv[1:]:
+    importlib.import_module(name)
+print(json.dumps({'sec': time.perf_counter() - start}))
+"""
+
+_APP_PROBE = """
+import json, sys, time
+from streamlit.testing.v1 import AppTest
+groups = json.loads(sys.argv[2])
+before = set(sys.modules)
+at = AppTest.from_file(sys.argv[1], default_timeout=float(sys.argv[3]))
+start = time.perf_counter()
+at.run()
+first = time.perf_counter() - start
+loaded = sorted(g for g, mods in groups.items() if any(m in sys.modules and m not in before for m in mods))
+start = time.perf_counter()
+at.run()
+rerun = time.perf_counter() - start
+print(json.dumps({'first_run_sec': first, 'rerun_sec': rerun, 'loaded': loaded,
+                  'exceptions': [str(e.value)[:200] for e in at.exception]}))
+"""
+
+
+def _run_probe(code, args=(), cwd=None, env=None, timeout=300):
+    """Ejecuta `code` en un intérprete nuevo (sin módulos ya cargados) y devuelve su última línea JSON."""
+    import subprocess
+    proc = subprocess.run([sys.executable, "-c", code, *args], cwd=cwd, env=env, capture_output=True, text=True,
+                          timeout=timeout)
+    lines = [line for line in proc.stdout.splitlines() if line.startswith("{")]
+    if proc.returncode != 0 or not lines:
+        raise RuntimeError((proc.stderr or proc.stdout).strip()[-500:])
+    return json.loads(lines[-1])
+
+
+def run_startup_benchmark(argv=None):
+    """
+    (7c) Presupuesto de arranque: `python AtlasBot.py --startup [opciones]`. Mide en intérpretes
+    nuevos el tiempo de importar el módulo (mediana de `--repeat`), lo que cuesta cada dependencia
+    diferida al usarse por primera vez y, con `streamlit.testing`, la primera ejecución del script
+    (pestaña de chat, corpus con embeddings locales en un directorio temporal) y un rerun. Escribe
+    un JSON y devuelve 1 si se supera algún presupuesto o si el script falla.
+    """
+    parser = argparse.ArgumentParser(prog="AtlasBot.py --startup", description="Presupuesto de arranque del agente")
+    parser.add_argument("--repeat", type=int, default=5, help="importaciones medidas (se informa la mediana)")
+    parser.add_argument("--budget-import-ms", type=float, default=1500.0, help="presupuesto para `import AtlasBot`")
+    parser.add_argument("--budget-first-run-ms", type=float, default=10000.0, help="presupuesto para la primera ejecución")
+    parser.add_argument("--budget-rerun-ms", type=float, default=1000.0, help="presupuesto para un rerun de Streamlit")
+    parser.add_argument("--no-app", action="store_true", help="medir solo importaciones (sin ejecutar el script)")
+    parser.add_argument("--timeout", type=float, default=300.0, help="s máximos por ejecución del script")
+    parser.add_argument("--output", help="archivo JSON de salida (por defecto stdout)")
+    args = parser.parse_args(argv)
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE="1")
+    imports = [_run_probe(_IMPORT_PROBE, cwd=here, env=env, timeout=args.timeout) for _ in range(max(1, args.repeat))]
+    import_sec = float(np.median([r['sec'] for r in imports]))
+    report = {
+        'config': {k: v for k, v in vars(args).items() if k != "output"},
+        'import': {'median_sec': import_sec, 'min_sec': min(r['sec'] for r in imports),
+                   'max_sec': max(r['sec'] for r in imports), 'deferred_loaded': imports[-1]['loaded']},
+        'deferred': {},
+        'app': None,
+        'budget': {},
+    }
+    for group, modules in DEFERRED_IMPORTS.items():
+        try:
+            report['deferred'][group] = _run_probe(_DEFERRED_PROBE, modules, env=env, timeout=args.timeout)['sec']
+        except Exception as e:
+            report['deferred'][group] = None  # dependencia no instalada
+            logger.warning("startup_deferred_error", group=group, error=str(e))
+    checks = {'import': (import_sec, args.budget_import_ms)}
+    if not args.no_app:
+        workdir = tempfile.mkdtemp(prefix="atlas-startup-")
+        app_env = dict(env, ATLAS_EMBEDDINGS_BACKEND="local")  # corpus indexado sin red ni claves
+        try:
+            report['app'] = _run_probe(_APP_PROBE, [os.path.join(here, os.path.basename(__file__)),
+                                                    json.dumps(DEFERRED_IMPORTS), str(args.timeout)],
+                                       cwd=workdir, env=app_env, timeout=args.timeout * 2)
+            checks['first_run'] = (report['app']['first_run_sec'], args.budget_first_run_ms)
+            checks['rerun'] = (report['app']['rerun_sec'], args.budget_rerun_ms)
+        except Exception as e:
+            report['app'] = {'error': str(e)}
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+    for name, (seconds, budget_ms) in checks.items():
+        report['budget'][name] = {'ms': seconds * 1000, 'budget_ms': budget_ms, 'ok': seconds * 1000 <= budget_ms}
+    app = report['app'] or {}
+    if app.get('error') or app.get('exceptions'):
+        # El script falló o no se pudo medir: cuenta como presupuesto incumplido (código de salida 1)
+        report['budget']['app'] = {'ok': False, 'error': app.get('error'), 'exceptions': app.get('exceptions')}
 
-            subset_cols = [c for c in ['Fecha', 'query', 'Decisión Agente', 'error_ocurrido', 'metrics'] if c in df.columns]
-            display_df = df[subset_cols].rename(columns={'query': 'Consulta', 'error_ocurrido': 'Error'})
-            st.dataframe(display_df, height=300, use_container_width=True)
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as fh:
+            fh.write(text + "\n")
+    else:
+        print(text)
+    return 0 if all(b['ok'] for b in report['budget'].values()) else 1
 
 
  # ==============================================================
  # 8. BLOQUE PRINCIPAL (Manejo de errores global)
  # ==============================================================
 if __name__ == "__main__":
+    if "--benchmark" in sys.argv[1:]:
+        # (7b) Benchmark offline: `python AtlasBot.py --benchmark [opciones]` (sin Streamlit ni red)
+        sys.exit(run_benchmark([a for a in sys.argv[1:] if a != "--benchmark"]))
+    if "--startup" in sys.argv[1:]:
+        # (7c) Presupuesto de arranque: `python AtlasBot.py --startup [opciones]`
+        sys.exit(run_startup_benchmark([a for a in sys.argv[1:] if a != "--startup"]))
     try:
         main()
     except Exception as e: